@@ -74,6 +74,9 @@ def register():
         contract_wizard.ContractTermAdjustmentStart,
         contract_wizard.ContractTermAdjustmentConfirm,
         contract_wizard.ContractTermAdjustmentResult,
+        contract_wizard.ProjectedCashFlowsStart,
+        contract_wizard.ProjectedCashFlowsResult,
+        contract_wizard.ProjectedCashFlow,
         #sequence.Sequence,
         res.User,
         ir.Cron,
@@ -92,6 +95,8 @@ def register():
         billing_unit.BillingUnit,
         billing_unit.BillingUnitLog,
         billing_unit.BillingUnitMoves,
+        billing_unit.BillingRun,
+        billing_unit.BillingRunProperty,
         billing_unit.BillingUnitMovesContext,
         settlement_unit.SettlementUnitContext,
         settlement_unit.SettlementUnit,
@@ -113,6 +118,7 @@ def register():
         billing_unit_wizard.BillingUnitWizard,
         billing_unit_wizard.CancelBillingWizard,
         contract_wizard.ContractTermAdjustmentWizard,
+        contract_wizard.ProjectedCashFlowsWizard,
         option_rate_wizard.OptionRateUpdateWizard,
         module='real_estate', type_='wizard')
     Pool.register(
@@ -7,9 +7,10 @@ from trytond.model.exceptions import ValidationError
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
 from trytond.cache import Cache
+from trytond import backend
 from trytond.report import Report
 from trytond.pool import Pool
-from trytond.transaction import Transaction
+from trytond.transaction import Transaction, inactive_records
 from trytond.pyson import Bool, Eval, If, PYSONEncoder, TimeDelta, Equal
 from trytond.pool import PoolMeta
 from trytond.wizard import Button, StateTransition, StateView, Wizard
@@ -17,7 +18,10 @@ from trytond.i18n import lazy_gettext
 from trytond.modules.company import CompanyReport
 
 from sql import Column
+from sql.aggregate import Count
+from trytond.tools import grouped_slice
 from decimal import Decimal
+import bisect
 import datetime
 
 from dateutil.relativedelta import relativedelta
@@ -26,6 +30,91 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+# Upper bound of the estimated cost of one billing job (see call_billing)
+_billing_job_cost = 2000
+
+
+def partition_by_cost(costs, budget):
+    """Split the keys of costs into jobs of at most budget total cost.
+
+    The keys are placed largest first into the first job with room left
+    (first-fit decreasing); a key costing more than the budget gets a job of
+    its own. The jobs are returned most expensive first."""
+    jobs = []
+    for key in sorted(costs, key=lambda k: costs[k], reverse=True):
+        cost = costs[key]
+        for job in jobs:
+            if job[0] + cost <= budget:
+                job[0] += cost
+                job[1].append(key)
+                break
+        else:
+            jobs.append([cost, [key]])
+    jobs.sort(key=lambda j: j[0], reverse=True)
+    return [keys for _, keys in jobs]
+
+
+class RecomputeDataManager(object):
+    """Collect the base objects, billing unit selections and properties
+    touched during a transaction. What is still pending at the commit is
+    pushed as a single queued recompute_dirty task."""
+
+    def __init__(self):
+        self.clear()
+
+    def __eq__(self, other):
+        if not isinstance(other, RecomputeDataManager):
+            return NotImplemented
+        return True
+
+    def __hash__(self):
+        return hash(RecomputeDataManager)
+
+    def clear(self):
+        self.occupancy_ids = set()
+        self.selection_ids = set()
+        self.property_ids = set()
+        self.context = None
+
+    def add(self, occupancy_ids=None, selection_ids=None, property_ids=None):
+        if self.context is None:
+            self.context = dict(Transaction().context)
+        self.occupancy_ids.update(occupancy_ids or [])
+        self.selection_ids.update(selection_ids or [])
+        self.property_ids.update(property_ids or [])
+
+    def pop(self):
+        values = (self.occupancy_ids, self.selection_ids, self.property_ids,
+            self.context or {})
+        self.clear()
+        return values
+
+    def abort(self, trans):
+        self.__init__()
+
+    def tpc_begin(self, trans):
+        BaseObject = Pool().get('real_estate.base_object')
+        if self.occupancy_ids or self.selection_ids or self.property_ids:
+            occupancy_ids, selection_ids, property_ids, context = self.pop()
+            with trans.set_context(context, queue_batch=False):
+                BaseObject.__queue__.recompute_dirty(
+                    sorted(occupancy_ids | selection_ids | property_ids),
+                    sorted(occupancy_ids), sorted(selection_ids),
+                    sorted(property_ids))
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        pass
+
+    def tpc_abort(self, trans):
+        self.__init__()
+
+
 def re_sequence_ordered(
         field_name='sequence',
         field_label=lazy_gettext('ir.msg_sequence'),
@@ -577,92 +666,234 @@ class BaseObject(Workflow, DeactivableMixin, re_sequence_ordered(), tree(separat
     def call_billing(cls, property_ids, billing_unit_ids=None,
             execute_in_queue=True, invoice_state='draft', invoice_date=None,
             payment_term=None):
-        """Call do_billing in queue or directly based on execute_in_queue flag."""
-        _chunk_size = 1
-        chunks = [property_ids[i:i + _chunk_size]
-            for i in range(0, len(property_ids), _chunk_size)]
-        for chunk in chunks:
+        """Call do_billing in queue or directly based on execute_in_queue flag.
+
+        The properties are grouped into jobs whose estimated cost stays below
+        _billing_job_cost; the most expensive jobs are run (or expected to be
+        run by the workers) first."""
+        BillingRun = Pool().get('real_estate.billing_run')
+        costs = cls._billing_costs(property_ids)
+        jobs = partition_by_cost(costs, _billing_job_cost)
+        transaction = Transaction()
+        context = transaction.context
+        if execute_in_queue:
+            runs = BillingRun.create([{
+                        'properties': [('add', job)],
+                        'property_count': len(job),
+                        } for job in jobs])
+        for index, job in enumerate(jobs):
+            logger.info('billing job %s/%s: %s properties, cost %s',
+                index + 1, len(jobs), len(job),
+                sum(costs[p] for p in job))
             if execute_in_queue:
-                transaction = Transaction()
-                context = transaction.context
+                # Jobs are already sized, do not let the queue split them
                 with transaction.set_context(
-                        queue_batch=context.get('queue_batch', True)):
+                        queue_batch=False,
+                        queue_expected_at=context.get(
+                            'queue_expected_at',
+                            datetime.timedelta(seconds=index))):
                     cls.__queue__.do_billing(
-                        chunk, billing_unit_ids, invoice_state, invoice_date,
-                        payment_term)
+                        job, billing_unit_ids, invoice_state, invoice_date,
+                        payment_term, billing_run=runs[index].id)
             else:
                 cls.do_billing(
-                    chunk, billing_unit_ids, invoice_state, invoice_date,
+                    job, billing_unit_ids, invoice_state, invoice_date,
                     payment_term)
 
+    @classmethod
+    def _billing_costs(cls, property_ids):
+        """Return the estimated billing cost per property id: one for the
+        property plus its approved settlement results and their contracts
+        in billing units ready for billing."""
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        SettlementResult = pool.get('real_estate.settlement_result')
+        cursor = Transaction().connection.cursor()
+        billing_unit = BillingUnit.__table__()
+        result = SettlementResult.__table__()
+
+        costs = dict.fromkeys(property_ids, 1)
+        for sub_ids in grouped_slice(property_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*billing_unit.join(result,
+                    condition=result.billing_unit == billing_unit.id
+                    ).select(
+                        billing_unit.property,
+                        Count(result.id),
+                        Count(result.contract, distinct=True),
+                        where=fields.SQL_OPERATORS['in'](
+                            billing_unit.property, sub_ids)
+                        & (billing_unit.state == 'ready_for_billing')
+                        & (result.state == 'approved'),
+                        group_by=[billing_unit.property]))
+            for property_id, n_results, n_contracts in cursor:
+                costs[property_id] += n_results + n_contracts
+        return costs
+
     @classmethod
     def do_billing(cls, property_ids, billing_unit_ids=None,
-            invoice_state='draft', invoice_date=None, payment_term=None):
+            invoice_state='draft', invoice_date=None, payment_term=None,
+            simulate=False, billing_run=None):
         """Execute billing per property.
 
         For each property all billing units with next_billing_start_date are
-        collected. With collective_billing the full set is always billed
-        together. Without collective_billing an optional billing_unit_ids
-        filter restricts which units are billed; if omitted all
-        ready_for_billing units are processed.
-        In all cases every unit that will be billed must be in state
-        ready_for_billing — otherwise a ValidationError is raised.
+        collected (see _get_units_to_bill) and billed together.
+        With simulate nothing is written; the billing previews of the
+        properties are returned instead (see BillingUnit.simulate_billing).
+
+        The billing of all properties is recorded in one billing run. A queued
+        job gets the id of the run created by call_billing and bills one step
+        per task (see _do_billing_step). Otherwise the run is created in the
+        current transaction and all properties are billed in it.
         """
         pool = Pool()
         BillingUnit = pool.get('real_estate.billing_unit')
+        BillingRun = pool.get('real_estate.billing_run')
         bu_filter = set(billing_unit_ids) if billing_unit_ids else None
+        previews = []
+
+        if not simulate and billing_run is not None:
+            cls._do_billing_step(property_ids, billing_unit_ids,
+                invoice_state, invoice_date, payment_term, billing_run)
+            return
+
+        run = None
+        if not simulate:
+            run = BillingRun(
+                state='running',
+                started_at=datetime.datetime.now(),
+                properties=property_ids,
+                property_count=len(property_ids))
+            run.save()
 
         for obj in cls.browse(property_ids):
-            if obj.type != 'property' or obj.state != 'approved':
-                continue
-            next_date = obj.next_billing_start_date
-            if not next_date:
-                continue
-            all_next_units = [bu for bu in obj.billing_units
-                if bu.start_date == next_date]
-            if not all_next_units:
-                continue
-
-            if obj.collective_billing:
-                if bu_filter is not None:
-                    # With collective billing all units must be in the filter
-                    missing = [bu for bu in all_next_units
-                        if bu.id not in bu_filter]
-                    if missing:
-                        details = '\n'.join(
-                            f'  {bu.name}' for bu in missing)
-                        raise ValidationError(gettext(
-                            'real_estate.msg_billing_collective_incomplete',
-                            name=obj.rec_name,
-                            next_date=str(next_date),
-                            details=details))
-                units_to_bill = all_next_units
-            elif bu_filter is not None:
-                # Bill only explicitly requested units for this property
-                units_to_bill = [bu for bu in all_next_units
-                    if bu.id in bu_filter]
-            else:
-                # Bill all ready units for this property
-                units_to_bill = [bu for bu in all_next_units
-                    if bu.state == 'ready_for_billing']
+            units_to_bill = obj._get_units_to_bill(bu_filter)
+            if units_to_bill and simulate:
+                preview = BillingUnit.simulate_billing(units_to_bill,
+                    invoice_date=invoice_date, payment_term=payment_term)
+                preview['property'] = obj.id
+                previews.append(preview)
+            elif units_to_bill:
+                BillingUnit.billing(units_to_bill,
+                    invoice_state=invoice_state,
+                    invoice_date=invoice_date,
+                    payment_term=payment_term, billing_run=run)
+            if run:
+                run.properties_done = (run.properties_done or 0) + 1
+
+        if simulate:
+            return previews
+        run.state = 'done'
+        run.finished_at = datetime.datetime.now()
+        run.save()
 
-            if not units_to_bill:
-                continue
+    @classmethod
+    def _do_billing_step(cls, property_ids, billing_unit_ids, invoice_state,
+            invoice_date, payment_term, billing_run):
+        """Bill the next step of the properties in the queued billing_run and
+        queue the billing of the remaining properties.
+
+        The task bills the properties up to the first one with units to bill
+        and executes one step of it (see BillingUnit.billing_step). The
+        progress of the run is saved and the next task queued in the same
+        transaction, so each step is committed by the queue on its own and
+        a failed task continues where it stopped when it is run again. The
+        failure is recorded on the run in a separate transaction."""
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        BillingRun = pool.get('real_estate.billing_run')
+        bu_filter = set(billing_unit_ids) if billing_unit_ids else None
 
-            not_ready = [bu for bu in units_to_bill
-                if bu.state != 'ready_for_billing']
-            if not_ready:
-                details = '\n'.join(
-                    f'  {bu.name} [{bu.state}]' for bu in not_ready)
-                raise ValidationError(gettext(
-                    'real_estate.msg_billing_unit_not_ready',
-                    name=obj.rec_name,
-                    next_date=str(next_date),
-                    details=details))
-
-            BillingUnit.billing(units_to_bill,
-                invoice_state=invoice_state, invoice_date=invoice_date,
-                payment_term=payment_term)
+        run = BillingRun(billing_run)
+        remaining = list(map(int, property_ids))
+        try:
+            while remaining:
+                obj = cls(remaining[0])
+                units_to_bill = obj._get_units_to_bill(bu_filter)
+                if units_to_bill and not BillingUnit.billing_step(
+                        units_to_bill, run, invoice_state=invoice_state,
+                        invoice_date=invoice_date,
+                        payment_term=payment_term):
+                    break
+                remaining.pop(0)
+                run.properties_done = (run.properties_done or 0) + 1
+                if units_to_bill:
+                    break
+
+            now = datetime.datetime.now()
+            run.started_at = run.started_at or now
+            run.error_message = None
+            if remaining:
+                run.state = 'running'
+                with Transaction().set_context(queue_batch=False):
+                    cls.__queue__.do_billing(
+                        remaining, billing_unit_ids, invoice_state,
+                        invoice_date, payment_term, billing_run=billing_run)
+            else:
+                run.state = 'done'
+                run.finished_at = now
+            run.save()
+        except Exception as exception:
+            BillingRun.write_detached(billing_run, {
+                    'state': 'failed',
+                    'finished_at': datetime.datetime.now(),
+                    'error_message': str(exception),
+                    })
+            raise
+
+    def _get_units_to_bill(self, bu_filter=None):
+        """Return the billing units of the property to bill next.
+
+        With collective_billing the full set is always billed together.
+        Without collective_billing an optional bu_filter (set of ids)
+        restricts which units are billed; if omitted all ready_for_billing
+        units are processed.
+        In all cases every unit that will be billed must be in state
+        ready_for_billing — otherwise a ValidationError is raised.
+        """
+        if self.type != 'property' or self.state != 'approved':
+            return []
+        next_date = self.next_billing_start_date
+        if not next_date:
+            return []
+        all_next_units = [bu for bu in self.billing_units
+            if bu.start_date == next_date]
+        if not all_next_units:
+            return []
+
+        if self.collective_billing:
+            if bu_filter is not None:
+                # With collective billing all units must be in the filter
+                missing = [bu for bu in all_next_units
+                    if bu.id not in bu_filter]
+                if missing:
+                    details = '\n'.join(
+                        f'  {bu.name}' for bu in missing)
+                    raise ValidationError(gettext(
+                        'real_estate.msg_billing_collective_incomplete',
+                        name=self.rec_name,
+                        next_date=str(next_date),
+                        details=details))
+            units_to_bill = all_next_units
+        elif bu_filter is not None:
+            # Bill only explicitly requested units for this property
+            units_to_bill = [bu for bu in all_next_units
+                if bu.id in bu_filter]
+        else:
+            # Bill all ready units for this property
+            units_to_bill = [bu for bu in all_next_units
+                if bu.state == 'ready_for_billing']
+
+        not_ready = [bu for bu in units_to_bill
+            if bu.state != 'ready_for_billing']
+        if not_ready:
+            details = '\n'.join(
+                f'  {bu.name} [{bu.state}]' for bu in not_ready)
+            raise ValidationError(gettext(
+                'real_estate.msg_billing_unit_not_ready',
+                name=self.rec_name,
+                next_date=str(next_date),
+                details=details))
+        return units_to_bill
 
     @classmethod
     @ModelView.button_action('real_estate.wizard_cancel_billing')
@@ -781,21 +1012,111 @@ class BaseObject(Workflow, DeactivableMixin, re_sequence_ordered(), tree(separat
 
 
 
+    _REFRESH_OCCUPANCY_FIELDS = frozenset({
+        'type', 'start_date', 'end_date', 'parent', 'property',
+    })
+
+    _COMPUTE_VALUE_SHARES_FIELDS = _REFRESH_OCCUPANCY_FIELDS | frozenset({
+        'state', 'active', 'measurements',
+    })
+
+    @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super().on_modification(mode, records, field_names=field_names)
+        Pool().get('real_estate.measurement')._clear_latest_cache()
+
     @classmethod
     def write(cls, *args):
         super().write(*args)
-        all_ids = set()
+        occ_ids = set()
+        value_share_ids = set()
         actions = iter(args)
-        for records, _ in zip(actions, actions):
-            for rec in records:
-                all_ids.add(rec.id)
-        rental_objects = [o for o in cls.browse(list(all_ids)) if o.type == 'object']
+        for records, values in zip(actions, actions):
+            if cls._REFRESH_OCCUPANCY_FIELDS & set(values):
+                occ_ids.update(r.id for r in records)
+            if cls._COMPUTE_VALUE_SHARES_FIELDS & set(values):
+                value_share_ids.update(r.id for r in records)
+        rental_objects = [o for o in cls.browse(list(occ_ids | value_share_ids))
+            if o.type == 'object']
         if rental_objects:
-            BaseObjectOccupancy = Pool().get('real_estate.base_object.occupancy')
-            BaseObjectOccupancy.refresh(rental_objects)
-            property_ids = {o.property.id for o in rental_objects if o.property}
+            cls._mark_dirty(
+                occupancy_ids={o.id for o in rental_objects
+                    if o.id in occ_ids},
+                property_ids={o.property.id for o in rental_objects
+                    if o.property and o.id in value_share_ids})
+
+    @classmethod
+    def _mark_dirty(cls, occupancy_ids=None, selection_ids=None,
+            property_ids=None):
+        """Register base objects whose occupancy must be refreshed, objects
+        whose billing units need a new selection and properties whose
+        value shares must be recomputed. The work is coalesced and queued
+        once at the commit unless _recompute_immediately is set in the
+        context."""
+        if not (occupancy_ids or selection_ids or property_ids):
+            return
+        transaction = Transaction()
+        if transaction.context.get('_recompute_immediately'):
+            cls.recompute_dirty(
+                cls.browse(sorted(set(occupancy_ids or [])
+                        | set(selection_ids or []) | set(property_ids or []))),
+                occupancy_ids, selection_ids, property_ids)
+            return
+        manager = transaction.join(RecomputeDataManager())
+        manager.add(occupancy_ids, selection_ids, property_ids)
+
+    @classmethod
+    def _flush_occupancy(cls, object_ids):
+        """Refresh now the pending occupancy of object_ids and return the
+        ids which were refreshed"""
+        BaseObjectOccupancy = Pool().get('real_estate.base_object.occupancy')
+        manager = Transaction().join(RecomputeDataManager())
+        pending = manager.occupancy_ids & set(object_ids)
+        if pending:
+            manager.occupancy_ids -= pending
+            BaseObjectOccupancy.refresh(cls.browse(sorted(pending)))
+        return pending
+
+    @classmethod
+    def flush_dirty(cls):
+        """Run the pending coalesced recomputation of the transaction now,
+        before reading data which depends on it"""
+        transaction = Transaction()
+        manager = transaction.join(RecomputeDataManager())
+        while manager.occupancy_ids or manager.selection_ids \
+                or manager.property_ids:
+            occupancy_ids, selection_ids, property_ids, context = (
+                manager.pop())
+            with transaction.set_context(
+                    context, _recompute_immediately=True):
+                with inactive_records():
+                    base_objects = cls.search([
+                            ('id', 'in', sorted(
+                                    occupancy_ids | selection_ids
+                                    | property_ids)),
+                            ])
+                cls.recompute_dirty(base_objects,
+                    occupancy_ids, selection_ids, property_ids)
+
+    @classmethod
+    def recompute_dirty(cls, base_objects, occupancy_ids=None,
+            selection_ids=None, property_ids=None):
+        """Refresh occupancy, billing unit selection and value shares for
+        the given ids (restricted to the still existing base_objects)."""
+        pool = Pool()
+        BaseObjectOccupancy = pool.get('real_estate.base_object.occupancy')
+        ContractItem = pool.get('real_estate.contract.item')
+        existing = {o.id for o in base_objects}
+        occupancy_ids = existing & set(occupancy_ids or [])
+        selection_ids = existing & set(selection_ids or [])
+        property_ids = existing & set(property_ids or [])
+        with Transaction().set_context(_recompute_immediately=True):
+            if occupancy_ids:
+                BaseObjectOccupancy.refresh(cls.browse(sorted(occupancy_ids)))
+            if selection_ids:
+                ContractItem._trigger_billing_unit_selection(selection_ids)
             if property_ids:
-                cls.compute_value_shares(cls.browse(list(property_ids)))
+                cls.compute_value_shares(cls.browse(sorted(property_ids)))
 
     def get_number_of_objects(self, name=None):
         return len(self.children)   
@@ -1008,12 +1329,86 @@ class BaseObjectOccupancy(ModelSQL, ModelView):
     def search_company(cls, name, clause):
         return [('base_object.company',) + tuple(clause[1:])]
 
+    _timeline_fields = (
+        'base_object', 'property', 'start_date', 'end_date', 'state',
+        'contract')
+
     @classmethod
-    def refresh(cls, base_objects):
-        for base_object in base_objects:
-            cls.delete(cls.search([('base_object', '=', base_object.id)]))
-            if base_object.type == 'object' and base_object.start_date:
-                cls._compute(base_object)
+    def refresh(cls, base_objects, diff=True):
+        """Rebuild the occupancy timeline of base_objects in bulk: one
+        contract item query for all objects. With diff, only rows whose
+        interval changed are written, created or deleted (unchanged rows
+        keep their id); otherwise all rows are deleted and re-created."""
+        base_objects = list({o.id: o for o in base_objects}.values())
+        if not base_objects:
+            return
+        existing = cls.search([
+            ('base_object', 'in', [o.id for o in base_objects]),
+        ])
+        if not diff:
+            cls.delete(existing)
+            existing = []
+        to_compute = [o for o in base_objects
+            if o.type == 'object' and o.start_date]
+        items_by_object = cls._get_items_by_object(to_compute)
+        records = []
+        for base_object in to_compute:
+            records.extend(cls._build_timeline(
+                base_object, items_by_object.get(base_object.id, [])))
+        cls._apply_timeline(existing, records)
+
+    @classmethod
+    def _timeline_key(cls, values):
+        return tuple(values[f] for f in cls._timeline_fields)
+
+    @classmethod
+    def _apply_timeline(cls, existing, records):
+        """Bring the rows existing in line with the values records: rows
+        matching a value dict are kept, remaining rows are re-used (in
+        start date order per object) for the remaining values, then
+        surplus rows are deleted and missing ones created."""
+        old_by_key = {}
+        for occupancy in existing:
+            key = cls._timeline_key({
+                'base_object': occupancy.base_object.id,
+                'property': (
+                    occupancy.property.id if occupancy.property else None),
+                'start_date': occupancy.start_date,
+                'end_date': occupancy.end_date,
+                'state': occupancy.state,
+                'contract': (
+                    occupancy.contract.id if occupancy.contract else None),
+                })
+            old_by_key.setdefault(key, []).append(occupancy)
+
+        old_by_object, new_by_object = {}, {}
+        for values in records:
+            matches = old_by_key.get(cls._timeline_key(values))
+            if matches:
+                matches.pop(0)
+            else:
+                new_by_object.setdefault(
+                    values['base_object'], []).append(values)
+        for occupancies in old_by_key.values():
+            for occupancy in occupancies:
+                old_by_object.setdefault(
+                    occupancy.base_object.id, []).append(occupancy)
+
+        to_write, to_delete, to_create = [], [], []
+        for object_id in old_by_object.keys() | new_by_object.keys():
+            olds = sorted(old_by_object.get(object_id, []),
+                key=lambda r: (r.start_date or datetime.date.min, r.id))
+            news = new_by_object.get(object_id, [])
+            for occupancy, values in zip(olds, news):
+                to_write.extend(([occupancy], values))
+            to_delete.extend(olds[len(news):])
+            to_create.extend(news[len(olds):])
+        if to_delete:
+            cls.delete(to_delete)
+        if to_write:
+            cls.write(*to_write)
+        if to_create:
+            cls.create(to_create)
 
     @classmethod
     def _get_property(cls, base_object):
@@ -1023,15 +1418,32 @@ class BaseObjectOccupancy(ModelSQL, ModelView):
         return obj if obj and obj.type == 'property' else None
 
     @classmethod
-    def _compute(cls, base_object):
+    def _get_items_by_object(cls, base_objects):
+        """Return {base_object_id: [contract items]} of occupancy relevant
+        contract items, ordered by valid_from, fetched in one query.
+        An item is listed once per object even if it refers to the object
+        several times."""
         ContractItem = Pool().get('real_estate.contract.item')
-        property_ = cls._get_property(base_object)
-
+        object_ids = {o.id for o in base_objects}
+        items_by_object = {i: [] for i in object_ids}
+        if not object_ids:
+            return items_by_object
         items = ContractItem.search([
-            ('objects.object', '=', base_object.id),
+            ('objects.object', 'in', list(object_ids)),
             ('contract.c_type.occupancy', '=', True),
             ('contract.state', 'in', ('running', 'terminated', 'draft')),
-        ], order=[('valid_from', 'ASC')])
+        ], order=[('valid_from', 'ASC'), ('id', 'ASC')])
+        for item in items:
+            item_object_ids = {o.object.id for o in item.objects}
+            for object_id in sorted(item_object_ids & object_ids):
+                items_by_object[object_id].append(item)
+        return items_by_object
+
+    @classmethod
+    def _build_timeline(cls, base_object, items):
+        """Return the occupancy values of base_object for items (ordered by
+        valid_from) - rented/under negotiation periods and vacant gaps."""
+        property_ = cls._get_property(base_object)
 
         ref_start = base_object.start_date
         ref_end = base_object.end_date
@@ -1105,8 +1517,7 @@ class BaseObjectOccupancy(ModelSQL, ModelView):
                     'contract': None,
                 })
 
-        if records:
-            cls.create(records)
+        return records
 
 
 #**************************************************************************
@@ -1265,6 +1676,156 @@ class MeterReadingContext(ModelView):
 
 
 #**************************************************************************
+class MeterReadingIndex(object):
+    """Readings of many meters, kept as date sorted lists per meter, that
+    answer closest, bracketing and exact lookups with binary search.
+
+    Readings are loaded with one query, optionally restricted to the
+    window [start, end]. Lookups that run past a loaded bound fall back to
+    a database search for that meter."""
+
+    def __init__(self, readings=None, start=None, end=None):
+        self.start = start
+        self.end = end
+        self._dates = {}
+        self._readings = {}
+        # The meter and date under which each reading id is indexed
+        self._keys = {}
+        for reading in readings or []:
+            self.add(reading)
+
+    @classmethod
+    def load(cls, meters, start=None, end=None):
+        MeterReading = Pool().get('real_estate.meter_reading')
+        domain = [('base_object', 'in', [m.id for m in meters])]
+        if start:
+            domain.append(('reading_date', '>=', start))
+        if end:
+            domain.append(('reading_date', '<=', end))
+        index = cls(start=start, end=end)
+        for meter in meters:
+            index._dates.setdefault(meter.id, [])
+            index._readings.setdefault(meter.id, [])
+        for reading in MeterReading.search(domain,
+                order=[('reading_date', 'ASC'), ('id', 'ASC')]):
+            index.add(reading)
+        return index
+
+    def add(self, reading):
+        "Insert or move reading (e.g. after it was created or changed)"
+        if reading.id in self._keys:
+            old_meter_id, old_date = self._keys[reading.id]
+            dates = self._dates[old_meter_id]
+            readings = self._readings[old_meter_id]
+            for i in range(bisect.bisect_left(dates, old_date),
+                    bisect.bisect_right(dates, old_date)):
+                if readings[i].id == reading.id:
+                    del dates[i]
+                    del readings[i]
+                    break
+        meter_id = reading.base_object.id
+        self._keys[reading.id] = (meter_id, reading.reading_date)
+        dates = self._dates.setdefault(meter_id, [])
+        readings = self._readings.setdefault(meter_id, [])
+        i = bisect.bisect_right(dates, reading.reading_date)
+        dates.insert(i, reading.reading_date)
+        readings.insert(i, reading)
+
+    @staticmethod
+    def _match(reading, meter_id=None, m_types=None):
+        return ((not meter_id or reading.meter_id == meter_id)
+            and (not m_types or reading.m_type in m_types))
+
+    def _search(self, meter, domain, order, limit=None):
+        MeterReading = Pool().get('real_estate.meter_reading')
+        return MeterReading.search(
+            [('base_object', '=', meter.id)] + domain, order=order,
+            limit=limit)
+
+    def _domain(self, meter_id=None, m_types=None):
+        domain = []
+        if meter_id:
+            domain.append(('meter_id', '=', meter_id))
+        if m_types:
+            domain.append(('m_type', 'in', list(m_types)))
+        return domain
+
+    def between(self, meter, start, end, meter_id=None, m_types=None):
+        "Readings of meter with start <= reading_date <= end, by date"
+        if ((self.start and start < self.start)
+                or (self.end and end > self.end)):
+            return self._search(meter, [
+                    ('reading_date', '>=', start),
+                    ('reading_date', '<=', end),
+                    ] + self._domain(meter_id, m_types),
+                [('reading_date', 'ASC'), ('id', 'ASC')])
+        dates = self._dates.get(meter.id, [])
+        readings = self._readings.get(meter.id, [])
+        lo = bisect.bisect_left(dates, start)
+        hi = bisect.bisect_right(dates, end)
+        return [r for r in readings[lo:hi]
+            if self._match(r, meter_id, m_types)]
+
+    def at(self, meter, date, meter_id=None, m_types=None):
+        "First reading of meter on date"
+        readings = self.between(meter, date, date, meter_id, m_types)
+        return readings[0] if readings else None
+
+    def before(self, meter, date, meter_id=None, m_types=None):
+        "Latest reading of meter strictly before date"
+        domain = self._domain(meter_id, m_types)
+        order = [('reading_date', 'DESC'), ('id', 'DESC')]
+        if ((self.start and date <= self.start)
+                or (self.end and date > self.end)):
+            # The readings up to date are not all loaded
+            readings = self._search(meter,
+                domain + [('reading_date', '<', date)], order, limit=1)
+            return readings[0] if readings else None
+        dates = self._dates.get(meter.id, [])
+        readings = self._readings.get(meter.id, [])
+        for i in range(bisect.bisect_left(dates, date) - 1, -1, -1):
+            if self._match(readings[i], meter_id, m_types):
+                return readings[i]
+        if self.start:
+            readings = self._search(meter,
+                domain + [('reading_date', '<', self.start)], order, limit=1)
+            return readings[0] if readings else None
+        return None
+
+    def after(self, meter, date, meter_id=None, m_types=None):
+        "Earliest reading of meter strictly after date"
+        domain = self._domain(meter_id, m_types)
+        order = [('reading_date', 'ASC'), ('id', 'ASC')]
+        if ((self.start and date < self.start)
+                or (self.end and date >= self.end)):
+            # The readings from date on are not all loaded
+            readings = self._search(meter,
+                domain + [('reading_date', '>', date)], order, limit=1)
+            return readings[0] if readings else None
+        dates = self._dates.get(meter.id, [])
+        readings = self._readings.get(meter.id, [])
+        for i in range(bisect.bisect_right(dates, date), len(readings)):
+            if self._match(readings[i], meter_id, m_types):
+                return readings[i]
+        if self.end:
+            readings = self._search(meter,
+                domain + [('reading_date', '>', self.end)], order, limit=1)
+            return readings[0] if readings else None
+        return None
+
+    def closest(self, meter, date, pre_days, post_days, meter_id=None,
+            m_types=None):
+        """Reading of meter closest to date within [date - pre_days,
+        date + post_days], the earlier one on a tie"""
+        readings = self.between(meter,
+            date - datetime.timedelta(days=pre_days),
+            date + datetime.timedelta(days=post_days),
+            meter_id, m_types)
+        if not readings:
+            return None
+        return min(readings, key=lambda r: abs((r.reading_date - date).days))
+
+
 class MeterReading(ModelSQL, ModelView):
     "Meter Reading"
     __name__ = 'real_estate.meter_reading'
@@ -1382,7 +1943,13 @@ class MeterReading(ModelSQL, ModelView):
             self.value = self.value.quantize(Decimal(1))
 
     @classmethod
-    def simulate_estimate(cls, base_object, per_date, meter_id=None):
+    def get_index(cls, meters, start=None, end=None):
+        "Return a MeterReadingIndex of meters for the window [start, end]"
+        return MeterReadingIndex.load(meters, start=start, end=end)
+
+    @classmethod
+    def simulate_estimate(cls, base_object, per_date, meter_id=None,
+            index=None):
         """Return (estimated_value, consumption, r1, r2).
 
         Interpolation (preferred): if readings exist both before and after
@@ -1390,23 +1957,16 @@ class MeterReading(ModelSQL, ModelView):
         Extrapolation (fallback): uses the last 2 readings within 1 year
         before per_date.
         """
-        base_domain = [
-            ('base_object', '=', base_object.id),
-            ('m_type', 'in', ['initial', 'reading', 'final']),
-        ]
-        if meter_id:
-            base_domain.append(('meter_id', '=', meter_id))
+        if index is None:
+            index = cls.get_index([base_object])
+        m_types = ('initial', 'reading', 'final')
 
-        before = cls.search(
-            base_domain + [('reading_date', '<', per_date)],
-            order=[('reading_date', 'DESC')], limit=1)
-        after = cls.search(
-            base_domain + [('reading_date', '>', per_date)],
-            order=[('reading_date', 'ASC')], limit=1)
+        before = index.before(base_object, per_date, meter_id, m_types)
+        after = index.after(base_object, per_date, meter_id, m_types)
 
         if before and after:
             # Interpolation between bracketing readings
-            r1, r2 = before[0], after[0]
+            r1, r2 = before, after
             days_between = (r2.reading_date - r1.reading_date).days
             days_to_r1 = (per_date - r1.reading_date).days
             rate = (float(r2.value) - float(r1.value)) / days_between
@@ -1415,12 +1975,9 @@ class MeterReading(ModelSQL, ModelView):
         else:
             # Extrapolation from last 2 readings within 1 year before per_date
             one_year_ago = per_date - datetime.timedelta(days=365)
-            readings = cls.search(
-                base_domain + [
-                    ('reading_date', '>=', one_year_ago),
-                    ('reading_date', '<', per_date),
-                ],
-                order=[('reading_date', 'ASC')])
+            readings = index.between(base_object,
+                one_year_ago, per_date - datetime.timedelta(days=1),
+                meter_id, m_types)
             if len(readings) < 2:
                 raise UserError(
                     f'Not enough readings for {base_object.rec_name}: '
@@ -1445,10 +2002,11 @@ class MeterReading(ModelSQL, ModelView):
         return estimated_value, consumption, r1, r2
 
     @classmethod
-    def create_estimate(cls, base_object, per_date, reason, meter_id=None):
+    def create_estimate(cls, base_object, per_date, reason, meter_id=None,
+            index=None):
         """Create and save an estimate reading. Returns the new MeterReading."""
         estimated_value, consumption, r1, r2 = cls.simulate_estimate(
-            base_object, per_date, meter_id)
+            base_object, per_date, meter_id, index=index)
         effective_meter_id = meter_id or r2.meter_id
         reading = cls()
         reading.company = base_object.company
@@ -1459,10 +2017,12 @@ class MeterReading(ModelSQL, ModelView):
         reading.value = estimated_value
         reading.comment = reason
         reading.save()
+        if index is not None:
+            index.add(reading)
         return reading
 
     @classmethod
-    def interpolate_at(cls, base_object, per_date, meter_id=None):
+    def interpolate_at(cls, base_object, per_date, meter_id=None, index=None):
         """Return (value, r1, r2): the meter value at per_date, linearly
         interpolated between the closest bracketing readings (any type,
         including estimates and previously interpolated values) strictly
@@ -1472,33 +2032,25 @@ class MeterReading(ModelSQL, ModelView):
         if either bracket is missing, a UserError is raised. If a reading
         exists exactly on per_date, it is returned directly (r1 is r2 is
         that reading)."""
-        base_domain = [
-            ('base_object', '=', base_object.id),
-        ]
-        if meter_id:
-            base_domain.append(('meter_id', '=', meter_id))
+        if index is None:
+            index = cls.get_index([base_object])
 
-        exact = cls.search(
-            base_domain + [('reading_date', '=', per_date)], limit=1)
+        exact = index.at(base_object, per_date, meter_id)
         if exact:
-            return exact[0].value, exact[0], exact[0]
+            return exact.value, exact, exact
 
-        before = cls.search(
-            base_domain + [('reading_date', '<', per_date)],
-            order=[('reading_date', 'DESC')], limit=1)
+        before = index.before(base_object, per_date, meter_id)
         if not before:
             raise UserError(gettext(
                 'real_estate.msg_no_reading_before_interpolation',
                 name=base_object.rec_name, date=str(per_date)))
-        after = cls.search(
-            base_domain + [('reading_date', '>', per_date)],
-            order=[('reading_date', 'ASC')], limit=1)
+        after = index.after(base_object, per_date, meter_id)
         if not after:
             raise UserError(gettext(
                 'real_estate.msg_no_reading_after_interpolation',
                 name=base_object.rec_name, date=str(per_date)))
 
-        r1, r2 = before[0], after[0]
+        r1, r2 = before, after
         days_between = (r2.reading_date - r1.reading_date).days
         days_to_target = (per_date - r1.reading_date).days
         rate = (float(r2.value) - float(r1.value)) / days_between
@@ -1512,25 +2064,24 @@ class MeterReading(ModelSQL, ModelView):
         return value, r1, r2
 
     @classmethod
-    def set_interpolation_reading(cls, base_object, per_date, meter_id=None):
+    def set_interpolation_reading(cls, base_object, per_date, meter_id=None,
+            index=None):
         """Get or create the persisted linear-interpolation reading for
         base_object at per_date. Idempotent: if one already exists for
         that meter/date, its value is refreshed instead of creating a
         duplicate. If per_date coincides with a real reading, that
         reading is returned as-is (no interpolation record created)."""
-        value, r1, r2 = cls.interpolate_at(base_object, per_date, meter_id)
+        if index is None:
+            index = cls.get_index([base_object])
+        value, r1, r2 = cls.interpolate_at(
+            base_object, per_date, meter_id, index=index)
         if r1.id == r2.id:
             return r1
 
         effective_meter_id = meter_id or r2.meter_id
-        existing = cls.search([
-            ('base_object', '=', base_object.id),
-            ('reading_date', '=', per_date),
-            ('m_type', '=', 'linear_interpolation'),
-            ('meter_id', '=', effective_meter_id),
-            ], limit=1)
-        if existing:
-            reading = existing[0]
+        reading = index.at(base_object, per_date, effective_meter_id,
+            ('linear_interpolation',))
+        if reading:
             if reading.value != value:
                 reading.value = value
                 reading.save()
@@ -1547,6 +2098,7 @@ class MeterReading(ModelSQL, ModelView):
             f'Interpolated between {r1.reading_date} ({r1.value}) and '
             f'{r2.reading_date} ({r2.value}).')
         reading.save()
+        index.add(reading)
         return reading
 
 
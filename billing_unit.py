@@ -1,4 +1,10 @@
 'Billing Unit'
+from sql import Null
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.operators import Or
+
+from trytond import backend
 from trytond.model import (sequence_ordered,
     DeactivableMixin, ModelSQL, ModelView, Workflow, fields)
 from trytond.model.exceptions import ValidationError
@@ -7,17 +13,24 @@ from trytond.i18n import gettext
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Bool, Eval, If
+from trytond.tools import grouped_slice, sqlite_apply_types
 from trytond.modules.currency.fields import Monetary
 
 from dateutil.relativedelta import relativedelta
 
 import datetime
+import json
+import time
+from collections import defaultdict
 from decimal import Decimal, ROUND_HALF_UP
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Number of contracts billed and committed together by a resumable billing
+_billing_step_size = 50
+
 
 class InvalidCalculationMethod(ValidationError):
     pass
@@ -157,6 +170,10 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
 
     sub_state = fields.Function(fields.Selection('get_sub_states', "Sub State"), 'on_change_with_sub_state')
 
+    readiness = fields.Function(fields.Text("Readiness",
+            help="The reasons why the billing unit cannot be billed yet."),
+        'get_readiness')
+
     term_types_of_use = fields.MultiSelection(
             'get_term_types_of_use', "Term Types",
             help="The term type which can use this billing unit.")
@@ -179,6 +196,13 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
     moves = fields.One2Many('real_estate.billing_unit.moves', 'billing_unit', 'Moves')
 
     billing_run_id = fields.Char('Billing Run ID', readonly=True)
+    billing_run = fields.Many2One('real_estate.billing_run', 'Billing Run',
+        readonly=True, ondelete='RESTRICT')
+
+    settlement_fingerprint = fields.Text('Settlement Fingerprint',
+        readonly=True,
+        help="Fingerprint of the inputs of the last settlement result "
+        "computation, used to rebuild only the contracts which changed.")
 
     sum_planned_costs = fields.Function(
         Monetary('Sum Planned Costs', currency='currency', digits='currency'),
@@ -344,11 +368,23 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
     @classmethod
     @ModelView.button
     def selection(cls, billing_units):
+        cls._selection(billing_units)
+
+    @classmethod
+    def _selection(cls, billing_units, settlement_units=None):
+        """Select cost shares of the settlement units of billing_units.
+        With settlement_units only those are re-selected; the billing unit
+        state is always derived from all its settlement units."""
         pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
         SettlementUnit = pool.get('real_estate.settlement_unit')
         SettlementResult = pool.get('real_estate.settlement_result')
         Warning = pool.get('res.user.warning')
 
+        # The selection reads the pending occupancy changes
+        BaseObject.flush_dirty()
+        cls._check_billing_interrupted(billing_units)
+        to_select, to_reset = [], []
         for billing_unit in billing_units:
             if billing_unit.state in ('draft', 'billed'):
                 raise ValidationError(gettext(
@@ -365,12 +401,20 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                         'real_estate.msg_selection_reset_warning',
                         name=billing_unit.name))
                 SettlementResult.delete(existing_results)
+                to_reset.append(billing_unit)
                 billing_unit.add_log('selection',
                     f'Deleted {len(existing_results)} settlement result(s)'
                     f' before re-selection.')
 
-            for su in billing_unit.settlement_units:
-                su.selection()
+            to_select.extend(cls._filter_settlement_units(
+                    billing_unit, settlement_units))
+        if to_reset:
+            # The next computation must rebuild every result
+            cls.write(to_reset, {'settlement_fingerprint': None})
+
+        SettlementUnit.select_cost_shares(to_select)
+
+        for billing_unit in cls.browse([bu.id for bu in billing_units]):
             sus = SettlementUnit.browse(
                 [su.id for su in billing_unit.settlement_units])
             # no_allocation SUs create no cost_shares (sub_state stays
@@ -389,11 +433,20 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
     @classmethod
     @ModelView.button
     def compute_value_shares_button(cls, billing_units):
+        cls._compute_value_shares(billing_units)
+
+    @classmethod
+    def _compute_value_shares(cls, billing_units, settlement_units=None):
+        """Compute value shares of the settlement units of billing_units,
+        restricted to settlement_units if given."""
         pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
         SettlementUnit = pool.get('real_estate.settlement_unit')
         SettlementResult = pool.get('real_estate.settlement_result')
         Warning = pool.get('res.user.warning')
 
+        # The value shares read the pending occupancy changes
+        BaseObject.flush_dirty()
         for billing_unit in billing_units:
             existing_results = SettlementResult.search([
                 ('billing_unit', '=', billing_unit.id)])
@@ -404,11 +457,14 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                         'real_estate.msg_value_share_reset_warning',
                         name=billing_unit.name))
                 SettlementResult.delete(existing_results)
+                # The next computation must rebuild every result
+                billing_unit.settlement_fingerprint = None
                 billing_unit.add_log('compute_value_shares',
                     f'Deleted {len(existing_results)} settlement result(s)'
                     f' before recomputing value shares.')
 
-            for su in billing_unit.settlement_units:
+            for su in cls._filter_settlement_units(
+                    billing_unit, settlement_units):
                 su.compute_value_shares()
             sus = SettlementUnit.browse(
                 [su.id for su in billing_unit.settlement_units])
@@ -432,99 +488,394 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                 billing_unit.state = 'value_share'
             billing_unit.save()
 
+    @staticmethod
+    def _filter_settlement_units(billing_unit, settlement_units=None):
+        if settlement_units is None:
+            return list(billing_unit.settlement_units)
+        su_ids = {su.id for su in settlement_units}
+        return [su for su in billing_unit.settlement_units if su.id in su_ids]
+
+    @classmethod
+    def _get_earlier_units(cls, billing_units):
+        """Return the unbilled billing units of the same property starting
+        on or before each billing unit.
+
+        Returns {billing_unit_id: [(other_id, other_start_date), ...]}
+        ordered like the billing units."""
+        cursor = Transaction().connection.cursor()
+        billing_unit = cls.__table__()
+        other = cls.__table__()
+
+        earlier = {}
+        for sub_ids in grouped_slice(
+                [bu.id for bu in billing_units], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*billing_unit.join(other,
+                    condition=(other.property == billing_unit.property)
+                    & (other.start_date <= billing_unit.start_date)
+                    & (other.id != billing_unit.id)
+                    ).select(
+                        billing_unit.id, other.id, other.start_date,
+                        where=fields.SQL_OPERATORS['in'](
+                            billing_unit.id, sub_ids)
+                        & (other.state != 'billed')
+                        & (other.active == True),  # noqa: E712
+                        order_by=[billing_unit.id,
+                            other.sequence, other.id]))
+            for bu_id, other_id, start_date in cursor:
+                earlier.setdefault(bu_id, []).append((other_id, start_date))
+        return earlier
+
     @classmethod
     def _check_chronological_order(cls, billing_units, check_collective=False):
         by_property = {}
         for bu in billing_units:
-            by_property.setdefault(bu.property.id, []).append(bu)
+            by_property.setdefault(bu.property, []).append(bu)
+        earlier = cls._get_earlier_units(
+            [min(units, key=lambda u: u.start_date)
+                for units in by_property.values()])
 
-        for prop_id, units in by_property.items():
-            prop = units[0].property
-            all_units = cls.search([('property', '=', prop_id)])
-            min_start = min(u.start_date for u in units)
+        for prop, units in by_property.items():
+            first = min(units, key=lambda u: u.start_date)
+            others = earlier.get(first.id, [])
 
-            blocking = [u for u in all_units
-                        if u.start_date < min_start and u.state != 'billed']
+            blocking = [i for i, d in others if d < first.start_date]
             if blocking:
                 raise ValidationError(gettext(
                     'real_estate.msg_billing_unit_chronological_order',
-                    names=', '.join(u.name for u in blocking)))
+                    names=', '.join(u.name for u in cls.browse(blocking))))
 
             if check_collective and prop.collective_billing:
-                same_start = [u for u in all_units
-                              if u.start_date == min_start and u.state != 'billed']
-                missing = [u for u in same_start
-                           if u.id not in {b.id for b in units}]
+                unit_ids = {u.id for u in units}
+                missing = [i for i, d in others
+                    if d == first.start_date and i not in unit_ids]
                 if missing:
                     raise ValidationError(gettext(
                         'real_estate.msg_billing_unit_collective_required',
-                        names=', '.join(u.name for u in missing)))
+                        names=', '.join(u.name for u in cls.browse(missing))))
+
+    @classmethod
+    def _get_unposted_invoices(cls, billing_units):
+        """Return the invoices in the settlement period which are not posted.
+
+        cash flow lines: advance payment invoices in draft or validated of
+                         the contracts, terms and period of the billing unit
+                         (see _cash_flow_base_domain).
+        invoice lines:   operating cost invoices of the settlement units.
+        Returns {billing_unit_id: [detail line, ...]} with one line per
+        invoice."""
+        pool = Pool()
+        CostShare = pool.get('real_estate.cost_share')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+        CashFlowLine = pool.get('real_estate.contract.term.cash_flow')
+        ContractTerm = pool.get('real_estate.contract.term')
+        Contract = pool.get('real_estate.contract')
+        InvoiceLine = pool.get('account.invoice.line')
+        Invoice = pool.get('account.invoice')
+        cursor = Transaction().connection.cursor()
+        cost_share = CostShare.__table__()
+        settlement_unit = SettlementUnit.__table__()
+        cash_flow = CashFlowLine.__table__()
+        term = ContractTerm.__table__()
+        contract = Contract.__table__()
+        invoice_line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+
+        def invoice_number(number, reference, invoice_id):
+            return number or reference or f'ID {invoice_id}'
+
+        def format_date(date):
+            return f'{date:%Y-%m-%d}' if date else '?'
+
+        details = {}
+        seen_invoices = set()
+        # Each billing unit of a slice adds its own period condition
+        for sub_units in grouped_slice(
+                billing_units, backend.MAX_QUERY_PARAMS // 4):
+            sub_units = list(sub_units)
+            sub_ids = [bu.id for bu in sub_units]
+
+            contracts = cost_share.join(settlement_unit,
+                condition=cost_share.settlement_unit == settlement_unit.id
+                ).select(
+                    settlement_unit.billing_unit.as_('billing_unit'),
+                    cost_share.contract.as_('contract'),
+                    where=fields.SQL_OPERATORS['in'](
+                        settlement_unit.billing_unit, sub_ids)
+                    & (settlement_unit.active == True)  # noqa: E712
+                    & (cost_share.active == True)  # noqa: E712
+                    & (cost_share.contract != Null),
+                    group_by=[settlement_unit.billing_unit,
+                        cost_share.contract])
+            periods = []
+            for bu in sub_units:
+                period = ((contracts.billing_unit == bu.id)
+                    & (cash_flow.document_date >= bu.start_date)
+                    & (cash_flow.document_date <= bu.end_date))
+                if bu.term_types_of_use:
+                    period &= fields.SQL_OPERATORS['in'](term.term_type,
+                        [int(t) for t in bu.term_types_of_use])
+                periods.append(period)
+            cursor.execute(*contracts.join(term,
+                    condition=term.contract == contracts.contract
+                    ).join(contract, condition=term.contract == contract.id
+                    ).join(cash_flow, condition=cash_flow.term == term.id
+                    ).join(invoice_line,
+                    condition=cash_flow.invoice_line == invoice_line.id
+                    ).join(invoice,
+                    condition=invoice_line.invoice == invoice.id
+                    ).select(
+                        contracts.billing_unit, invoice.id,
+                        contract.contract_number, cash_flow.document_date,
+                        invoice.number, invoice.reference, invoice.state,
+                        where=invoice.state.in_(['draft', 'validated'])
+                        & Or(periods),
+                        order_by=[contracts.billing_unit,
+                            cash_flow.document_date, cash_flow.posting_date,
+                            cash_flow.id]))
+            for (bu_id, invoice_id, contract_number, document_date,
+                    number, reference, state) in cursor:
+                if (bu_id, invoice_id) in seen_invoices:
+                    continue
+                seen_invoices.add((bu_id, invoice_id))
+                details.setdefault(bu_id, []).append(
+                    f'  {contract_number or "?"} / {format_date(document_date)}'
+                    f' / {invoice_number(number, reference, invoice_id)}'
+                    f' [{state}]')
+
+            cursor.execute(*invoice_line.join(invoice,
+                    condition=invoice_line.invoice == invoice.id
+                    ).join(settlement_unit,
+                    condition=invoice_line.settlement_unit == settlement_unit.id
+                    ).select(
+                        settlement_unit.billing_unit, invoice.id,
+                        settlement_unit.id, invoice.invoice_date,
+                        invoice.number, invoice.reference, invoice.state,
+                        where=fields.SQL_OPERATORS['in'](
+                            settlement_unit.billing_unit, sub_ids)
+                        & (settlement_unit.active == True)  # noqa: E712
+                        & ~invoice.state.in_(['posted', 'paid', 'cancelled']),
+                        order_by=[settlement_unit.billing_unit,
+                            settlement_unit.sequence, settlement_unit.id,
+                            invoice_line.id]))
+            rows = []
+            for row in cursor:
+                if (row[0], row[1]) in seen_invoices:
+                    continue
+                seen_invoices.add((row[0], row[1]))
+                rows.append(row)
+            names = {su.id: su.name for su in SettlementUnit.browse(
+                    {row[2] for row in rows})}
+            for (bu_id, invoice_id, su_id, invoice_date,
+                    number, reference, state) in rows:
+                details.setdefault(bu_id, []).append(
+                    f'  {names[su_id] or "?"} / {format_date(invoice_date)}'
+                    f' / {invoice_number(number, reference, invoice_id)}'
+                    f' [{state}]')
+        return details
 
     @classmethod
     def _check_invoices_posted(cls, billing_units):
         """Verify all invoices in the settlement period are posted.
 
-        cash_flow_lines: advance payment invoices from contracts.
-        invoice_lines:   operating cost invoices from settlement units.
         Raises ValidationError listing each unposted invoice.
         """
-        CashFlowLine = Pool().get('real_estate.contract.term.cash_flow')
+        details = cls._get_unposted_invoices(billing_units)
+        for bu in billing_units:
+            if bu.id in details:
+                raise ValidationError(gettext(
+                    'real_estate.msg_billing_unit_invoices_not_posted',
+                    name=bu.name,
+                    details='\n'.join(details[bu.id])))
+
+    @classmethod
+    def _get_settlement_problems(cls, billing_units):
+        """Return the reasons why the billing units are not ready for billing,
+        apart from unposted invoices.
+
+        Each check is one aggregated query over all billing units which
+        returns only the offending rows.
+        Returns {billing_unit_id: [(message_id, variables), ...]} in the
+        order the checks are applied by check_ready_for_billing."""
+        pool = Pool()
+        CostShare = pool.get('real_estate.cost_share')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+        SettlementResult = pool.get('real_estate.settlement_result')
+        cursor = Transaction().connection.cursor()
+        cost_share = CostShare.__table__()
+        settlement_unit = SettlementUnit.__table__()
+        result = SettlementResult.__table__()
+
+        problems = {}
+        bu_ids = [bu.id for bu in billing_units]
+
+        def add(bu_id, message, **variables):
+            problems.setdefault(bu_id, []).append(
+                ('real_estate.' + message, variables))
+
+        def state_count(state):
+            return Sum(Case((cost_share.state == state, 1), else_=0))
+
+        # Settlement units (no_allocation exempt) whose sub_state is not
+        # value_share; the sub_state follows SettlementUnit.get_sub_state
+        not_ready = {}
+        for sub_ids in grouped_slice(bu_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*settlement_unit.join(cost_share, 'LEFT',
+                    condition=(cost_share.settlement_unit == settlement_unit.id)
+                    & (cost_share.active == True)  # noqa: E712
+                    ).select(
+                        settlement_unit.billing_unit, settlement_unit.id,
+                        settlement_unit.vacancy, Count(cost_share.id),
+                        Min(cost_share.state), Max(cost_share.state),
+                        state_count('error'), state_count('selection'),
+                        state_count('estimated_value_share'),
+                        where=fields.SQL_OPERATORS['in'](
+                            settlement_unit.billing_unit, sub_ids)
+                        & (settlement_unit.active == True)  # noqa: E712
+                        & (Coalesce(settlement_unit.allocation_rule, '')
+                            != 'no_allocation'),
+                        group_by=[settlement_unit.billing_unit,
+                            settlement_unit.id, settlement_unit.vacancy],
+                        having=(state_count('value_share') == 0)
+                        | (state_count('error') > 0)
+                        | (state_count('selection') > 0)
+                        | (state_count('estimated_value_share') > 0),
+                        order_by=[settlement_unit.billing_unit,
+                            settlement_unit.sequence, settlement_unit.id]))
+            for (bu_id, su_id, vacancy, count, first_state, last_state,
+                    errors, selections, estimates) in cursor:
+                if not count:
+                    sub_state = ('no_allocation'
+                        if vacancy == 'no_allocation' else 'preparation')
+                elif first_state == last_state:
+                    sub_state = first_state
+                elif errors:
+                    sub_state = 'error'
+                elif selections:
+                    sub_state = 'selection'
+                elif estimates:
+                    sub_state = 'estimated_value_share'
+                else:
+                    sub_state = 'preparation'
+                not_ready.setdefault(bu_id, []).append((su_id, sub_state))
+        names = {su.id: su.name for su in SettlementUnit.browse(
+                [su_id for units in not_ready.values() for su_id, _ in units])}
+
+        # Approved settlement results: their count and sum per billing unit
+        # and the results with zero actual costs or a missing term
+        totals = {}
+        offending = []
+        for sub_ids in grouped_slice(bu_ids, backend.MAX_QUERY_PARAMS):
+            where = (fields.SQL_OPERATORS['in'](
+                    result.billing_unit, sub_ids)
+                & (result.state == 'approved'))
+            query = result.select(
+                result.billing_unit.as_('billing_unit'),
+                Count(result.id).as_('count'),
+                Sum(Coalesce(result.actual_costs, Decimal(0))
+                    ).as_('actual_costs'),
+                where=where,
+                group_by=[result.billing_unit])
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, None, 'NUMERIC'])
+            cursor.execute(*query)
+            for bu_id, count, actual_costs in cursor:
+                totals[bu_id] = (count, actual_costs or Decimal(0))
+            cursor.execute(*result.select(result.id,
+                    where=where
+                    & ((Coalesce(result.actual_costs, 0) == 0)
+                        | ((Coalesce(result.advanced_payment, 0) != 0)
+                            & ((result.term == Null)
+                                | (result.contract == Null))))))
+            offending.extend(r for r, in cursor)
+        zero_results, missing_term = {}, {}
+        for r in SettlementResult.browse(sorted(offending)):
+            if not r.actual_costs:
+                zero_results.setdefault(r.billing_unit.id, []).append(r)
+            if r.advanced_payment and (not r.term or not r.contract):
+                missing_term.setdefault(r.billing_unit.id, []).append(r)
+
+        cost_share_groups = cls._get_cost_share_groups(
+            [bu for bu in billing_units if not bu.external_billing])
 
         for bu in billing_units:
-            seen_invoices = set()
-            lines_info = []
-
-            # Advance payment lines: use _cash_flow_base_domain() (shared logic)
-            # and search only for unposted states — cash_flow_lines already
-            # filters for posted/paid so we must query the complement separately.
-            base_domain = bu._cash_flow_base_domain()
-            if base_domain is not None:
-                unposted_cf = CashFlowLine.search(
-                    base_domain + [('invoice_state', 'in', ['draft', 'validated'])])
-                for line in unposted_cf:
-                    inv = line.invoice
-                    inv_key = inv.id if inv else id(line)
-                    if inv_key in seen_invoices:
-                        continue
-                    seen_invoices.add(inv_key)
-                    contract_num = (line.term.contract.contract_number
-                        if line.term and line.term.contract else '?')
-                    if inv:
-                        inv_num = inv.number or inv.reference or f'ID {inv.id}'
-                        inv_state = inv.state
-                    else:
-                        inv_num = '—'
-                        inv_state = line.invoice_state or 'draft'
-                    date_str = (f'{line.document_date:%Y-%m-%d}'
-                        if line.document_date else '?')
-                    lines_info.append(
-                        f'  {contract_num} / {date_str}'
-                        f' / {inv_num} [{inv_state}]')
-
-            # Operating cost invoice lines: use bu.invoice_lines directly
-            for line in (bu.invoice_lines or []):
-                inv = line.invoice if line.invoice else None
-                if not inv or inv.state in ('posted', 'paid', 'cancelled'):
-                    continue
-                if inv.id in seen_invoices:
-                    continue
-                seen_invoices.add(inv.id)
-                su_name = (line.settlement_unit.name
-                    if line.settlement_unit else '?')
-                inv_num = inv.number or inv.reference or f'ID {inv.id}'
-                date_str = (f'{inv.invoice_date:%Y-%m-%d}'
-                    if inv.invoice_date else '?')
-                lines_info.append(
-                    f'  {su_name} / {date_str}'
-                    f' / {inv_num} [{inv.state}]')
-
-            if not lines_info:
+            units = not_ready.get(bu.id, [])
+            errors = [su_id for su_id, s in units if s == 'error']
+            if errors:
+                add(bu.id, 'msg_billing_unit_settlement_unit_errors',
+                    name=bu.name, details='\n'.join(
+                        f'  {names[su_id] or str(su_id)}' for su_id in errors))
+            elif units:
+                add(bu.id, 'msg_billing_unit_settlement_units_not_ready',
+                    name=bu.name, details='\n'.join(
+                        f'  {names[su_id] or str(su_id)} [{s or "?"}]'
+                        for su_id, s in units))
+
+            if bu.id not in totals:
+                add(bu.id, 'msg_billing_unit_no_settlement_results',
+                    name=bu.name)
                 continue
+            if bu.id in zero_results:
+                add(bu.id, 'msg_billing_unit_zero_actual_costs',
+                    name=bu.name, details='\n'.join(
+                        '  ' + (r.contract.rec_name if r.contract
+                            else (r.base_object.rec_name
+                                if r.base_object else '?'))
+                        for r in zero_results[bu.id]))
+            # Settlement results with advance payment must have term and
+            # contract. If term is None it means multiple terms contributed
+            # — the billing unit configuration (term_types_of_use) must be
+            # narrowed so that exactly one advance payment term per contract
+            # is included.
+            if bu.id in missing_term:
+                add(bu.id,
+                    'msg_billing_unit_settlement_result_missing_term',
+                    name=bu.name, details='\n'.join(
+                        f'  {r.contract.rec_name if r.contract else "?"}'
+                        f' / {r.base_object.rec_name if r.base_object else "?"}'
+                        f' [term: {"MISSING" if not r.term else r.term.name},'
+                        f' adv: {r.advanced_payment}]'
+                        for r in missing_term[bu.id]))
+            if not bu.external_billing:
+                sr_sum = totals[bu.id][1]
+                cs_sum = sum(
+                    (g['actual_costs']
+                        for g in cost_share_groups.get(bu.id, {}).values()),
+                    Decimal(0))
+                if sr_sum != cs_sum:
+                    add(bu.id, 'msg_billing_unit_sum_mismatch',
+                        name=bu.name, sr_sum=str(sr_sum), bu_sum=str(cs_sum))
+        return problems
 
-            raise ValidationError(gettext(
-                'real_estate.msg_billing_unit_invoices_not_posted',
-                name=bu.name,
-                details='\n'.join(lines_info)))
+    @classmethod
+    def get_readiness(cls, billing_units, name):
+        """Return the reasons why each billing unit cannot be billed yet:
+        earlier billing units of the property which are not billed, unposted
+        invoices and the checks of check_ready_for_billing."""
+        readiness = {bu.id: '' for bu in billing_units}
+        billing_units = [bu for bu in billing_units if bu.state != 'billed']
+        earlier = cls._get_earlier_units(billing_units)
+        blocking_ids = {
+            i for others in earlier.values() for i, _ in others}
+        blocking_names = {u.id: u.name for u in cls.browse(blocking_ids)}
+        unposted = cls._get_unposted_invoices(billing_units)
+        problems = cls._get_settlement_problems(billing_units)
+
+        for bu in billing_units:
+            messages = []
+            blocking = [i for i, d in earlier.get(bu.id, [])
+                if d < bu.start_date]
+            if blocking:
+                messages.append(gettext(
+                    'real_estate.msg_billing_unit_chronological_order',
+                    names=', '.join(blocking_names[i] for i in blocking)))
+            if bu.id in unposted:
+                messages.append(gettext(
+                    'real_estate.msg_billing_unit_invoices_not_posted',
+                    name=bu.name, details='\n'.join(unposted[bu.id])))
+            messages.extend(gettext(message, **variables)
+                for message, variables in problems.get(bu.id, []))
+            readiness[bu.id] = '\n'.join(messages)
+        return readiness
 
     @classmethod
     @ModelView.button
@@ -532,91 +883,20 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
     def check_ready_for_billing(cls, billing_units):
         """Validate billing unit is fully ready for billing and set state accordingly.
 
-        Checks: all invoices posted, settlement results exist, no zero actual
-        costs, and settlement result sum matches cost share sum.
+        Checks: all invoices posted, settlement units in value share,
+        settlement results exist, no zero actual costs, advance payments with
+        a term, and settlement result sum matches cost share sum.
         """
-        pool = Pool()
-        SettlementResult = pool.get('real_estate.settlement_result')
-
+        BaseObject = Pool().get('real_estate.base_object')
+        # Pending value share changes would reset the settlement results
+        BaseObject.flush_dirty()
         cls._check_invoices_posted(billing_units)
 
+        problems = cls._get_settlement_problems(billing_units)
         for bu in billing_units:
-            # Check all settlement units have sub_state 'value_share' (no_allocation exempt)
-            error_sus = [su for su in (bu.settlement_units or [])
-                if su.sub_state == 'error']
-            if error_sus:
-                details = '\n'.join(
-                    f'  {su.name or str(su.id)}' for su in error_sus)
-                raise ValidationError(gettext(
-                    'real_estate.msg_billing_unit_settlement_unit_errors',
-                    name=bu.name, details=details))
-
-            not_value_share = [su for su in (bu.settlement_units or [])
-                if su.sub_state not in ('value_share',)
-                and (su.allocation_rule or '') != 'no_allocation']
-            if not_value_share:
-                details = '\n'.join(
-                    f'  {su.name or str(su.id)} [{su.sub_state or "?"}]'
-                    for su in not_value_share)
-                raise ValidationError(gettext(
-                    'real_estate.msg_billing_unit_settlement_units_not_ready',
-                    name=bu.name, details=details))
-
-            results = SettlementResult.search([
-                ('billing_unit', '=', bu.id),
-                ('state', '=', 'approved'),
-            ])
-
-            if not results:
-                raise ValidationError(gettext(
-                    'real_estate.msg_billing_unit_no_settlement_results',
-                    name=bu.name))
-
-            zero_results = [
-                r for r in results
-                if not r.actual_costs or r.actual_costs == Decimal(0)
-            ]
-            if zero_results:
-                details = '\n'.join(
-                    '  ' + (r.contract.rec_name if r.contract
-                        else (r.base_object.rec_name if r.base_object else '?'))
-                    for r in zero_results)
-                raise ValidationError(gettext(
-                    'real_estate.msg_billing_unit_zero_actual_costs',
-                    name=bu.name,
-                    details=details))
-
-            # Settlement results with advance payment > 0 must have term and contract.
-            # If term is None it means multiple terms contributed — the billing unit
-            # configuration (term_types_of_use) must be narrowed so that exactly one
-            # advance payment term per contract is included.
-            missing_term = [
-                r for r in results
-                if (r.advanced_payment or Decimal(0)) != Decimal(0)
-                and (not r.term or not r.contract)
-            ]
-            if missing_term:
-                details = '\n'.join(
-                    f'  {r.contract.rec_name if r.contract else "?"}'
-                    f' / {r.base_object.rec_name if r.base_object else "?"}'
-                    f' [term: {"MISSING" if not r.term else r.term.name},'
-                    f' adv: {r.advanced_payment}]'
-                    for r in missing_term)
-                raise ValidationError(gettext(
-                    'real_estate.msg_billing_unit_settlement_result_missing_term',
-                    name=bu.name, details=details))
-
-            if not bu.external_billing:
-                sr_sum = sum(r.actual_costs or Decimal(0) for r in results)
-                cs_sum = sum(
-                    cs.actual_costs or Decimal(0)
-                    for cs in bu._get_cost_shares())
-                if sr_sum != cs_sum:
-                    raise ValidationError(gettext(
-                        'real_estate.msg_billing_unit_sum_mismatch',
-                        name=bu.name,
-                        sr_sum=str(sr_sum),
-                        bu_sum=str(cs_sum)))
+            if bu.id in problems:
+                message, variables = problems[bu.id][0]
+                raise ValidationError(gettext(message, **variables))
 
     @classmethod
     @ModelView.button_action('real_estate.wizard_billing_unit')
@@ -626,17 +906,108 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
     @classmethod
     @Workflow.transition('billed')
     def billing(cls, billing_units, invoice_state='draft', invoice_date=None,
+            payment_term=None, billing_run=None):
+        """Bill the billing units.
+
+        The billing is executed in steps of _billing_step_size contracts
+        which mark their settlement results as billed, all in the current
+        transaction (see billing_step for one step at a time).
+
+        The stage durations and row counts are added to billing_run; its
+        state is left to the caller. Without billing_run a run of its own is
+        created and completed."""
+        pool = Pool()
+        BillingRun = pool.get('real_estate.billing_run')
+        own_run = billing_run is None
+        if own_run:
+            billing_run = BillingRun(
+                state='running', started_at=datetime.datetime.now())
+            billing_run.save()
+        cls._bill(billing_units, billing_run, invoice_state=invoice_state,
+            invoice_date=invoice_date, payment_term=payment_term)
+        if own_run:
+            billing_run.state = 'done'
+            billing_run.finished_at = datetime.datetime.now()
+            billing_run.save()
+
+    @classmethod
+    def billing_step(cls, billing_units, billing_run, invoice_state='draft',
+            invoice_date=None, payment_term=None):
+        """Bill the next step of the billing units and return whether their
+        billing is complete.
+
+        Only the next _billing_step_size contracts with approved settlement
+        results are planned, so the next call continues with the contracts
+        not billed yet. The billing units are
+        billed with the last step; until then they stay ready for billing.
+        Used by queued billing to run each step in a task of its own (see
+        BaseObject.do_billing)."""
+        completed = cls._bill(billing_units, billing_run,
+            invoice_state=invoice_state, invoice_date=invoice_date,
+            payment_term=payment_term, max_steps=1)
+        if completed:
+            cls.billed(billing_units)
+        return completed
+
+    @classmethod
+    @Workflow.transition('billed')
+    def billed(cls, billing_units):
+        pass
+
+    @classmethod
+    def _bill(cls, billing_units, billing_run, invoice_state='draft',
+            invoice_date=None, payment_term=None, max_steps=None):
+        """Plan the billing of at most max_steps steps and execute them.
+        Returns whether the last step was executed."""
+        max_contracts = (max_steps * _billing_step_size
+            if max_steps is not None else None)
+        plan = cls._plan_billing(billing_units, invoice_date=invoice_date,
+            payment_term=payment_term, billing_run=billing_run,
+            max_contracts=max_contracts)
+        cls.write(plan['billing_units'], {
+                'billing_run_id': plan['billing_run_id'],
+                'billing_run': billing_run.id,
+                })
+        billing_run.add_metrics(plan['durations'], {})
+        for step in cls._get_billing_steps(plan):
+            cls._execute_billing_plan(step, invoice_state=invoice_state)
+            billing_run.add_metrics(step['durations'], step['counts'])
+        return step['completed']
+
+    @classmethod
+    def simulate_billing(cls, billing_units, invoice_date=None,
             payment_term=None):
+        """Run the billing of the billing units as a dry run.
+
+        Performs the same checks and builds the same invoices and owner-borne
+        moves as billing(), but only in memory; nothing is written. Returns
+        a preview dictionary with the invoices (lines and tax amounts), the
+        moves and the settlement results which would be billed."""
+        plan = cls._plan_billing(billing_units, invoice_date=invoice_date,
+            payment_term=payment_term)
+        return cls._preview_billing_plan(plan)
+
+    @classmethod
+    def _plan_billing(cls, billing_units, invoice_date=None,
+            payment_term=None, billing_run=None, max_contracts=None):
+        """Check the billing units and build all invoices and owner-borne
+        moves of the billing run in memory.
+
+        With max_contracts only the first contracts with approved settlement
+        results are planned; the owner-borne results are left to the plan
+        which reaches the last contract.
+
+        Returns the plan consumed by _execute_billing_plan and
+        _preview_billing_plan."""
         pool = Pool()
         Invoice = pool.get('account.invoice')
         InvoiceLine = pool.get('account.invoice.line')
-        AccountMove = pool.get('account.move')
-        AccountMoveLine = pool.get('account.move.line')
         SettlementResult = pool.get('real_estate.settlement_result')
-        BillingUnitMoves = pool.get('real_estate.billing_unit.moves')
+        BillingRun = pool.get('real_estate.billing_run')
         AccountConfiguration = pool.get('account.configuration')
-        CashFlowLine = pool.get('real_estate.contract.term.cash_flow')
         Date = pool.get('ir.date')
+        durations = {}
+        started = time.perf_counter()
 
         cls._check_chronological_order(billing_units, check_collective=True)
 
@@ -661,9 +1032,8 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                         f'  {bu.name} [{bu.state}]' for bu in not_ready)))
             scope_units = all_same_start
 
-        billing_run_id = (
-            f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
-            f"-U{Transaction().user}")
+        billing_run_id = (billing_run.name if billing_run
+            else BillingRun.default_name())
 
         # Refuse billing if any settlement unit has error sub_state
         error_units = [bu for bu in scope_units if bu.sub_state == 'error']
@@ -674,29 +1044,45 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
 
         # Verify all advance payment invoices in the settlement period are posted
         cls._check_invoices_posted(scope_units)
-
-        cls.write(scope_units, {'billing_run_id': billing_run_id})
+        durations['checks'] = time.perf_counter() - started
+        started = time.perf_counter()
 
         billing_date = invoice_date or Date.today()
         config = AccountConfiguration(1)
+        logs = []
 
-        # Pre-compute (term, account) per (billing_unit_id, contract_id, object_id)
-        # from cash flow lines — fallback when SettlementResult.term is None.
+        # (term, account) per (billing_unit_id, contract_id, object_id) from
+        # cash flow lines — fallback when SettlementResult.term is None.
+        # Filled per billing unit on first use.
         term_account_by_bu_co = {}
-        for bu in scope_units:
-            for line in bu.cash_flow_lines:
-                if line.contract and line.term and line.term.account:
-                    key = (bu.id, line.contract.id,
-                        line.base_object.id if line.base_object else None)
-                    if key not in term_account_by_bu_co:
-                        term_account_by_bu_co[key] = (
-                            line.term, line.term.account)
-
-        # Collect all approved settlement results for scope_units
-        all_results = SettlementResult.search([
+        term_account_bu_ids = set()
+
+        def get_term_account(bu, contract, base_object):
+            if bu.id not in term_account_bu_ids:
+                term_account_bu_ids.add(bu.id)
+                for line in bu.cash_flow_lines:
+                    if line.contract and line.term and line.term.account:
+                        key = (bu.id, line.contract.id,
+                            line.base_object.id if line.base_object else None)
+                        if key not in term_account_by_bu_co:
+                            term_account_by_bu_co[key] = (
+                                line.term, line.term.account)
+            return term_account_by_bu_co.get((bu.id, contract.id,
+                    base_object.id if base_object else None))
+
+        # Collect the approved settlement results for scope_units
+        domain = [
             ('billing_unit', 'in', [bu.id for bu in scope_units]),
             ('state', '=', 'approved'),
-        ])
+            ]
+        completed = True
+        if max_contracts is not None:
+            contract_ids = cls._get_billing_contracts(
+                scope_units, max_contracts + 1)
+            if len(contract_ids) > max_contracts:
+                completed = False
+                domain.append(('contract', 'in', contract_ids[:max_contracts]))
+        all_results = SettlementResult.search(domain)
 
         # Group by contract (or base_object for vacancy / flat-rate terms).
         # A contract result whose term uses oc_processing='flat_rate' has no
@@ -711,11 +1097,19 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
             if result.contract and oc_processing != 'flat_rate':
                 key = result.contract.id
                 by_contract.setdefault(key, []).append(result)
-            else:
+            elif completed:
                 owner_borne_results.append(result)
+        durations['aggregation'] = time.perf_counter() - started
+        started = time.perf_counter()
 
         # --- Process contracts ---
+        # All invoices of the run are built in memory first and then saved,
+        # posted and linked to the billing unit moves in bulk.
+        billed_results = []
+        to_link = []
+        contract_logs = {}
         for contract_id, results in by_contract.items():
+            first_log = len(logs)
             contract = results[0].contract
             c_type = contract.c_type
             re_accounting = contract.company.re_accounting
@@ -726,7 +1120,7 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
 
             # Skip if truly nothing to post
             if total_actual == Decimal(0) and total_advanced == Decimal(0):
-                SettlementResult.write(results, {'state': 'billed'})
+                billed_results.extend(results)
                 continue
 
             invoice_type = c_type.invoice_type
@@ -766,9 +1160,8 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                 adv_account = (adv_term.account
                                if adv_term and adv_term.account else None)
                 if r_advanced != Decimal(0) and adv_account is None:
-                    fallback = term_account_by_bu_co.get(
-                        (r.billing_unit.id, contract.id,
-                            r.base_object.id if r.base_object else None))
+                    fallback = get_term_account(
+                        r.billing_unit, contract, r.base_object)
                     if fallback:
                         adv_term, adv_account = fallback
 
@@ -798,15 +1191,18 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                         base_object=r.base_object.id if r.base_object else None,
                         assignment_control='settlement_result_contract',
                     )
-                    adv_line.save()
                     invoice_lines.append(adv_line)
                 elif r_advanced != Decimal(0):
-                    r.billing_unit.add_log('billing',
-                        f'Warning: no advance payment line for '
-                        f'{contract.contract_number}/{r.billing_unit.name}: '
-                        f'no term with clearing account found '
-                        f'(r.term={r.term}, adv={r_advanced})')
-                    r.billing_unit.save()
+                    logs.append({
+                            'billing_unit': r.billing_unit.id,
+                            'event': 'billing',
+                            'description': (
+                                f'Warning: no advance payment line for '
+                                f'{contract.contract_number}/'
+                                f'{r.billing_unit.name}: '
+                                f'no term with clearing account found '
+                                f'(r.term={r.term}, adv={r_advanced})'),
+                            })
 
                 # Line 2: Actual costs (revenue/expense account from ContractType)
                 cost_line = None
@@ -828,13 +1224,12 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                         base_object=r.base_object.id if r.base_object else None,
                         assignment_control='settlement_result_contract',
                     )
-                    cost_line.save()
                     invoice_lines.append(cost_line)
 
                 moves_by_result[r.id] = (adv_line, cost_line)
 
             if not invoice_lines:
-                SettlementResult.write(results, {'state': 'billed'})
+                billed_results.extend(results)
                 continue
 
             period_str = (f"{min(r.start_date for r in results if r.start_date)}"
@@ -859,13 +1254,151 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                               else None),
                 description=f"{c_type.oc_mark or 'Operating Cost Settlement'} {period_str}",
                 reference=contract.contract_number,
-                lines=invoice_lines,
                 contract=contract,
             )
-            Invoice.save([invoice])
-            if invoice_state == 'posted':
-                Invoice.post([invoice])
+            # The lines are attached to the invoice only once they are saved
+            to_link.append((invoice, invoice_lines, contract, invoice_type,
+                    results, moves_by_result))
+            # The warnings of an invoiced contract go with its billing step
+            contract_logs[contract.id] = logs[first_log:]
+            del logs[first_log:]
+
+        # --- Process vacancy and flat-rate settlements (owner bears the ---
+        # --- cost directly, no tenant reconciliation) ---
+        owner_moves, owner_lines, billed_owner_results = (
+            cls._plan_owner_borne_results(
+                owner_borne_results, billing_date, billing_run_id))
+        durations['invoices'] = time.perf_counter() - started
+
+        return {
+            'billing_run_id': billing_run_id,
+            'billing_units': scope_units,
+            'invoices': to_link,
+            'billed_results': billed_results + billed_owner_results,
+            'owner_moves': owner_moves,
+            'owner_lines': owner_lines,
+            'logs': logs,
+            'contract_logs': contract_logs,
+            'durations': durations,
+            'completed': completed,
+            }
+
+    @classmethod
+    def _get_billing_contracts(cls, billing_units, limit):
+        """Return the ids of the first limit contracts with approved
+        settlement results of the billing units which are billed to the
+        tenant (i.e. not flat-rate)"""
+        pool = Pool()
+        SettlementResult = pool.get('real_estate.settlement_result')
+        ContractTerm = pool.get('real_estate.contract.term')
+        TermType = pool.get('real_estate.contract.term.type')
+        cursor = Transaction().connection.cursor()
+        result = SettlementResult.__table__()
+        term = ContractTerm.__table__()
+        term_type = TermType.__table__()
+
+        contract_ids = set()
+        bu_ids = [bu.id for bu in billing_units]
+        for sub_ids in grouped_slice(bu_ids, backend.MAX_QUERY_PARAMS):
+            cursor.execute(*result.join(term, 'LEFT',
+                    condition=result.term == term.id
+                    ).join(term_type, 'LEFT',
+                    condition=term.term_type == term_type.id
+                    ).select(
+                    result.contract,
+                    where=fields.SQL_OPERATORS['in'](
+                        result.billing_unit, sub_ids)
+                    & (result.state == 'approved')
+                    & (result.contract != Null)
+                    & ((term_type.oc_processing == Null)
+                        | (term_type.oc_processing != 'flat_rate')),
+                    group_by=[result.contract],
+                    order_by=[result.contract],
+                    limit=limit))
+            contract_ids.update(contract_id for contract_id, in cursor)
+        return sorted(contract_ids)[:limit]
+
+    @classmethod
+    def _get_billing_steps(cls, plan):
+        """Split a billing plan into steps of _billing_step_size contracts.
+
+        The warnings of the invoiced contracts go with their step. The results
+        billed without invoice, the owner-borne moves and the other warnings
+        go with the last step, and the completion log too if the plan
+        reaches the last contract."""
+        invoices = plan['invoices']
+        chunks = [invoices[i:i + _billing_step_size]
+            for i in range(0, len(invoices), _billing_step_size)] or [[]]
+        for index, chunk in enumerate(chunks):
+            last = index == len(chunks) - 1
+            logs = [log for _, _, contract, *_ in chunk
+                for log in plan['contract_logs'].get(contract.id, [])]
+            yield {
+                'billing_run_id': plan['billing_run_id'],
+                'billing_units': plan['billing_units'],
+                'invoices': chunk,
+                'billed_results': plan['billed_results'] if last else [],
+                'owner_moves': plan['owner_moves'] if last else [],
+                'owner_lines': plan['owner_lines'] if last else [],
+                'logs': logs + (plan['logs'] if last else []),
+                'completed': last and plan['completed'],
+                'durations': {},
+                'counts': {},
+                }
+
+    @classmethod
+    def _check_billing_interrupted(cls, billing_units):
+        """Refuse to change billing units with settlement results already
+        billed by an interrupted billing"""
+        pool = Pool()
+        SettlementResult = pool.get('real_estate.settlement_result')
+        results = SettlementResult.search([
+                ('billing_unit', 'in', [bu.id for bu in billing_units]),
+                ('billing_unit.state', '!=', 'billed'),
+                ('state', '=', 'billed'),
+                ])
+        if results:
+            names = sorted({r.billing_unit.name for r in results})
+            raise ValidationError(gettext(
+                'real_estate.msg_billing_unit_billing_interrupted',
+                names=', '.join(names)))
 
+    @classmethod
+    def _execute_billing_plan(cls, plan, invoice_state='draft'):
+        "Persist and post the invoices and moves of a billing plan (step)"
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        AccountMove = pool.get('account.move')
+        AccountMoveLine = pool.get('account.move.line')
+        SettlementResult = pool.get('real_estate.settlement_result')
+        BillingUnitMoves = pool.get('real_estate.billing_unit.moves')
+        BillingUnitLog = pool.get('real_estate.billing_unit.log')
+        billing_run_id = plan['billing_run_id']
+        logs = list(plan['logs'])
+        started = time.perf_counter()
+
+        invoice_lines = [line
+            for _, lines, *_ in plan['invoices'] for line in lines]
+        if invoice_lines:
+            InvoiceLine.save(invoice_lines)
+        invoices = []
+        for invoice, lines, *_ in plan['invoices']:
+            invoice.lines = lines
+            invoices.append(invoice)
+        if invoices:
+            Invoice.save(invoices)
+            if invoice_state == 'posted':
+                Invoice.post(invoices)
+        plan['durations']['posting'] = time.perf_counter() - started
+        started = time.perf_counter()
+
+        moves = []
+        to_write = []
+        if plan['billed_results']:
+            to_write.extend([plan['billed_results'], {'state': 'billed'}])
+        for invoice, _, contract, invoice_type, results, moves_by_result in (
+                plan['invoices']):
             for r in results:
                 adv_line, cost_line = moves_by_result.get(r.id, (None, None))
                 base = {
@@ -876,103 +1409,242 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                     'billing_run_id': billing_run_id,
                 }
                 if adv_line:
-                    BillingUnitMoves.create([{
+                    moves.append({
                         **base,
                         'moves_advanced_payment': adv_line.id,
-                    }])
+                    })
                 if cost_line:
-                    BillingUnitMoves.create([{
+                    moves.append({
                         **base,
                         'moves_actual_costs': cost_line.id,
-                    }])
+                    })
 
-            SettlementResult.write(results, {
+            to_write.extend([results, {
                 'state': 'billed',
                 'invoice': invoice.id,
-            })
-
-            for bu in scope_units:
-                bu.add_log('billing',
-                    f"Invoice {invoice.id} created for contract "
-                    f"{contract.contract_number} ({invoice_type}).")
+            }])
+
+            for bu in plan['billing_units']:
+                logs.append({
+                        'billing_unit': bu.id,
+                        'event': 'billing',
+                        'description': (
+                            f"Invoice {invoice.id} created for contract "
+                            f"{contract.contract_number} ({invoice_type})."),
+                        })
+
+        if plan['owner_moves']:
+            AccountMove.save(plan['owner_moves'])
+            AccountMoveLine.save([line
+                    for _, debit_line, credit_line in plan['owner_lines']
+                    for line in (debit_line, credit_line)])
+            AccountMove.post(plan['owner_moves'])
+            moves.extend({
+                    'billing_unit': r.billing_unit.id,
+                    'settlement_result': r.id,
+                    'property': r.billing_unit.property.id,
+                    'moves_alloc_by_owner': credit_line.id,
+                    'billing_run_id': billing_run_id,
+                    } for r, _, credit_line in plan['owner_lines'])
+
+        if moves:
+            BillingUnitMoves.create(moves)
+        if to_write:
+            SettlementResult.write(*to_write)
+
+        if plan.get('completed', True):
+            logs.extend({
+                    'billing_unit': bu.id,
+                    'event': 'billing',
+                    'description': 'Billing completed.',
+                    } for bu in plan['billing_units'])
+        if logs:
+            BillingUnitLog.create(logs)
+        plan['durations']['moves'] = time.perf_counter() - started
+        plan['counts'].update({
+                'billing_unit': (len(plan['billing_units'])
+                    if plan.get('completed', True) else 0),
+                'settlement_result': len(plan['billed_results']) + sum(
+                    len(results) for *_, results, _ in plan['invoices']),
+                'invoice': len(invoices),
+                'invoice_line': len(invoice_lines),
+                'move': len(plan['owner_moves']),
+                'billing_unit_moves': len(moves),
+                })
 
-        # --- Process vacancy and flat-rate settlements (owner bears the ---
-        # --- cost directly, no tenant reconciliation) ---
-        if owner_borne_results:
-            for r in owner_borne_results:
-                actual = r.actual_costs or Decimal(0)
-                if actual == Decimal(0):
-                    SettlementResult.write([r], {'state': 'billed'})
-                    continue
+    @classmethod
+    def _preview_billing_plan(cls, plan):
+        "Return the invoices and moves of a billing plan as dictionaries"
+        invoices = []
+        for invoice, invoice_lines, contract, invoice_type, results, \
+                moves_by_result in plan['invoices']:
+            kinds = {}
+            for r in results:
+                adv_line, cost_line = moves_by_result.get(r.id, (None, None))
+                if adv_line:
+                    kinds[adv_line] = (r, 'advance_payment')
+                if cost_line:
+                    kinds[cost_line] = (r, 'actual_costs')
+            lines = []
+            for line in invoice_lines:
+                line.amount = line.on_change_with_amount()
+                r, kind = kinds[line]
+                lines.append({
+                        'kind': kind,
+                        'settlement_result': r.id,
+                        'billing_unit': r.billing_unit.id,
+                        'base_object': (
+                            r.base_object.id if r.base_object else None),
+                        'description': line.description,
+                        'account': line.account.id,
+                        'amount': line.amount,
+                        'tax_amount': line.on_change_with_tax_amount(),
+                        })
+            invoice.lines = invoice_lines
+            invoice.on_change_lines()
+            invoices.append({
+                    'contract': contract.id,
+                    'party': invoice.party.id,
+                    'type': invoice_type,
+                    'journal': invoice.journal.id,
+                    'account': invoice.account.id,
+                    'invoice_date': invoice.invoice_date,
+                    'description': invoice.description,
+                    'currency': invoice.currency.id,
+                    'untaxed_amount': invoice.untaxed_amount,
+                    'tax_amount': invoice.tax_amount,
+                    'total_amount': invoice.total_amount,
+                    'settlement_results': [r.id for r in results],
+                    'lines': lines,
+                    })
+
+        moves = {}
+        for r, debit_line, credit_line in plan['owner_lines']:
+            move = debit_line.move
+            if move not in moves:
+                moves[move] = {
+                    'company': move.company.id,
+                    'journal': move.journal.id,
+                    'period': move.period.id,
+                    'date': move.date,
+                    'description': move.description,
+                    'lines': [],
+                    }
+            for line in (debit_line, credit_line):
+                moves[move]['lines'].append({
+                        'settlement_result': r.id,
+                        'account': line.account.id,
+                        'debit': line.debit,
+                        'credit': line.credit,
+                        'description': line.description,
+                        })
+
+        return {
+            'billing_run_id': plan['billing_run_id'],
+            'billing_units': [bu.id for bu in plan['billing_units']],
+            'invoices': invoices,
+            'moves': list(moves.values()),
+            'settlement_results': sorted(
+                {r.id for r in plan['billed_results']}
+                | {r.id for *_, results, _ in plan['invoices']
+                    for r in results}),
+            'warnings': [log['description']
+                for log in [log for logs in plan['contract_logs'].values()
+                    for log in logs] + plan['logs']],
+            }
 
-                re_accounting = r.billing_unit.property.company.re_accounting
-                vacancy_account = (
-                    re_accounting.re_account_allocation_by_owner
-                    if re_accounting else None)
-                vacancy_journal = (
-                    re_accounting.re_journal_billing if re_accounting else None)
-                if not (vacancy_account and vacancy_journal):
-                    # No configuration for this company — just mark as billed
-                    SettlementResult.write([r], {'state': 'billed'})
-                    continue
+    @classmethod
+    def _plan_owner_borne_results(cls, results, billing_date, billing_run_id):
+        """Build the owner postings of vacancy and flat-rate settlement
+        results in memory.
+
+        Each result gets a debit and a credit line on the vacancy cost
+        account. By default every result is booked in its own move; with
+        re_consolidate_owner_moves set on the company's accounting
+        configuration all results of the run are booked in one move per
+        company and journal.
+
+        Returns the moves, the (result, debit line, credit line) tuples and
+        the results to mark as billed."""
+        pool = Pool()
+        AccountMove = pool.get('account.move')
+        AccountMoveLine = pool.get('account.move.line')
+        Period = pool.get('account.period')
+
+        periods = {}
+
+        def find_period(company):
+            if company.id not in periods:
+                periods[company.id] = Period.find(
+                    company.id, date=billing_date)
+            return periods[company.id]
+
+        billed = []
+        moves = {}
+        lines = []
+        for r in results:
+            billed.append(r)
+            actual = r.actual_costs or Decimal(0)
+            if actual == Decimal(0):
+                continue
 
-                is_flat_rate = bool(r.contract)
-                label = 'Flat Rate' if is_flat_rate else 'Vacancy'
-                assignment_control = (
-                    'settlement_result_flat_rate' if is_flat_rate
-                    else 'settlement_result_vacant')
+            company = r.billing_unit.property.company
+            re_accounting = company.re_accounting
+            vacancy_account = (
+                re_accounting.re_account_allocation_by_owner
+                if re_accounting else None)
+            vacancy_journal = (
+                re_accounting.re_journal_billing if re_accounting else None)
+            if not (vacancy_account and vacancy_journal):
+                # No configuration for this company — just mark as billed
+                continue
 
-                period = Pool().get('account.period')
-                period_rec = period.find(
-                    r.billing_unit.property.company.id, date=billing_date)
+            is_flat_rate = bool(r.contract)
+            label = 'Flat Rate' if is_flat_rate else 'Vacancy'
+            assignment_control = (
+                'settlement_result_flat_rate' if is_flat_rate
+                else 'settlement_result_vacant')
 
-                obj_name = (r.base_object.rec_name
-                    if r.base_object else r.billing_unit.name)
-                move = AccountMove(
+            if re_accounting.re_consolidate_owner_moves:
+                key = (company.id, vacancy_journal.id)
+                description = f"Owner-borne Costs — {billing_run_id}"
+            else:
+                key = r.id
+                description = f"{label} Cost — {r.billing_unit.name}"
+            move = moves.get(key)
+            if move is None:
+                move = moves[key] = AccountMove(
                     journal=vacancy_journal.id,
                     date=billing_date,
-                    period=period_rec,
-                    company=r.billing_unit.property.company.id,
-                    description=(
-                        f"{label} Cost — {r.billing_unit.name}"),
-                )
-                AccountMove.save([move])
-
-                debit_line = AccountMoveLine(
-                    move=move.id,
-                    account=vacancy_account.id,
-                    debit=actual,
-                    credit=Decimal(0),
-                    description=f"{label} — {obj_name}",
-                    base_object=r.base_object.id if r.base_object else None,
-                    contract=r.contract.id if r.contract else None,
-                    assignment_control=assignment_control,
-                )
-                credit_line = AccountMoveLine(
-                    move=move.id,
-                    account=vacancy_account.id,
-                    debit=Decimal(0),
-                    credit=actual,
-                    description=f"{label} — {r.billing_unit.name}",
-                    billing_unit=r.billing_unit.id,
-                    contract=r.contract.id if r.contract else None,
-                    assignment_control=assignment_control,
+                    period=find_period(company),
+                    company=company.id,
+                    description=description,
                 )
-                AccountMoveLine.save([debit_line, credit_line])
-                AccountMove.post([move])
-
-                BillingUnitMoves.create([{
-                    'billing_unit': r.billing_unit.id,
-                    'settlement_result': r.id,
-                    'property': r.billing_unit.property.id,
-                    'moves_alloc_by_owner': credit_line.id,
-                    'billing_run_id': billing_run_id,
-                }])
 
-                SettlementResult.write([r], {'state': 'billed'})
-
-        for bu in scope_units:
-            bu.add_log('billing', 'Billing completed.')
+            obj_name = (r.base_object.rec_name
+                if r.base_object else r.billing_unit.name)
+            debit_line = AccountMoveLine(
+                move=move,
+                account=vacancy_account.id,
+                debit=actual,
+                credit=Decimal(0),
+                description=f"{label} — {obj_name}",
+                base_object=r.base_object.id if r.base_object else None,
+                contract=r.contract.id if r.contract else None,
+                assignment_control=assignment_control,
+            )
+            credit_line = AccountMoveLine(
+                move=move,
+                account=vacancy_account.id,
+                debit=Decimal(0),
+                credit=actual,
+                description=f"{label} — {r.billing_unit.name}",
+                billing_unit=r.billing_unit.id,
+                contract=r.contract.id if r.contract else None,
+                assignment_control=assignment_control,
+            )
+            lines.append((r, debit_line, credit_line))
+        return list(moves.values()), lines, billed
 
     @classmethod
     @ModelView.button_action('real_estate.wizard_cancel_billing')
@@ -984,8 +1656,10 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
     def cancel_units(cls, billing_units, invoice_date=None):
         pool = Pool()
         Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
         SettlementResult = pool.get('real_estate.settlement_result')
         BillingUnitMoves = pool.get('real_estate.billing_unit.moves')
+        BillingUnitLog = pool.get('real_estate.billing_unit.log')
 
         # Expand scope for collective billing (same property, same start_date, state billed)
         scope_units = list(billing_units)
@@ -999,15 +1673,7 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
             ])
 
         # Collect all invoices linked via BillingUnitMoves
-        all_moves = BillingUnitMoves.search([
-            ('billing_unit', 'in', [bu.id for bu in scope_units]),
-        ])
-        invoice_ids = set()
-        for m in all_moves:
-            if m.moves_advanced_payment and m.moves_advanced_payment.invoice:
-                invoice_ids.add(m.moves_advanced_payment.invoice.id)
-            if m.moves_actual_costs and m.moves_actual_costs.invoice:
-                invoice_ids.add(m.moves_actual_costs.invoice.id)
+        move_ids, invoice_ids = cls._get_billing_moves_invoices(scope_units)
 
         # 'posted' and 'paid' invoices are always reversed via a credit note
         # (never cancelled directly). Only when the original is still open
@@ -1018,11 +1684,11 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
         # (typically 'draft', with no posted move yet) is simply cancelled;
         # an already 'cancelled' invoice is left untouched.
         if invoice_ids:
-            MoveLine = pool.get('account.move.line')
-            invoices = Invoice.browse(list(invoice_ids))
+            invoices = Invoice.browse(sorted(invoice_ids))
             to_credit = [i for i in invoices if i.state in ('posted', 'paid')]
             to_cancel = [
                 i for i in invoices if i.state not in ('posted', 'paid', 'cancelled')]
+            open_invoices = {i for i in to_credit if i.state == 'posted'}
 
             if to_cancel:
                 Invoice.cancel(to_cancel)
@@ -1032,20 +1698,24 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                     to_credit, refund=False, invoice_date=invoice_date)
                 Invoice.post(new_invoices)
 
-                for invoice, new_invoice in zip(to_credit, new_invoices):
-                    if invoice.state != 'posted':
-                        continue
-                    open_lines = [
-                        line for line in
-                        list(invoice.lines_to_pay) + list(new_invoice.lines_to_pay)
-                        if not line.reconciliation]
-                    if open_lines and sum(
-                            line.debit - line.credit
-                            for line in open_lines) == Decimal(0):
-                        MoveLine.reconcile(open_lines)
+                pairs = [(invoice.id, new_invoice.id)
+                    for invoice, new_invoice in zip(to_credit, new_invoices)
+                    if invoice in open_invoices]
+                open_lines = cls._get_open_lines_to_pay(
+                    [i for pair in pairs for i in pair])
+                to_reconcile = []
+                for pair in pairs:
+                    lines = [line for invoice_id in pair
+                        for line in open_lines.get(invoice_id, [])]
+                    if lines and sum(
+                            amount for _, amount in lines) == Decimal(0):
+                        to_reconcile.append([line_id for line_id, _ in lines])
+                if to_reconcile:
+                    MoveLine.reconcile(
+                        *[MoveLine.browse(ids) for ids in to_reconcile])
 
         # Delete BillingUnitMoves
-        BillingUnitMoves.delete(all_moves)
+        BillingUnitMoves.delete(BillingUnitMoves.browse(move_ids))
 
         # Reset SettlementResults
         results = SettlementResult.search([
@@ -1058,9 +1728,69 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
         # Transition all scope units back to value_share and clear the
         # billing run reference, so a repeated lookup by billing_run_id
         # (e.g. via the Cancel Billing wizard) no longer matches them.
-        cls.write(scope_units, {'state': 'value_share', 'billing_run_id': None})
-        for bu in scope_units:
-            bu.add_log('cancel', 'Billing cancelled.')
+        cls.write(scope_units, {
+                'state': 'value_share',
+                'billing_run_id': None,
+                'billing_run': None,
+                })
+        BillingUnitLog.create([{
+                    'billing_unit': bu.id,
+                    'event': 'cancel',
+                    'description': 'Billing cancelled.',
+                    } for bu in scope_units])
+
+    @classmethod
+    def _get_billing_moves_invoices(cls, billing_units):
+        """Return the ids of the billing unit moves of billing_units and the
+        ids of the invoices of their invoice lines"""
+        pool = Pool()
+        BillingUnitMoves = pool.get('real_estate.billing_unit.moves')
+        InvoiceLine = pool.get('account.invoice.line')
+        moves = BillingUnitMoves.__table__()
+        advance_line = InvoiceLine.__table__()
+        cost_line = InvoiceLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        move_ids, invoice_ids = [], set()
+        for sub_ids in grouped_slice(
+                [bu.id for bu in billing_units], backend.MAX_QUERY_PARAMS):
+            cursor.execute(*moves
+                .join(advance_line, 'LEFT',
+                    condition=advance_line.id == moves.moves_advanced_payment)
+                .join(cost_line, 'LEFT',
+                    condition=cost_line.id == moves.moves_actual_costs)
+                .select(moves.id, advance_line.invoice, cost_line.invoice,
+                    where=fields.SQL_OPERATORS['in'](
+                        moves.billing_unit, sub_ids)))
+            for move_id, *line_invoices in cursor:
+                move_ids.append(move_id)
+                invoice_ids.update(filter(None, line_invoices))
+        return move_ids, invoice_ids
+
+    @classmethod
+    def _get_open_lines_to_pay(cls, invoice_ids):
+        """Return the unreconciled lines to pay of the invoices as
+        {invoice_id: [(line_id, debit - credit)]}
+
+        The lines_to_pay of all the invoices and then their amounts are
+        each read at once."""
+        pool = Pool()
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+
+        lines_to_pay = {i['id']: i['lines_to_pay']
+            for i in Invoice.read(list(invoice_ids), ['lines_to_pay'])}
+        lines = {l['id']: l for l in MoveLine.read(
+                [l for ids in lines_to_pay.values() for l in ids],
+                ['debit', 'credit', 'reconciliation'])}
+        open_lines = {}
+        for invoice_id, line_ids in lines_to_pay.items():
+            for line_id in line_ids:
+                line = lines[line_id]
+                if line['reconciliation'] is None:
+                    open_lines.setdefault(invoice_id, []).append(
+                        (line_id, line['debit'] - line['credit']))
+        return open_lines
 
     @classmethod
     @ModelView.button
@@ -1123,23 +1853,60 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
         """Compute settlement result based on cost shares and cash flow lines of all settlement units.
         Checks chronological order before processing.
         For each unique combination of contract and base_object, create a settlement result record with
-        aggregated planned and actual costs, and allocated advanced payment and refund/receivable amounts."""
+        aggregated planned and actual costs, and allocated advanced payment and refund/receivable amounts.
+
+        The inputs are fingerprinted per contract; only the results of
+        contracts whose fingerprint changed since the last run are rebuilt."""
+        BaseObject = Pool().get('real_estate.base_object')
+        # The results read the pending occupancy and value share changes
+        BaseObject.flush_dirty()
         cls._check_chronological_order(billing_units)
+        cls._check_billing_interrupted(billing_units)
         # Reset ready_for_billing back to value_share before recomputing
         ready_units = [bu for bu in billing_units if bu.state == 'ready_for_billing']
         if ready_units:
             cls.write(ready_units, {'state': 'value_share'})
         pool = Pool()
         SettlementResult = pool.get('real_estate.settlement_result')
-        CostShare = pool.get('real_estate.cost_share')
-        CashFlowLine = pool.get('real_estate.contract.term.cash_flow')
         for billing_unit in billing_units:
             if billing_unit.state not in ('value_share',):
                 raise ValidationError(gettext(
                     'real_estate.msg_billing_unit_compute_settlement_result_invalid_state',
                     name=billing_unit.name, state=billing_unit.state))
+        groups_by_bu = cls._get_cost_share_groups(billing_units)
+        to_delete, to_create, to_store = [], [], []
+        for billing_unit in billing_units:
+            groups = groups_by_bu.get(billing_unit.id, {})
+            billing_unit._check_draft_cash_flows(
+                {contract_id for contract_id, _ in groups if contract_id})
+
+            fingerprint = billing_unit._get_settlement_fingerprint()
+            previous = json.loads(billing_unit.settlement_fingerprint or '{}')
             existing = SettlementResult.search(
                 [('billing_unit', '=', billing_unit.id)])
+            if any(fingerprint.get(k) != previous.get(k) for k in '*#'):
+                # The invoice lines of the settlement units or the
+                # parameters of the billing unit changed: the results of
+                # every contract may differ.
+                changed = None
+            else:
+                # A removed result changes the key of its contract
+                changed = {
+                    int(key) if key else None
+                    for key in fingerprint.keys() | previous.keys()
+                    if fingerprint.get(key) != previous.get(key)}
+            if fingerprint != previous:
+                to_store.append(billing_unit)
+            if changed is not None and not changed:
+                billing_unit.add_log('compute_settlement_result',
+                    'Settlement results are up to date.')
+                continue
+
+            def is_changed(contract_id):
+                return changed is None or contract_id in changed
+
+            existing = [r for r in existing
+                if is_changed(r.contract.id if r.contract else None)]
             # For external billing: preserve manually entered costs before delete
             preserved_costs = {}
             if existing and billing_unit.external_billing:
@@ -1148,112 +1915,18 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                          r.base_object.id if r.base_object else None)
                     preserved_costs[k] = (
                         r.actual_costs, r.planned_costs)
-            if existing:
-                SettlementResult.delete(existing)
-            groups = {}
-            for cs in billing_unit._get_cost_shares():
-                if cs.contract:
-                    key = ('contract', cs.contract.id,
-                        cs.base_object.id if cs.base_object else None)
-                elif cs.base_object:
-                    key = ('object', cs.base_object.id)
-                else:
-                    key = None
-                if key not in groups:
-                    groups[key] = {
-                        'contract': cs.contract if cs.contract else None,
-                        'base_object': cs.base_object if cs.base_object else None,
-                        'start_date': cs.start_date,
-                        'end_date': cs.end_date,
-                        'planned_costs': Decimal(0),
-                        'actual_costs': Decimal(0),
-                    }
-                g = groups[key]
-                if cs.start_date and (
-                        g['start_date'] is None or cs.start_date < g['start_date']):
-                    g['start_date'] = cs.start_date
-                if cs.end_date and (
-                        g['end_date'] is None or cs.end_date > g['end_date']):
-                    g['end_date'] = cs.end_date
-                g['planned_costs'] += cs.planned_costs or Decimal(0)
-                g['actual_costs'] += cs.actual_costs or Decimal(0)
-            advanced_by_co = {}
-            terms_by_co = {}
-            for line in (billing_unit.cash_flow_lines or []):
-                if line.contract:
-                    co_key = (
-                        line.contract.id,
-                        line.base_object.id if line.base_object else None)
-                    advanced_by_co[co_key] = (
-                        advanced_by_co.get(co_key, Decimal(0))
-                        + (line.amount or Decimal(0)))
-                    if line.term:
-                        terms_by_co.setdefault(co_key, set()).add(line.term.id)
-
-            # a) Check for draft invoice items in the settlement period.
-            # Reset previous draft-error markers so the check is re-runnable.
-            prev_draft_errors = CostShare.search([
-                ('settlement_unit.billing_unit', '=', billing_unit.id),
-                ('state', '=', 'error'),
-                ('error_message', 'like', '[draft]%'),
-            ])
-            if prev_draft_errors:
-                CostShare.write(prev_draft_errors, {
-                    'state': 'value_share',
-                    'error_message': '',
-                })
-            all_contract_ids = list({
-                cs.contract.id
-                for su in billing_unit.settlement_units
-                for cs in su.cost_shares
-                if cs.contract
-            })
-            if all_contract_ids:
-                draft_domain = [
-                    ('term.contract', 'in', all_contract_ids),
-                    ('invoice_state', '=', 'draft'),
-                ]
-                if billing_unit.start_date:
-                    draft_domain.append(
-                        ('document_date', '>=', billing_unit.start_date))
-                if billing_unit.end_date:
-                    draft_domain.append(
-                        ('document_date', '<=', billing_unit.end_date))
-                if billing_unit.term_types_of_use:
-                    draft_domain.append(('term.term_type', 'in',
-                        [int(t) for t in billing_unit.term_types_of_use]))
-                draft_lines = CashFlowLine.search(draft_domain)
-                if draft_lines:
-                    draft_contract_ids = {
-                        dl.contract.id for dl in draft_lines if dl.contract}
-                    period_str = (
-                        f"{billing_unit.start_date} - {billing_unit.end_date}")
-                    for su in billing_unit.settlement_units:
-                        error_shares = [
-                            cs for cs in su.cost_shares
-                            if cs.contract
-                            and cs.contract.id in draft_contract_ids
-                        ]
-                        if error_shares:
-                            CostShare.write(error_shares, {
-                                'state': 'error',
-                                'error_message': (
-                                    f'[draft] Draft items in period {period_str}.'
-                                    f' Please post or delete before settlement.'),
-                            })
-                    billing_unit.add_log('compute_settlement_result',
-                        f'[draft] {len(draft_lines)} draft item(s) found for '
-                        f'{len(draft_contract_ids)} contract(s) in {period_str}.')
+            to_delete.extend(existing)
+            advanced_by_co, terms_by_co = (
+                billing_unit._get_advanced_payments())
 
             # Keys consumed by the cost-share groups
             consumed_co_keys = {
-                (g['contract'].id, g['base_object'].id if g['base_object'] else None)
-                for g in groups.values()
-                if g['contract']
-            }
+                key for key in groups if key[0]}
+            group_count = 0
             for key, g in groups.items():
-                contract_id = g['contract'].id if g['contract'] else None
-                base_object_id = g['base_object'].id if g['base_object'] else None
+                contract_id, base_object_id = key
+                if not is_changed(contract_id):
+                    continue
                 if contract_id:
                     co_key = (contract_id, base_object_id)
                     adv = advanced_by_co.get(co_key, Decimal(0))
@@ -1275,19 +1948,19 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                             g['planned_costs'] = prev_planned
                         refund = (g['actual_costs'] - adv
                             if adv is not None else None)
-                result = SettlementResult(
-                    billing_unit=billing_unit.id,
-                    contract=contract_id,
-                    base_object=base_object_id,
-                    term=term_id,
-                    start_date=g['start_date'],
-                    end_date=g['end_date'],
-                    planned_costs=g['planned_costs'],
-                    actual_costs=g['actual_costs'],
-                    advanced_payment=adv,
-                    refund_receivable=refund,
-                )
-                result.save()
+                to_create.append({
+                    'billing_unit': billing_unit.id,
+                    'contract': contract_id,
+                    'base_object': base_object_id,
+                    'term': term_id,
+                    'start_date': g['start_date'],
+                    'end_date': g['end_date'],
+                    'planned_costs': g['planned_costs'],
+                    'actual_costs': g['actual_costs'],
+                    'advanced_payment': adv,
+                    'refund_receivable': refund,
+                    })
+                group_count += 1
 
             # Fallback: advance payment lines whose (contract, object) key has
             # no matching cost-share group (e.g. no base_object on old invoices,
@@ -1298,27 +1971,323 @@ class BillingUnit(Workflow, DeactivableMixin, sequence_ordered(), ModelSQL, Mode
                 if co_key in consumed_co_keys or not adv_amount:
                     continue
                 fb_contract_id, fb_object_id = co_key
+                if not is_changed(fb_contract_id):
+                    continue
                 fb_term_ids = terms_by_co.get(co_key, set())
                 fb_term_id = (next(iter(fb_term_ids))
                     if len(fb_term_ids) == 1 else None)
-                fallback = SettlementResult(
-                    billing_unit=billing_unit.id,
-                    contract=fb_contract_id,
-                    base_object=fb_object_id,
-                    term=fb_term_id,
-                    start_date=billing_unit.start_date,
-                    end_date=billing_unit.end_date,
-                    planned_costs=Decimal(0),
-                    actual_costs=Decimal(0),
-                    advanced_payment=adv_amount,
-                    refund_receivable=-adv_amount,
-                )
-                fallback.save()
+                to_create.append({
+                    'billing_unit': billing_unit.id,
+                    'contract': fb_contract_id,
+                    'base_object': fb_object_id,
+                    'term': fb_term_id,
+                    'start_date': billing_unit.start_date,
+                    'end_date': billing_unit.end_date,
+                    'planned_costs': Decimal(0),
+                    'actual_costs': Decimal(0),
+                    'advanced_payment': adv_amount,
+                    'refund_receivable': -adv_amount,
+                    })
                 fallback_count += 1
             billing_unit.add_log('compute_settlement_result',
-                f'Settlement results computed: {len(groups)} records created'
+                f'Settlement results computed: {group_count} records created'
                 + (f', {fallback_count} fallback (unmatched advance payment)'
-                    if fallback_count else '') + '.')
+                    if fallback_count else '')
+                + (f' for {len(changed)} changed contract(s)'
+                    if changed is not None else '') + '.')
+        if to_delete:
+            SettlementResult.delete(to_delete)
+        if to_create:
+            SettlementResult.create(to_create)
+        # The fingerprint is taken once the results exist to include them
+        to_write = []
+        for billing_unit in to_store:
+            to_write.extend([[billing_unit], {
+                        'settlement_fingerprint': json.dumps(
+                            billing_unit._get_settlement_fingerprint(),
+                            sort_keys=True),
+                        }])
+        if to_write:
+            cls.write(*to_write)
+
+    def _check_draft_cash_flows(self, contract_ids):
+        """Flag the cost shares of contracts which still have draft cash
+        flow lines in the settlement period, and clear the flag of those
+        which no longer have any.
+
+        Only cost shares whose flag actually changes are written."""
+        pool = Pool()
+        CostShare = pool.get('real_estate.cost_share')
+        CashFlowLine = pool.get('real_estate.contract.term.cash_flow')
+        ContractTerm = pool.get('real_estate.contract.term')
+        # Previous draft-error markers, so the check is re-runnable.
+        prev_draft_errors = CostShare.search([
+            ('settlement_unit.billing_unit', '=', self.id),
+            ('state', '=', 'error'),
+            ('error_message', 'like', '[draft]%'),
+        ])
+        error_shares = []
+        error_message = None
+        if contract_ids:
+            draft_domain = [
+                ('term.contract', 'in', sorted(contract_ids)),
+                ('invoice_state', '=', 'draft'),
+            ]
+            if self.start_date:
+                draft_domain.append(
+                    ('document_date', '>=', self.start_date))
+            if self.end_date:
+                draft_domain.append(
+                    ('document_date', '<=', self.end_date))
+            if self.term_types_of_use:
+                draft_domain.append(('term.term_type', 'in',
+                    [int(t) for t in self.term_types_of_use]))
+            draft_lines = CashFlowLine.search(draft_domain)
+            # Cash flows not invoiced yet are projected from the terms
+            term_domain = [('contract', 'in', sorted(contract_ids))]
+            if self.term_types_of_use:
+                term_domain.append(('term_type', 'in',
+                    [int(t) for t in self.term_types_of_use]))
+            for term in ContractTerm.search(term_domain):
+                draft_lines.extend(cf
+                    for cf in term.get_projected_cash_flows(self.end_date)
+                    if not self.start_date
+                    or cf.document_date >= self.start_date)
+            if draft_lines:
+                draft_contract_ids = {
+                    dl.term.contract.id for dl in draft_lines}
+                period_str = f"{self.start_date} - {self.end_date}"
+                error_message = (
+                    f'[draft] Draft items in period {period_str}.'
+                    f' Please post or delete before settlement.')
+                error_shares = CostShare.search([
+                        ('settlement_unit.billing_unit', '=', self.id),
+                        ('settlement_unit.active', '=', True),
+                        ('contract', 'in', list(draft_contract_ids)),
+                        ])
+                self.add_log('compute_settlement_result',
+                    f'[draft] {len(draft_lines)} draft item(s) found for '
+                    f'{len(draft_contract_ids)} contract(s) in {period_str}.')
+        to_reset = [cs for cs in prev_draft_errors if cs not in error_shares]
+        if to_reset:
+            CostShare.write(to_reset, {
+                'state': 'value_share',
+                'error_message': '',
+            })
+        to_flag = [cs for cs in error_shares
+            if cs.state != 'error' or cs.error_message != error_message]
+        if to_flag:
+            CostShare.write(to_flag, {
+                'state': 'error',
+                'error_message': error_message,
+            })
+
+    def _get_settlement_fingerprint(self):
+        """Return the fingerprint of the settlement result inputs.
+
+        The keys are the contract ids as strings ('' for cost shares without
+        contract); each value combines the count and the latest change of the
+        cost shares and of the cash flow lines with their invoice lines and
+        invoices, the number of cash flow lines per invoice state and the ids
+        of the existing settlement results of the contract.
+        The key '*' covers the invoice lines of the settlement units, which
+        feed the actual costs of all contracts, in the same way. The key '#'
+        covers the parameters of the billing unit itself."""
+        pool = Pool()
+        CostShare = pool.get('real_estate.cost_share')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+        SettlementResult = pool.get('real_estate.settlement_result')
+        CashFlowLine = pool.get('real_estate.contract.term.cash_flow')
+        ContractTerm = pool.get('real_estate.contract.term')
+        InvoiceLine = pool.get('account.invoice.line')
+        Invoice = pool.get('account.invoice')
+        cursor = Transaction().connection.cursor()
+        cost_share = CostShare.__table__()
+        settlement_unit = SettlementUnit.__table__()
+        result = SettlementResult.__table__()
+        cash_flow = CashFlowLine.__table__()
+        term = ContractTerm.__table__()
+        invoice_line = InvoiceLine.__table__()
+        invoice = Invoice.__table__()
+
+        def changed(table, name):
+            return Max(Coalesce(table.write_date, table.create_date)).as_(
+                name)
+
+        def execute(query, types):
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, types)
+            cursor.execute(*query)
+            return cursor
+
+        def latest(*dates):
+            return max(filter(None, dates), default=None)
+
+        def add_state(states, state, count):
+            states[state or ''] = states.get(state or '', 0) + count
+
+        def format_states(states):
+            return ','.join(f'{k}:{v}' for k, v in sorted(states.items()))
+
+        def format_date(date):
+            return date.isoformat() if date else ''
+
+        # count and latest change of the cost shares, of the cash flow
+        # lines, their invoice states and the ids of the results
+        inputs = defaultdict(lambda: [0, None, 0, None, {}, []])
+        for contract_id, count, last in execute(cost_share.join(
+                    settlement_unit,
+                    condition=cost_share.settlement_unit == settlement_unit.id
+                    ).select(
+                    cost_share.contract,
+                    Count(cost_share.id),
+                    changed(cost_share, 'cost_share'),
+                    where=(settlement_unit.billing_unit == self.id)
+                    & (settlement_unit.active == True)  # noqa: E712
+                    & (cost_share.active == True),  # noqa: E712
+                    group_by=[cost_share.contract]),
+                [None, None, 'DATETIME']):
+            inputs[contract_id][:2] = [count, last]
+
+        line_ids = [l.id for l in (self.cash_flow_lines or [])]
+        for sub_ids in grouped_slice(line_ids, backend.MAX_QUERY_PARAMS):
+            for contract_id, state, count, *lasts in execute(cash_flow.join(
+                        term, condition=cash_flow.term == term.id
+                        ).join(invoice_line, 'LEFT',
+                        condition=cash_flow.invoice_line == invoice_line.id
+                        ).join(invoice, 'LEFT',
+                        condition=invoice_line.invoice == invoice.id
+                        ).select(
+                        term.contract,
+                        invoice.state,
+                        Count(cash_flow.id),
+                        changed(cash_flow, 'cash_flow'),
+                        changed(invoice_line, 'invoice_line'),
+                        changed(invoice, 'invoice'),
+                        where=fields.SQL_OPERATORS['in'](
+                            cash_flow.id, sub_ids),
+                        group_by=[term.contract, invoice.state]),
+                    [None, None, None, 'DATETIME', 'DATETIME', 'DATETIME']):
+                values = inputs[contract_id]
+                values[2] += count
+                values[3] = latest(values[3], *lasts)
+                add_state(values[4], state, count)
+
+        cursor.execute(*result.select(result.contract, result.id,
+                where=result.billing_unit == self.id,
+                order_by=[result.id]))
+        for contract_id, result_id in cursor:
+            inputs[contract_id][5].append(result_id)
+
+        su_ids = [su.id for su in (self.settlement_units or [])]
+        invoice_lines = [0, None, {}]
+        for sub_ids in grouped_slice(su_ids, backend.MAX_QUERY_PARAMS):
+            for state, count, *lasts in execute(invoice_line.join(invoice,
+                        condition=invoice_line.invoice == invoice.id
+                        ).select(
+                        invoice.state,
+                        Count(invoice_line.id),
+                        changed(invoice_line, 'invoice_line'),
+                        changed(invoice, 'invoice'),
+                        where=fields.SQL_OPERATORS['in'](
+                            invoice_line.settlement_unit, sub_ids),
+                        group_by=[invoice.state]),
+                    [None, None, 'DATETIME', 'DATETIME']):
+                invoice_lines[0] += count
+                invoice_lines[1] = latest(invoice_lines[1], *lasts)
+                add_state(invoice_lines[2], state, count)
+
+        fingerprint = {
+            str(contract_id) if contract_id else '': '/'.join([
+                    str(values[0]), format_date(values[1]),
+                    str(values[2]), format_date(values[3]),
+                    format_states(values[4]),
+                    ','.join(map(str, values[5]))])
+            for contract_id, values in inputs.items()}
+        fingerprint['*'] = '/'.join([str(invoice_lines[0]),
+                format_date(invoice_lines[1]),
+                format_states(invoice_lines[2])])
+        fingerprint['#'] = '/'.join([
+                format_date(self.start_date), format_date(self.end_date),
+                ','.join(sorted(self.term_types_of_use or [])),
+                str(bool(self.external_billing))])
+        return fingerprint
+
+    @classmethod
+    def _get_cost_share_groups(cls, billing_units):
+        """Aggregate the active cost shares of the billing units by
+        (contract, base_object).
+
+        Returns {billing_unit_id: {(contract_id, base_object_id): values}}
+        with the earliest start date, the latest end date and the summed
+        planned and actual costs of each group."""
+        pool = Pool()
+        CostShare = pool.get('real_estate.cost_share')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+        cursor = Transaction().connection.cursor()
+        cost_share = CostShare.__table__()
+        settlement_unit = SettlementUnit.__table__()
+
+        groups = {}
+        bu_ids = [bu.id for bu in billing_units if bu.state != 'draft']
+        if not bu_ids:
+            return groups
+        for sub_ids in grouped_slice(bu_ids, backend.MAX_QUERY_PARAMS):
+            query = cost_share.join(settlement_unit,
+                condition=cost_share.settlement_unit == settlement_unit.id
+                ).select(
+                    settlement_unit.billing_unit,
+                    cost_share.contract,
+                    cost_share.base_object,
+                    Min(cost_share.start_date).as_('start_date'),
+                    Max(cost_share.end_date).as_('end_date'),
+                    Sum(Coalesce(cost_share.planned_costs, Decimal(0))
+                        ).as_('planned_costs'),
+                    Sum(Coalesce(cost_share.actual_costs, Decimal(0))
+                        ).as_('actual_costs'),
+                    where=(fields.SQL_OPERATORS['in'](
+                            settlement_unit.billing_unit, sub_ids)
+                        & (settlement_unit.active == True)  # noqa: E712
+                        & (cost_share.active == True)),  # noqa: E712
+                    group_by=[settlement_unit.billing_unit,
+                        cost_share.contract, cost_share.base_object],
+                    order_by=[settlement_unit.billing_unit,
+                        cost_share.contract, cost_share.base_object])
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query,
+                    [None, None, None, 'DATE', 'DATE', 'NUMERIC', 'NUMERIC'])
+            cursor.execute(*query)
+            for (bu_id, contract_id, base_object_id, start_date, end_date,
+                    planned_costs, actual_costs) in cursor:
+                groups.setdefault(bu_id, {})[(contract_id, base_object_id)] = {
+                    'start_date': start_date,
+                    'end_date': end_date,
+                    'planned_costs': planned_costs or Decimal(0),
+                    'actual_costs': actual_costs or Decimal(0),
+                    }
+        return groups
+
+    def _get_advanced_payments(self):
+        """Return the advance payments of the cash flow lines summed by
+        (contract, base_object) and the terms involved per key.
+
+        The amounts are taken from the booked invoice lines, which are not
+        stored columns, so the lines are read once and summed here."""
+        CashFlowLine = Pool().get('real_estate.contract.term.cash_flow')
+        advanced_by_co = {}
+        terms_by_co = {}
+        lines = self.cash_flow_lines or []
+        for line in CashFlowLine.read([l.id for l in lines],
+                ['contract', 'base_object', 'term', 'amount']):
+            if not line['contract']:
+                continue
+            co_key = (line['contract'], line['base_object'])
+            advanced_by_co[co_key] = (
+                advanced_by_co.get(co_key, Decimal(0))
+                + (line['amount'] or Decimal(0)))
+            if line['term']:
+                terms_by_co.setdefault(co_key, set()).add(line['term'])
+        return advanced_by_co, terms_by_co
 
     @staticmethod
     def default_state():
@@ -1809,6 +2778,115 @@ class BillingUnitMoves(ModelSQL, ModelView):
         return result
 
 
+#**********************************************************************
+class BillingRun(ModelSQL, ModelView):
+    "Billing Run — one execution of the billing with its stage metrics"
+    __name__ = 'real_estate.billing_run'
+
+    name = fields.Char('Billing Run ID', readonly=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    state = fields.Selection([
+            ('queued', 'Queued'),
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('failed', 'Failed'),
+            ], 'State', required=True, readonly=True, sort=False)
+    properties = fields.Many2Many('real_estate.billing_run-base_object',
+        'billing_run', 'property', 'Properties', readonly=True,
+        help="The properties in the scope of the billing run.")
+    billing_units = fields.One2Many('real_estate.billing_unit',
+        'billing_run', 'Billing Units', readonly=True)
+    started_at = fields.DateTime('Started at', readonly=True)
+    finished_at = fields.DateTime('Finished at', readonly=True)
+    duration = fields.Function(fields.TimeDelta('Duration'), 'get_duration')
+    error_message = fields.Text('Error Message', readonly=True)
+
+    property_count = fields.Integer('Properties', readonly=True)
+    properties_done = fields.Integer('Properties Done', readonly=True)
+    billing_unit_count = fields.Integer('Billing Units', readonly=True)
+    settlement_result_count = fields.Integer('Settlement Results',
+        readonly=True)
+    invoice_count = fields.Integer('Invoices', readonly=True)
+    invoice_line_count = fields.Integer('Invoice Lines', readonly=True)
+    move_count = fields.Integer('Moves', readonly=True,
+        help="Number of account moves of the owner-borne costs.")
+    billing_unit_moves_count = fields.Integer('Billing Unit Moves',
+        readonly=True)
+
+    duration_checks = fields.TimeDelta('Checks', readonly=True)
+    duration_aggregation = fields.TimeDelta('Aggregation', readonly=True)
+    duration_invoices = fields.TimeDelta('Invoice Build', readonly=True)
+    duration_posting = fields.TimeDelta('Posting', readonly=True)
+    duration_moves = fields.TimeDelta('Moves', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('id', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_name(cls):
+        return (f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
+            f"-U{Transaction().user}")
+
+    @classmethod
+    def create(cls, vlist):
+        runs = super().create(vlist)
+        # Runs created in the same second by the same user are told apart
+        # by their id
+        to_write = []
+        for run in runs:
+            to_write.extend([[run], {'name': f'{run.name}-{run.id}'}])
+        if to_write:
+            cls.write(*to_write)
+        return runs
+
+    def get_duration(self, name):
+        if self.started_at and self.finished_at:
+            return self.finished_at - self.started_at
+
+    def add_metrics(self, durations, counts):
+        "Add the stage durations (in seconds) and row counts of a billing"
+        for stage, seconds in durations.items():
+            name = f'duration_{stage}'
+            setattr(self, name, (getattr(self, name) or datetime.timedelta())
+                + datetime.timedelta(seconds=seconds))
+        for key, count in counts.items():
+            name = f'{key}_count'
+            setattr(self, name, (getattr(self, name) or 0) + count)
+
+    @classmethod
+    def write_detached(cls, run_id, values):
+        """Write values on the run in a transaction of its own.
+
+        Used by queued billing jobs so the failure of a job remains recorded
+        on its run."""
+        try:
+            with Transaction().new_transaction():
+                cls.write([cls(run_id)], values)
+        except Exception:
+            logger.critical(
+                "failed to update billing run %s", run_id, exc_info=True)
+
+
+class BillingRunProperty(ModelSQL):
+    "Billing Run - Property"
+    __name__ = 'real_estate.billing_run-base_object'
+
+    billing_run = fields.Many2One('real_estate.billing_run', 'Billing Run',
+        required=True, ondelete='CASCADE')
+    property = fields.Many2One('real_estate.base_object', 'Property',
+        required=True, ondelete='CASCADE')
+
+
 #**********************************************************************
 class BillingUnitContext(ModelView):
     'Billing Unit Context'
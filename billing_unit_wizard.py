@@ -4,7 +4,7 @@ from trytond.model.exceptions import ValidationError
 from trytond.i18n import gettext
 from trytond.pool import Pool
 from trytond.transaction import Transaction
-from trytond.pyson import Eval
+from trytond.pyson import Eval, If
 from trytond.wizard import (
     Button, StateTransition, StateView, Wizard)
 from trytond.transaction import check_access, without_check_access
@@ -261,30 +261,25 @@ class CancelBillingStart(ModelView):
             ('type', '=', 'property'),
             ('company', '=', Eval('company', -1)),
         ])
-    billing_run_id = fields.Selection('get_billing_run_ids', 'Billing Run ID',
+    billing_run = fields.Many2One('real_estate.billing_run', 'Billing Run',
         required=True,
-        help="Only billing run IDs of billed billing units matching "
+        domain=[
+            ('billing_units.state', '=', 'billed'),
+            ('billing_units.property.company', '=', Eval('company', -1)),
+            If(Eval('property', None),
+                [('billing_units.property', '=', Eval('property', None))],
+                []),
+        ],
+        help="Only billing runs with billed billing units matching "
              "Company/Property above are shown. All billed billing units "
-             "with this billing run ID will be cancelled.")
+             "of this billing run (of the property, if set) will be "
+             "cancelled.")
     invoice_date = fields.Date('Invoice Date', required=True,
         help="Reference date for this cancellation, recorded in the "
              "billing unit log. The date of the reversal accounting "
              "move itself is determined automatically by the "
              "accounting module.")
 
-    @fields.depends('company', 'property')
-    def get_billing_run_ids(self):
-        pool = Pool()
-        BillingUnit = pool.get('real_estate.billing_unit')
-        domain = [('state', '=', 'billed'), ('billing_run_id', '!=', None)]
-        if self.company:
-            domain.append(('company', '=', self.company.id))
-        if self.property:
-            domain.append(('property', '=', self.property.id))
-        units = BillingUnit.search(domain)
-        run_ids = sorted({u.billing_run_id for u in units if u.billing_run_id})
-        return [(run_id, run_id) for run_id in run_ids]
-
     @staticmethod
     def default_invoice_date():
         return Pool().get('ir.date').today()
@@ -317,6 +312,17 @@ class CancelBillingStart(ModelView):
             return billing_unit.property.id if billing_unit.property else None
         return None
 
+    @classmethod
+    def default_billing_run(cls):
+        pool = Pool()
+        context = Transaction().context
+        active_id = context.get('active_id')
+        if active_id and context.get('active_model') == 'real_estate.billing_unit':
+            billing_unit = pool.get('real_estate.billing_unit')(active_id)
+            if billing_unit.state == 'billed' and billing_unit.billing_run:
+                return billing_unit.billing_run.id
+        return None
+
 
 #**********************************************************************
 class CancelBillingWizard(Wizard):
@@ -333,21 +339,29 @@ class CancelBillingWizard(Wizard):
     def transition_do_cancel(self):
         pool = Pool()
         BillingUnit = pool.get('real_estate.billing_unit')
+        BillingUnitLog = pool.get('real_estate.billing_unit.log')
 
-        units = BillingUnit.search([
-            ('billing_run_id', '=', self.start.billing_run_id),
+        run = self.start.billing_run
+        domain = [
+            ('billing_run', '=', run.id),
             ('state', '=', 'billed'),
-        ])
+        ]
+        if self.start.property:
+            domain.append(('property', '=', self.start.property.id))
+        units = BillingUnit.search(domain)
         if not units:
             raise ValidationError(gettext(
                 'real_estate.msg_cancel_billing_no_units_found',
-                billing_run_id=self.start.billing_run_id))
+                billing_run_id=run.name))
 
         BillingUnit.cancel_units(units, invoice_date=self.start.invoice_date)
-        for unit in units:
-            unit.add_log('cancel_billing_wizard',
-                f'Billing cancelled via wizard (billing_run_id='
-                f'{self.start.billing_run_id}). Reference invoice date: '
-                f'{self.start.invoice_date}.')
+        BillingUnitLog.create([{
+                    'billing_unit': unit.id,
+                    'event': 'cancel_billing_wizard',
+                    'description': (
+                        f'Billing cancelled via wizard (billing_run_id='
+                        f'{run.name}). Reference invoice date: '
+                        f'{self.start.invoice_date}.'),
+                    } for unit in units])
 
         return 'end'
@@ -11,11 +11,11 @@ from trytond import backend
 from trytond.modules.currency.fields import Monetary
 from trytond.modules.company.model import (
     employee_field, reset_employee, set_employee)
-from trytond.tools import sqlite_apply_types
+from trytond.tools import grouped_slice, sqlite_apply_types
 from trytond.transaction import without_check_access
 
 from sql import Column, Null
-from sql.aggregate import Sum, Count, Min
+from sql.aggregate import Sum, Count, Max, Min
 from sql.conditionals import Coalesce
 from collections import defaultdict
 from itertools import groupby
@@ -30,7 +30,9 @@ from trytond.modules.account.common import ActivePeriodMixin
 
 logger = logging.getLogger(__name__)
 
-_chunk_size = 100
+# Upper bound of the estimated cost of one create_moves job
+# (see call_create_moves)
+_create_moves_job_cost = 200
 
 
 #**********************************************************************
@@ -557,7 +559,7 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
         'on_change_with_next_term_sequence')
 
     cash_flow_draft = fields.Function(
-        fields.One2Many('real_estate.contract.term.cash_flow', None, 'Cash Flow draft', readonly=True),
+        fields.One2Many('real_estate.contract.term.cash_flow', None, 'Cash Flow Not Posted', readonly=True),
         'on_change_with_cash_flow_draft', setter='set_cash_flow')
 
     cash_flow_pending = fields.One2Many('account.invoice', 'contract', 'Cash Flow Pending',
@@ -773,12 +775,6 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
                         key,
                         gettext('real_estate.msg_cancel_contract_has_postings',
                             contract.rec_name))
-            draft_flows = CashFlow.search([
-                ('term.contract', '=', contract.id),
-                ('state', '=', 'draft'),
-            ])
-            if draft_flows:
-                CashFlow.delete(draft_flows)
             contract.add_log('state_change', 'contract state changed to cancelled')
             contract.state = 'cancelled'
             contract.save()
@@ -792,10 +788,7 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
 
     @classmethod
     def _refresh_occupancy_for_contracts(cls, contracts):
-        pool = Pool()
-        BaseObjectOccupancy = pool.get('real_estate.base_object.occupancy')
-        BaseObject = pool.get('real_estate.base_object')
-        ContractItem = pool.get('real_estate.contract.item')
+        BaseObject = Pool().get('real_estate.base_object')
         base_object_ids = set()
         for contract in contracts:
             for item in contract.items:
@@ -803,8 +796,8 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
                     if item_obj.object:
                         base_object_ids.add(item_obj.object.id)
         if base_object_ids:
-            BaseObjectOccupancy.refresh(BaseObject.browse(list(base_object_ids)))
-            ContractItem._trigger_billing_unit_selection(base_object_ids)
+            BaseObject._mark_dirty(
+                occupancy_ids=base_object_ids, selection_ids=base_object_ids)
 
     _COMPUTE_VALUE_SHARES_FIELDS = frozenset({
         'state', 'start_date', 'end_date',
@@ -843,13 +836,9 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
                 for c in records:
                     re_calc_ids.add(c.id)
         if occ_ids:
-            fresh = cls.browse(list(occ_ids))
-            cls._refresh_occupancy_for_contracts(fresh)
-            BaseObject = Pool().get('real_estate.base_object')
-            property_ids = {c.property.id for c in fresh if c.property}
-            if property_ids:
-                BaseObject.compute_value_shares(
-                    BaseObject.browse(list(property_ids)))
+            # The re-selection of the settlement units covering the objects
+            # of the contracts also recomputes their value shares
+            cls._refresh_occupancy_for_contracts(cls.browse(list(occ_ids)))
         if re_calc_ids and not Transaction().context.get('_skip_re_calc'):
             cls._re_calc_terms(cls.browse(list(re_calc_ids)))
 
@@ -960,6 +949,8 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
 
     @fields.depends('terms')
     def on_change_with_cash_flow_draft(self, name=None):
+        # The stored cash flows whose invoice is not posted yet, the planned
+        # ones are projected by ContractTerm.get_projected_cash_flows
         def _is_draft(cf):
             if not cf.invoice_line:
                 return True
@@ -969,6 +960,14 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
             [cf for term in self.terms for cf in term.cash_flow if _is_draft(cf)],
             key=lambda line: (line.document_date, line.posting_date, line.name))
 
+    def get_projected_cash_flows(self, end_date=None):
+        """Return the draft cash flows of all terms up to end_date in
+        document date order (see ContractTerm.get_projected_cash_flows)"""
+        return sorted(
+            (cf for term in self.terms
+                for cf in term.get_projected_cash_flows(end_date)),
+            key=lambda cf: (cf.document_date, cf.name))
+
     def add_log(self, event, description=None):
         pool = Pool()
         ContractLog = pool.get('real_estate.contract.log')
@@ -1167,11 +1166,15 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
             ('contractual_partner.name',) + tuple(clause[1:]),
         ]
 
-    def _create_moves(self, terms, date, invoice_state='draft', invoice_date=None, run_id=None):
+    def _get_moves(self, terms, date, invoice_date=None, run_id=None):
+        """Build the invoices of the terms up to date in memory.
+
+        Returns the unsaved invoices, their unsaved lines and the projected
+        cash flows they invoice, to be persisted by _save_moves."""
         self.add_log('process', f'start quere contract {self.id} at {date}')
         if not terms:
             self.add_log('process', f'stop quere contract {self.id} at {date} - no terms')
-            return
+            return [], [], []
 
         # run_id is normally generated once per property by the caller
         # (call_create_moves), so all contracts of that property share it.
@@ -1183,142 +1186,116 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
         pool = Pool()
         Invoice = pool.get('account.invoice')
         InvoiceLine = pool.get('account.invoice.line')
+        ContractTerm = pool.get('real_estate.contract.term')
         Configuration = pool.get('account.configuration')
         config = Configuration(1)
 
         lines_by_date = defaultdict(
             lambda: {'lines': [], 'document_date': None, 'due_date': None})
+        cash_flows = []
 
+        terms_by_id = {t.id: t for t in self.terms}
         for term_id in terms:
-            term = next(
-                (obj for obj in self.terms if obj.id == term_id), None)
-            if term:
-                taxes = set(term.taxes)
-                l_account = term.account.id if term.account \
-                    else config.account_revenue.id if self.c_type.invoice_type == 'out' \
-                    else config.account_expense.id
-
-                for cash_flow in term.cash_flow:
-                    if cash_flow.document_date <= date and cash_flow.state == 'draft':
-                        ref_item = term.reference_item
-                        m_type = (term.term_type.m_type
-                            if term.term_type else None)
-
-                        # Build per-object lines when measurement-based and
-                        # multiple objects are assigned; otherwise single line.
-                        if (ref_item and m_type
-                                and ref_item.objects
-                                and len(ref_item.objects) > 1):
-                            from .contract_term import ContractTerm
-                            per_obj_lines = []
-                            for item_obj in ref_item.objects:
-                                obj = item_obj.object
-                                if not obj:
-                                    continue
-                                obj_qty = ContractTerm._sum_measurements(
-                                    type('_R', (), {'objects': [item_obj]})(),
-                                    m_type,
-                                    cash_flow.document_date)
-                                if not obj_qty:
-                                    self.add_log('warning',
-                                        f'term "{term.name}": object '
-                                        f'"{obj.name}" has no matching '
-                                        f'measurement "{m_type.name}" for '
-                                        f'{cash_flow.document_date} - no '
-                                        f'invoice line created for this '
-                                        f'object.')
-                                    continue
-                                line = InvoiceLine(
-                                    type='line',
-                                    company=self.company.id,
-                                    party=self.contractual_partner.id,
-                                    invoice_type=self.c_type.invoice_type,
-                                    description=(
-                                        cash_flow.name + ' – ' + obj.name),
-                                    quantity=obj_qty,
-                                    unit=term.unit,
-                                    unit_price=term.unit_price,
-                                    account=l_account,
-                                    currency=self.currency.id,
-                                    taxes=list(taxes),
-                                    contract=self,
-                                    term=term,
-                                    base_object=obj.id,
-                                    assignment_control='contract',
-                                )
-                                line.save()
-                                per_obj_lines.append(line)
-                            if not per_obj_lines:
-                                # No object had a measurement — fall through to
-                                # single-line behaviour below
-                                pass
-                            else:
-                                cash_flow.state = 'done'
-                                cash_flow.posting_date = cash_flow.document_date
-                                cash_flow.create_moves_run_id = create_moves_run_id
-                                group = lines_by_date[cash_flow.posting_date]
-                                group['lines'].extend(per_obj_lines)
-                                if group['document_date'] is None:
-                                    group['document_date'] = cash_flow.document_date
-                                    group['due_date'] = cash_flow.due_date
-                                # link first line to cash_flow for traceability
-                                cash_flow.invoice_line = per_obj_lines[0]
-                                cash_flow.save()
-                                term.last_posting_date = cash_flow.posting_date
-                                continue
-
-                        # Default: single invoice line
-                        first_obj = (
-                            ref_item.objects[0].object
-                            if ref_item and ref_item.objects else None)
-                        if (m_type and not term.quantity
-                                and not (ref_item and ref_item.objects
-                                    and len(ref_item.objects) > 1)):
+            term = terms_by_id.get(term_id)
+            if not term:
+                continue
+            taxes = list(term.taxes)
+            l_account = term.account.id if term.account \
+                else config.account_revenue.id if self.c_type.invoice_type == 'out' \
+                else config.account_expense.id
+            ref_item = term.reference_item
+            m_type = term.term_type.m_type if term.term_type else None
+
+            for cash_flow in term.get_projected_cash_flows(date):
+                # Build per-object lines when measurement-based and
+                # multiple objects are assigned; otherwise single line.
+                new_lines = []
+                if (ref_item and m_type
+                        and ref_item.objects
+                        and len(ref_item.objects) > 1):
+                    for item_obj in ref_item.objects:
+                        obj = item_obj.object
+                        if not obj:
+                            continue
+                        obj_qty = ContractTerm._sum_measurements(
+                            type('_R', (), {'objects': [item_obj]})(),
+                            m_type,
+                            cash_flow.document_date)
+                        if not obj_qty:
                             self.add_log('warning',
-                                f'term "{term.name}": no assigned object '
-                                f'has a matching measurement "{m_type.name}" '
-                                f'for {cash_flow.document_date} - quantity '
-                                f'defaulted to {term.quantity or 0}.')
-                        new_invoice_line = InvoiceLine(
+                                f'term "{term.name}": object '
+                                f'"{obj.name}" has no matching '
+                                f'measurement "{m_type.name}" for '
+                                f'{cash_flow.document_date} - no '
+                                f'invoice line created for this '
+                                f'object.')
+                            continue
+                        new_lines.append(InvoiceLine(
                             type='line',
                             company=self.company.id,
                             party=self.contractual_partner.id,
                             invoice_type=self.c_type.invoice_type,
-                            description=cash_flow.name,
-                            quantity=term.quantity,
+                            description=(
+                                cash_flow.name + ' – ' + obj.name),
+                            quantity=obj_qty,
                             unit=term.unit,
                             unit_price=term.unit_price,
                             account=l_account,
                             currency=self.currency.id,
-                            taxes=list(taxes),
+                            taxes=taxes,
                             contract=self,
                             term=term,
-                            base_object=first_obj.id if first_obj else None,
+                            base_object=obj.id,
                             assignment_control='contract',
-                        )
-                        new_invoice_line.save()
-
-                        cash_flow.state = 'done'
-                        cash_flow.posting_date = cash_flow.document_date
-                        cash_flow.create_moves_run_id = create_moves_run_id
-                        group = lines_by_date[cash_flow.posting_date]
-                        group['lines'].append(new_invoice_line)
-                        if group['document_date'] is None:
-                            group['document_date'] = cash_flow.document_date
-                            group['due_date'] = cash_flow.due_date
-
-                        cash_flow.invoice_line = new_invoice_line
-                        cash_flow.save()
-
-                        term.last_posting_date = cash_flow.posting_date
-                        term.last_document_date = cash_flow.document_date
-                        term.next_document_date = term.on_change_with_next_document_date()
-                        term.next_due_date = term.on_change_with_next_due_date()
-                        term.save()
+                        ))
+
+                if not new_lines:
+                    # Default: single invoice line, also when no object
+                    # had a measurement
+                    first_obj = (
+                        ref_item.objects[0].object
+                        if ref_item and ref_item.objects else None)
+                    if (m_type and not term.quantity
+                            and not (ref_item and ref_item.objects
+                                and len(ref_item.objects) > 1)):
+                        self.add_log('warning',
+                            f'term "{term.name}": no assigned object '
+                            f'has a matching measurement "{m_type.name}" '
+                            f'for {cash_flow.document_date} - quantity '
+                            f'defaulted to {term.quantity or 0}.')
+                    new_lines.append(InvoiceLine(
+                        type='line',
+                        company=self.company.id,
+                        party=self.contractual_partner.id,
+                        invoice_type=self.c_type.invoice_type,
+                        description=cash_flow.name,
+                        quantity=term.quantity,
+                        unit=term.unit,
+                        unit_price=term.unit_price,
+                        account=l_account,
+                        currency=self.currency.id,
+                        taxes=taxes,
+                        contract=self,
+                        term=term,
+                        base_object=first_obj.id if first_obj else None,
+                        assignment_control='contract',
+                    ))
+
+                cash_flow.state = 'done'
+                cash_flow.posting_date = cash_flow.document_date
+                cash_flow.create_moves_run_id = create_moves_run_id
+                group = lines_by_date[cash_flow.posting_date]
+                group['lines'].extend(new_lines)
+                if group['document_date'] is None:
+                    group['document_date'] = cash_flow.document_date
+                    group['due_date'] = cash_flow.due_date
+                # link first line to cash_flow for traceability
+                cash_flow.invoice_line = new_lines[0]
+                cash_flows.append(cash_flow)
 
         if not lines_by_date:
             self.add_log('process', f'contract {self.id} - no term computed')
-            return
+            return [], [], []
 
         if self.c_type.invoice_type == 'out':
             l_account = (
@@ -1335,6 +1312,7 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
                 if self.contractual_partner.account_payable
                 else config.default_account_payable.id)
 
+        invoices, lines = [], []
         for posting_date, group in sorted(lines_by_date.items()):
             invoice_lines = sorted(group['lines'], key=lambda l: l.description)
             document_date = group['document_date']
@@ -1357,52 +1335,179 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
                 payment_term=self.payment_term.id if self.payment_term else None,
                 description=f'{l_description} - {posting_date.strftime("%Y-%m-%d")}',
                 reference=self.contract_number,
-                lines=invoice_lines,
                 contract=self,
             )
-            Invoice.save([invoice])
-            if invoice_state == 'posted':
-                with Transaction().set_context(_skip_warnings=True):
-                    Invoice.post([invoice])
-            self.add_log('process',
-                f'contract {self.id} / invoice {invoice.id} saved'
-                f' (state={invoice_state}, posting_date={posting_date}).')
+            for line in invoice_lines:
+                line.invoice = invoice
+            invoices.append(invoice)
+            lines.extend(invoice_lines)
+        return invoices, lines, cash_flows
+
+    @classmethod
+    def _save_moves(cls, moves, invoice_state='draft'):
+        """Persist the moves built by _get_moves for several contracts.
+
+        moves is a list of (contract, invoices, lines, cash_flows). The
+        invoices, the invoice lines, the cash flows, the posting and the
+        contract logs are each written with one call for all the contracts."""
+        pool = Pool()
+        ContractLog = pool.get('real_estate.contract.log')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        CashFlow = pool.get('real_estate.contract.term.cash_flow')
+
+        invoices = [i for _, invoices, _, _ in moves for i in invoices]
+        if not invoices:
+            return
+        # The lines are created after their invoices and before the cash
+        # flows which link to them
+        Invoice.save(invoices)
+        InvoiceLine.save([l for _, _, lines, _ in moves for l in lines])
+        Invoice.update_taxes(invoices)
+        CashFlow.save(
+            [cf for _, _, _, cash_flows in moves for cf in cash_flows])
+        if invoice_state == 'posted':
+            with Transaction().set_context(_skip_warnings=True):
+                Invoice.post(invoices)
+        ContractLog.create([{
+                    'contract': contract.id,
+                    'event': 'process',
+                    'description': (
+                        f'contract {contract.id} / invoice {invoice.id} saved'
+                        f' (state={invoice_state},'
+                        f' posting_date={invoice.accounting_date}).'),
+                    }
+                for contract, invoices, _, _ in moves
+                for invoice in invoices])
 
     @classmethod
     def call_create_moves(cls, contract_ids, date, action='re_calc', execute_in_queue=True, invoice_state='draft', invoice_date=None):
-        """call create_moves in queue or directly based on execute_in_queue flag"""
+        """call create_moves in queue or directly based on execute_in_queue flag
+
+        The contracts are grouped by property into jobs whose estimated cost
+        stays below _create_moves_job_cost (see _create_moves_costs); the
+        contracts of a property more expensive than that are spread over
+        several jobs. The most expensive jobs are run (or expected to be run
+        by the workers) first."""
         if len(contract_ids) > 0:
+            costs, contract_properties = cls._create_moves_costs(
+                contract_ids, date)
+
             # One run ID per property, generated once for this whole wizard
-            # invocation (before chunking/queueing), so that all contracts
+            # invocation (before partitioning/queueing), so that all contracts
             # of the same property share the same create_moves_run_id even
-            # if they end up in different chunks/queued jobs.
+            # if they end up in different queued jobs.
             property_run_ids = {}
-            for contract in cls.browse(contract_ids):
-                prop_id = str(contract.property.id)
+            property_contracts = defaultdict(list)
+            for contract_id in contract_ids:
+                prop_id = str(contract_properties[contract_id])
                 if prop_id not in property_run_ids:
                     property_run_ids[prop_id] = (
                         f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}"
                         f"-U{Transaction().user}")
-
-            chunks = [contract_ids[i:i+_chunk_size] for i in range(0, len(contract_ids), _chunk_size)]
-            for chunk in chunks:
+                property_contracts[prop_id].append(contract_id)
+
+            property_costs = {
+                prop_id: sum(costs[c] for c in ids)
+                for prop_id, ids in property_contracts.items()}
+            jobs = []
+            for prop_ids in base_object.partition_by_cost(
+                    property_costs, _create_moves_job_cost):
+                if (len(prop_ids) == 1
+                        and property_costs[prop_ids[0]]
+                        > _create_moves_job_cost):
+                    jobs.extend(base_object.partition_by_cost(
+                            {c: costs[c]
+                                for c in property_contracts[prop_ids[0]]},
+                            _create_moves_job_cost))
+                else:
+                    jobs.append([c for prop_id in prop_ids
+                            for c in property_contracts[prop_id]])
+            jobs.sort(key=lambda j: sum(costs[c] for c in j), reverse=True)
+
+            transaction = Transaction()
+            context = transaction.context
+            for index, job in enumerate(jobs):
+                logger.info('create moves job %s/%s: %s contracts, cost %s',
+                    index + 1, len(jobs), len(job),
+                    sum(costs[c] for c in job))
+                run_ids = {
+                    str(contract_properties[c]):
+                    property_run_ids[str(contract_properties[c])]
+                    for c in job}
                 if execute_in_queue:
-                    transaction = Transaction()
-                    context = transaction.context
+                    # Jobs are already sized, do not let the queue split them
                     with transaction.set_context(
-                        queue_batch=context.get('queue_batch', True)):
+                            queue_batch=False,
+                            queue_expected_at=context.get(
+                                'queue_expected_at',
+                                datetime.timedelta(seconds=index))):
                         cls.__queue__.create_moves(
-                            chunk, date, action, invoice_state, invoice_date,
-                            property_run_ids)
+                            job, date, action, invoice_state, invoice_date,
+                            run_ids)
                 else:
                     cls.create_moves(
-                        chunk, date, action, invoice_state, invoice_date,
-                        property_run_ids)
+                        job, date, action, invoice_state, invoice_date,
+                        run_ids)
+
+    @classmethod
+    def _create_moves_costs(cls, contract_ids, date):
+        """Return the estimated create_moves cost per contract id and the
+        property id per contract id.
+
+        The cost is one for the contract plus the draft cash flows of its
+        terms up to date: the document dates of the rhythm following the
+        last invoiced one (or the start of the term)."""
+        pool = Pool()
+        ContractTerm = pool.get('real_estate.contract.term')
+        CashFlow = pool.get('real_estate.contract.term.cash_flow')
+        cursor = Transaction().connection.cursor()
+        contract = cls.__table__()
+        term = ContractTerm.__table__()
+        cash_flow = CashFlow.__table__()
+
+        costs = dict.fromkeys(contract_ids, 1)
+        contract_properties = {}
+        terms = {}
+        for sub_ids in grouped_slice(contract_ids, backend.MAX_QUERY_PARAMS):
+            sub_ids = list(sub_ids)
+            cursor.execute(*contract.select(contract.id, contract.property,
+                    where=fields.SQL_OPERATORS['in'](contract.id, sub_ids)))
+            contract_properties.update(cursor)
+
+            query = term.join(cash_flow, 'LEFT',
+                condition=(cash_flow.term == term.id)
+                & (cash_flow.state == 'done')
+                ).select(
+                    term.id.as_('term'),
+                    term.contract.as_('contract'),
+                    Max(cash_flow.document_date).as_('last_document_date'),
+                    where=fields.SQL_OPERATORS['in'](term.contract, sub_ids),
+                    group_by=[term.id, term.contract])
+            if backend.name == 'sqlite':
+                sqlite_apply_types(query, [None, None, 'DATE'])
+            cursor.execute(*query)
+            for term_id, contract_id, last_document_date in cursor:
+                terms[term_id] = (contract_id, last_document_date)
+
+        for term in ContractTerm.browse(list(terms)):
+            contract_id, last_document_date = terms[term.id]
+            anchor = last_document_date or term.valid_from
+            if not anchor or anchor > date:
+                continue
+            schedule = term._get_rhythm_schedule()
+            pending = int(last_document_date is None)
+            if schedule.periodic:
+                end = min(date, term.valid_to or date)
+                pending += len(schedule.dates(anchor, end))
+            costs[contract_id] += pending
+        return costs, contract_properties
 
     @classmethod
     def create_moves(cls, contract_ids, date, action='re_calc', invoice_state='draft', invoice_date=None, property_run_ids=None):
         """Calculate and Create all account move on contract before a date."""
         property_run_ids = property_run_ids or {}
+        moves = []
         for contract_id in contract_ids:
             contract = cls(contract_id)
             contract.add_log('process', f'start "create_moves" with date {date} and action {action}')
@@ -1434,9 +1539,13 @@ class Contract(Workflow, DeactivableMixin, base_object.re_sequence_ordered(), Mo
 
             if len(process_terms) > 0 and action in ('create', 're_calc_and_create'):
                 run_id = property_run_ids.get(str(contract.property.id))
-                cls._create_moves(
-                    contract, process_terms, date, invoice_state,
-                    invoice_date, run_id)
+                invoices, lines, cash_flows = contract._get_moves(
+                    process_terms, date, invoice_date, run_id)
+                if invoices:
+                    moves.append((contract, invoices, lines, cash_flows))
 
             contract.add_log('process', f'"create_moves" finished')
             contract.save()
+
+        # The invoices of all the contracts are written together
+        cls._save_moves(moves, invoice_state)
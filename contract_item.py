@@ -303,6 +303,9 @@ class ContractItem(sequence_ordered(), ModelSQL, ModelView, metaclass=PoolMeta):
 
         pool = Pool()
         BaseObjectOccupancy = pool.get('real_estate.base_object.occupancy')
+        BaseObject = pool.get('real_estate.base_object')
+        BaseObject._flush_occupancy(
+            [o.object.id for o in item.objects if o.object])
 
         for item_obj in item.objects:
             if not item_obj.object:
@@ -370,11 +373,9 @@ class ContractItem(sequence_ordered(), ModelSQL, ModelView, metaclass=PoolMeta):
     def _refresh_occupancy_by_ids(cls, base_object_ids):
         if not base_object_ids:
             return
-        pool = Pool()
-        BaseObjectOccupancy = pool.get('real_estate.base_object.occupancy')
-        BaseObject = pool.get('real_estate.base_object')
-        BaseObjectOccupancy.refresh(BaseObject.browse(list(base_object_ids)))
-        cls._trigger_billing_unit_selection(base_object_ids)
+        BaseObject = Pool().get('real_estate.base_object')
+        BaseObject._mark_dirty(
+            occupancy_ids=base_object_ids, selection_ids=base_object_ids)
 
     @classmethod
     def _trigger_billing_unit_selection(cls, base_object_ids):
@@ -389,10 +390,20 @@ class ContractItem(sequence_ordered(), ModelSQL, ModelView, metaclass=PoolMeta):
             ('property', 'in', list(property_ids)),
             ('state', 'in', ['approved', 'selection', 'value_share']),
         ])
-        if not billing_units:
+        # only settlement units covering one of the changed objects
+        base_object_ids = set(base_object_ids)
+        settlement_units = [su
+            for bu in billing_units for su in bu.settlement_units
+            if base_object_ids & {o.id for o in su.objects}]
+        if not settlement_units:
             return
-        BillingUnit.selection(billing_units)
+        billing_units = list(
+            {su.billing_unit.id: su.billing_unit
+                for su in settlement_units}.values())
+        BillingUnit._selection(
+            billing_units, settlement_units=settlement_units)
         refreshed = BillingUnit.browse([bu.id for bu in billing_units])
         compute_units = [bu for bu in refreshed if bu.state in ('selection', 'value_share')]
         if compute_units:
-            BillingUnit.compute_value_shares_button(compute_units)
+            BillingUnit._compute_value_shares(
+                compute_units, settlement_units=settlement_units)
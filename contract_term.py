@@ -4,13 +4,14 @@ from trytond.model import (sequence_ordered,
 from trytond.model.exceptions import ValidationError
 from trytond.i18n import gettext
 from trytond.pool import Pool
-from trytond.transaction import Transaction
+from trytond.transaction import Transaction, inactive_records
 from trytond.pyson import Eval, If
 from trytond import backend
 from trytond.modules.currency.fields import Monetary
 from trytond.modules.account.tax import TaxableMixin
 from trytond.modules.product import price_digits
 
+from sql import Null
 from dateutil.relativedelta import relativedelta
 
 import logging
@@ -51,6 +52,106 @@ class Quantitative(fields.Numeric):
         return definition
 
 
+#**********************************************************************
+class RhythmSchedule(object):
+    """Document dates of a contract term rhythm.
+
+    The date following a document date is the date advanced by one period
+    of the rhythm and moved to the rhythm start day of its month. Periods in
+    months (monthly, quarterly, annually and daily rhythms in multiples of
+    30 or 365 days) are computed in closed form for any index; weekly and
+    daily periods can move a date back within its month, so they are
+    stepped until the dates stop increasing. A rhythm without period
+    (one_time) has no following dates."""
+
+    def __init__(self, rhythm_type, rhythm, rhythm_start=None, start_day=None):
+        rhythm = rhythm or 0
+        self.rhythm_start = rhythm_start
+        self.start_day = start_day
+        self.months = self.days = None
+        if rhythm_type == 'monthly':
+            self.months = rhythm
+        elif rhythm_type == 'quarterly':
+            self.months = rhythm * 3
+        elif rhythm_type == 'annually':
+            self.months = rhythm * 12
+        elif rhythm_type == 'weekly':
+            self.days = rhythm * 7
+        elif rhythm_type == 'daily':
+            if rhythm % 365 == 0:
+                self.months = rhythm // 365 * 12
+            elif rhythm % 30 == 0:
+                self.months = rhythm // 30
+            else:
+                self.days = rhythm
+
+    @property
+    def periodic(self):
+        return self.months is not None or self.days is not None
+
+    def align(self, date):
+        "Return date moved to the rhythm start day of its month"
+        last_day = calendar.monthrange(date.year, date.month)[1]
+        if self.rhythm_start == 'term_start' and self.start_day:
+            return date.replace(day=min(self.start_day, last_day))
+        elif self.rhythm_start == 'month_end':
+            return date.replace(day=last_day)
+        elif self.rhythm_start == '15th_month':
+            return date.replace(day=15)
+        return date.replace(day=1)
+
+    def advance(self, date):
+        "Return date advanced by one period, not aligned"
+        if self.months is not None:
+            return date + relativedelta(months=self.months)
+        elif self.days is not None:
+            return date + datetime.timedelta(days=self.days)
+
+    def _month_date(self, anchor, index):
+        month = anchor.year * 12 + anchor.month - 1 + index * self.months
+        return self.align(datetime.date(month // 12, month % 12 + 1, 1))
+
+    def _step_dates(self, anchor):
+        date = anchor
+        while True:
+            following = self.align(self.advance(date))
+            if following <= date:
+                return
+            yield following
+            date = following
+
+    def date(self, anchor, index):
+        """Return the index-th date following anchor (anchor for 0) or None
+        if the dates stop increasing before"""
+        if index <= 0:
+            return anchor
+        elif self.months:
+            return self._month_date(anchor, index)
+        elif self.days is not None:
+            for i, date in enumerate(self._step_dates(anchor), 1):
+                if i == index:
+                    return date
+
+    def dates(self, anchor, end):
+        "Return the dates following anchor up to end included"
+        if self.months:
+            months = ((end.year - anchor.year) * 12
+                + end.month - anchor.month)
+            dates = [self._month_date(anchor, i)
+                for i in range(1, months // self.months + 1)]
+            if dates and dates[-1] > end:
+                dates.pop()
+            return dates
+        elif self.days is not None:
+            dates = []
+            for date in self._step_dates(anchor):
+                if date > end:
+                    break
+                dates.append(date)
+            return dates
+        return []
+
+
 #**********************************************************************
 class ContractTermTax(ModelSQL):
     __name__ = 'real_estate.contract.term.tax'
@@ -162,6 +263,21 @@ class ContractTermCashFlow(ModelView, ModelSQL):
         super().__setup__()
         cls._order = [('document_date', 'ASC'), ('posting_date', 'ASC')] + cls._order
 
+    @classmethod
+    def __register__(cls, module):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        exist = backend.TableHandler.table_exist(cls._table)
+        super().__register__(module)
+
+        # Migration from 8.0: draft cash flows are projected from the term,
+        # no longer stored
+        if exist:
+            draft = (table.state == 'draft') & (table.invoice_line == Null)
+            cursor.execute(*table.select(table.id, where=draft, limit=1))
+            if cursor.fetchone():
+                cursor.execute(*table.delete(where=draft))
+
     @classmethod
     def default_state(cls):
         return 'draft'
@@ -661,6 +777,13 @@ class ContractTerm(sequence_ordered(), ModelSQL, ModelView, TaxableMixin):
             Contract._re_calc_terms(Contract.browse(list(contract_ids)))
 
     def re_calc(self):
+        """Regenerate the cash flow of the term.
+
+        Only the done rows are stored: one per invoice line of the term. They
+        are matched with the existing rows by (document_date, invoice_line)
+        and only the missing rows are created, the obsolete ones deleted and
+        the changed ones updated, each in one call. The draft rows are
+        projected on demand by get_projected_cash_flows."""
         pool = Pool()
         InvoiceLine = pool.get('account.invoice.line')
         CashFlow = pool.get('real_estate.contract.term.cash_flow')
@@ -670,62 +793,103 @@ class ContractTerm(sequence_ordered(), ModelSQL, ModelView, TaxableMixin):
             ('assignment_control', '=', 'contract'),
             ])
 
-        for cash_flow in self.cash_flow:
-            CashFlow.delete([cash_flow])
-
+        targets = {}
         for invoice_line in invoice_lines:
-            is_found = next((e for e in self.cash_flow if e.invoice_line == invoice_line.id), None)
-            if is_found is None:
-                cash_flow = CashFlow(
-                    state='done',
-                    posting_date=invoice_line.invoice.accounting_date,
-                    document_date=invoice_line.invoice.invoice_date,
-                    due_date=invoice_line.invoice.payment_term_date,
-                    contract=self.contract.id,
-                    invoice=invoice_line.invoice.id,
-                    term=self.id,
-                    invoice_line=invoice_line.id,
-                    property=self.contract.property.id if self.contract else None,
-                    company=self.contract.company.id if self.contract else None,
-                    quantity=invoice_line.quantity,
-                    unit=invoice_line.unit.id if invoice_line.unit else None,
-                    unit_price=invoice_line.unit_price,
-                    )
-                cash_flow.save()
-
-            elif is_found is not None and invoice_line.invoice.state == 'cancelled':
-                    CashFlow.delete([is_found])
+            invoice = invoice_line.invoice
+            targets[(invoice.invoice_date, invoice_line.id)] = {
+                'state': 'done',
+                'posting_date': invoice.accounting_date,
+                'due_date': invoice.payment_term_date,
+                }
 
-        today = datetime.date.today()
-        today_plus_year = today.replace(year=today.year + _re_calc_year)
+        self.last_document_date = max(
+            (d for d, _ in targets if d is not None), default=None)
 
-        self.last_document_date = self.on_change_with_last_document_date()
-
-        my_last_document_date = self.last_document_date
-        my_next_document_date = self._next_document_date(calc_document_date=my_last_document_date)
-        while my_next_document_date is not None \
-            and (my_last_document_date is None or my_last_document_date < my_next_document_date) \
-            and self.total_amount != 0 \
-            and (not self.valid_from or my_next_document_date >= self.valid_from) \
-            and (not self.valid_to or my_next_document_date <= self.valid_to) \
-            and my_next_document_date <= today_plus_year:
-
-                cash_flow = CashFlow(
-                    state='draft',
-                    document_date=my_next_document_date,
-                    due_date=self._on_change_with_next_due_date(calc_document_date=my_next_document_date),
-                    contract=self.contract.id,
+        to_delete, to_save = [], []
+        for cash_flow in self.cash_flow:
+            values = targets.pop((cash_flow.document_date,
+                    cash_flow.invoice_line.id if cash_flow.invoice_line
+                    else None), None)
+            if values is None:
+                to_delete.append(cash_flow)
+                continue
+            changed = False
+            for name, value in values.items():
+                if getattr(cash_flow, name) != value:
+                    setattr(cash_flow, name, value)
+                    changed = True
+            if changed:
+                to_save.append(cash_flow)
+        for (document_date, invoice_line), values in targets.items():
+            to_save.append(CashFlow(
                     term=self.id,
-                    property=self.contract.property.id if self.contract else None,
-                    company=self.contract.company.id if self.contract else None,
-                    quantity=self.quantity,
-                    unit=self.unit.id if self.unit else None,
-                    unit_price=self.unit_price,
-                    )
-                cash_flow.save()
+                    document_date=document_date,
+                    invoice_line=invoice_line,
+                    **values))
+        if to_delete:
+            CashFlow.delete(to_delete)
+        if to_save:
+            CashFlow.save(to_save)
+
+    def get_projected_cash_flows(self, end_date=None):
+        """Return the draft cash flows of the term up to end_date.
+
+        The draft cash flows are not stored: the document dates follow from
+        the rhythm of the term after its last document date (or its start)
+        up to end_date, at most _re_calc_year ahead. They are returned as
+        unsaved records in document date order."""
+        pool = Pool()
+        CashFlow = pool.get('real_estate.contract.term.cash_flow')
 
-                my_last_document_date = my_next_document_date
-                my_next_document_date = self._next_document_date(calc_document_date=my_last_document_date)
+        if self.contract and self.contract.state == 'cancelled':
+            return []
+
+        today = datetime.date.today()
+        today_plus_year = today.replace(year=today.year + _re_calc_year)
+        if end_date is None or end_date > today_plus_year:
+            end_date = today_plus_year
+
+        # The document dates following the last invoiced one (or the start
+        # date) up to the end date, in one call
+        schedule = self._get_rhythm_schedule()
+        last_document_date = self.last_document_date
+        if last_document_date is None or not schedule.periodic:
+            first_document_date = self._next_document_date(
+                calc_document_date=last_document_date)
+            document_dates = [first_document_date]
+            if last_document_date is None and schedule.periodic:
+                document_dates += schedule.dates(
+                    first_document_date, end_date)
+        else:
+            document_dates = schedule.dates(last_document_date, end_date)
+
+        cash_flows = []
+        total_amount = self.total_amount
+        previous_date = last_document_date
+        for document_date in document_dates:
+            if previous_date is not None and schedule.periodic \
+                and self._is_after_end(schedule.advance(previous_date)):
+                break
+            if (previous_date is not None and previous_date >= document_date) \
+                or total_amount == 0 \
+                or (self.valid_from and document_date < self.valid_from) \
+                or (self.valid_to and document_date > self.valid_to) \
+                or document_date > end_date:
+                break
+
+            cash_flow = CashFlow(
+                term=self,
+                state='draft',
+                document_date=document_date,
+                due_date=self._on_change_with_next_due_date(
+                    calc_document_date=document_date),
+                posting_date=None,
+                invoice_line=None,
+                create_moves_run_id=None)
+            cash_flow.name = cash_flow.on_change_with_name()
+            cash_flows.append(cash_flow)
+            previous_date = document_date
+        return cash_flows
 
     def _get_taxes(self) -> dict:
         pool = Pool()
@@ -904,47 +1068,32 @@ class ContractTerm(sequence_ordered(), ModelSQL, ModelView, TaxableMixin):
         return self._on_change_with_next_due_date(calc_document_date=self.next_document_date)
 
     @fields.depends('rhythm', 'valid_from', 'last_document_date', 'rhythm_type', 'rhythm_start', 'contract',
-                    'unit_price', '_parent_contract.start_booking_date')
+                    'unit_price', '_parent_contract.start_booking_date',
+                    methods=['_get_rhythm_schedule', '_is_after_end'])
     def _next_document_date(self, calc_document_date=None):
-        def _check_valid_to(i_date: datetime.date):
-            if (self.valid_to is not None and self.valid_to < i_date and self.contract.start_booking_date < i_date) \
-                or (self.contract.get_effective_end_date() is not None and self.contract.get_effective_end_date() < i_date):
-                return self.last_document_date
-            else:
-                if self.rhythm_start == 'term_start' and i_date is not None:
-                    return i_date.replace(day=self.valid_from.day)
-
-                if self.rhythm_start == 'month_end' and i_date is not None:
-                    return i_date.replace(day=1) + relativedelta(months=1) - datetime.timedelta(days=1)
-
-                if self.rhythm_start == '15th_month' and i_date is not None:
-                    return i_date.replace(day=15)
-
-                return i_date.replace(day=1)
-
+        schedule = self._get_rhythm_schedule()
         my_document_Date = calc_document_date if calc_document_date is not None else self.last_document_date
 
-        if my_document_Date is not None:
-            if self.rhythm_type == 'monthly':
-                return _check_valid_to(my_document_Date + relativedelta(months=self.rhythm))
-
-            elif self.rhythm_type == 'weekly':
-                return _check_valid_to(my_document_Date + relativedelta(weeks=self.rhythm))
-
-            elif self.rhythm_type == 'daily':
-                if self.rhythm % 365 == 0:
-                    return _check_valid_to(my_document_Date + relativedelta(years=int(self.rhythm / 365)))
-                if self.rhythm % 30 == 0:
-                    return _check_valid_to(my_document_Date + relativedelta(months=int(self.rhythm / 30)))
-                return _check_valid_to(my_document_Date + relativedelta(days=self.rhythm))
+        if my_document_Date is not None and schedule.periodic:
+            if self._is_after_end(schedule.advance(my_document_Date)):
+                return self.last_document_date
+            next_date = schedule.date(my_document_Date, 1)
+            return next_date if next_date is not None else self.last_document_date
 
-            elif self.rhythm_type == 'quarterly':
-                return _check_valid_to(my_document_Date + relativedelta(months=self.rhythm * 3))
+        return self.contract.start_booking_date if (self.contract and self.contract.start_booking_date) else self.valid_from
 
-            elif self.rhythm_type == 'annually':
-                return _check_valid_to(my_document_Date + relativedelta(years=self.rhythm))
+    @fields.depends('rhythm', 'rhythm_type', 'rhythm_start', 'valid_from')
+    def _get_rhythm_schedule(self):
+        return RhythmSchedule(self.rhythm_type, self.rhythm, self.rhythm_start,
+            self.valid_from.day if self.valid_from else None)
 
-        return self.contract.start_booking_date if (self.contract and self.contract.start_booking_date) else self.valid_from
+    @fields.depends('valid_to', 'contract', '_parent_contract.start_booking_date')
+    def _is_after_end(self, date):
+        "Return whether a document date lies after the end of the term or contract"
+        end_date = self.contract.get_effective_end_date()
+        return ((self.valid_to is not None and self.valid_to < date
+                and self.contract.start_booking_date < date)
+            or (end_date is not None and end_date < date))
 
     @fields.depends('rhythm', 'valid_from', 'last_document_date', 'rhythm_type',
                     'unit_price', 'contract', '_parent_contract.start_booking_date',
@@ -1028,31 +1177,31 @@ class ContractTerm(sequence_ordered(), ModelSQL, ModelView, TaxableMixin):
         group), a fallback checks for any measurement with the same unit."""
         if not m_type:
             return None
-        MeasurementType = Pool().get('real_estate.measurement.type')
-        effective_ids = set(MeasurementType.get_effective_ids(m_type))
-        m_type_unit = m_type.unit
+        pool = Pool()
+        Measurement = pool.get('real_estate.measurement')
+        MeasurementType = pool.get('real_estate.measurement.type')
+        objects = [io.object for io in (ref_item.objects or []) if io.object]
+        if not objects:
+            return None
+        effective_ids = MeasurementType.get_effective_ids(m_type)
+        latest = Measurement.get_latest([
+                (o.id, effective_ids, reference_date) for o in objects])
+        missing = [o for o, measurements in zip(objects, latest)
+            if not measurements]
+        if missing and m_type.unit and not m_type.is_group:
+            with inactive_records():
+                unit_ids = [t.id for t in MeasurementType.search([
+                            ('unit', '=', m_type.unit.id),
+                            ('is_group', '=', False),
+                            ])]
+            fallback = Measurement.get_latest([
+                    (o.id, unit_ids, reference_date) for o in missing])
+            latest = [m for m in latest if m] + fallback
         total = None
-        for item_obj in (ref_item.objects or []):
-            obj = item_obj.object
-            if not obj or not obj.measurements:
-                continue
-            meas_sorted = sorted(
-                obj.measurements, key=lambda x: x.valid_from, reverse=True)
-            found = False
-            for meas in meas_sorted:
-                if (meas.m_type and meas.m_type.id in effective_ids and (
-                        reference_date is None
-                        or meas.valid_from <= reference_date)):
-                    total = (total or Decimal(0)) + Decimal(str(meas.value))
-                    found = True
-                    break
-            if not found and m_type_unit and not m_type.is_group:
-                for meas in meas_sorted:
-                    if (meas.m_type and meas.m_type.unit == m_type_unit and (
-                            reference_date is None
-                            or meas.valid_from <= reference_date)):
-                        total = (total or Decimal(0)) + Decimal(str(meas.value))
-                        break
+        for measurements in latest:
+            if measurements:
+                total = (total or Decimal(0)) + Decimal(
+                    str(measurements[0].value))
         return total
 
     @fields.depends('contract', 'taxes', 'term_type', '_parent_contract.c_type')
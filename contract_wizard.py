@@ -665,3 +665,95 @@ class ContractTermAdjustmentWizard(Wizard):
             'processed': self.result.processed,
             'message': self.result.message,
         }
+
+
+#**********************************************************************
+class ProjectedCashFlowsStart(ModelView):
+    'Projected Cash Flows - Start'
+    __name__ = 'real_estate.contract.projected_cash_flows.start'
+
+    contract = fields.Many2One('real_estate.contract', 'Contract',
+        readonly=True)
+    date = fields.Date('Up to Date', required=True)
+
+    @staticmethod
+    def default_date():
+        Date = Pool().get('ir.date')
+        return Date.today() + relativedelta(years=1)
+
+
+#**********************************************************************
+class ProjectedCashFlowsResult(ModelView):
+    'Projected Cash Flows - Result'
+    __name__ = 'real_estate.contract.projected_cash_flows.result'
+
+    contract = fields.Many2One('real_estate.contract', 'Contract',
+        readonly=True)
+    date = fields.Date('Up to Date', readonly=True)
+    cash_flows = fields.One2Many('real_estate.contract.projected_cash_flow',
+        None, 'Cash Flows', readonly=True)
+
+
+#**********************************************************************
+class ProjectedCashFlow(ModelView):
+    'Projected Cash Flow'
+    __name__ = 'real_estate.contract.projected_cash_flow'
+
+    document_date = fields.Date('Document Date', readonly=True)
+    due_date = fields.Date('Due Date', readonly=True)
+    name = fields.Char('Name', readonly=True)
+    term = fields.Many2One('real_estate.contract.term', 'Term',
+        readonly=True)
+    amount = Monetary('Amount', currency='currency', digits='currency',
+        readonly=True)
+    tax_amount = Monetary('Tax', currency='currency', digits='currency',
+        readonly=True)
+    total_amount = Monetary('Total', currency='currency', digits='currency',
+        readonly=True)
+    currency = fields.Many2One('currency.currency', 'Currency',
+        readonly=True)
+
+
+#**********************************************************************
+class ProjectedCashFlowsWizard(Wizard):
+    """Show the draft cash flows of a contract which are not stored but
+    projected from its terms up to a date"""
+    __name__ = 'real_estate.contract.projected_cash_flows.wizard'
+
+    start = StateView('real_estate.contract.projected_cash_flows.start',
+        'real_estate.contract_projected_cash_flows_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('OK', 'result', 'tryton-ok', True),
+        ])
+    result = StateView('real_estate.contract.projected_cash_flows.result',
+        'real_estate.contract_projected_cash_flows_result_view_form', [
+            Button('Close', 'end', 'tryton-ok', True),
+        ])
+
+    def default_start(self, fields):
+        return {
+            'contract': Transaction().context.get('active_id'),
+        }
+
+    def default_result(self, fields):
+        contract = self.start.contract
+        cash_flows = []
+        for cash_flow in contract.get_projected_cash_flows(self.start.date):
+            amounts = cash_flow.get_amount_and_tax(
+                ['tax_amount', 'total_amount'])
+            cash_flows.append({
+                    'document_date': cash_flow.document_date,
+                    'due_date': cash_flow.due_date,
+                    'name': cash_flow.name,
+                    'term': cash_flow.term.id,
+                    'amount': cash_flow.on_change_with_amount(),
+                    'tax_amount': amounts['tax_amount'],
+                    'total_amount': amounts['total_amount'],
+                    'currency': (contract.currency.id
+                        if contract.currency else None),
+                    })
+        return {
+            'contract': contract.id,
+            'date': self.start.date,
+            'cash_flows': cash_flows,
+        }
@@ -7,10 +7,14 @@ from trytond.cache import Cache
 from trytond.pool import Pool, PoolMeta
 from trytond.transaction import Transaction
 from trytond.pyson import Bool, Eval, If, Not, PYSONEncoder
-from sql import Column
+from trytond import backend
+from trytond.tools import grouped_slice
+from sql import Column, Values, Window
+from sql.functions import RowNumber
 
 from .base_object import BaseObject
 
+import datetime
 import logging
 
 logger = logging.getLogger(__name__)
@@ -166,12 +170,47 @@ class MeasurementType(DeactivableMixin, sequence_ordered(), ModelSQL, ModelView)
         return domains
 
 
+class LatestMeasurementCache(object):
+    """Hold the answers of Measurement.get_latest for one transaction.
+
+    They are dropped when a measurement or a base object is modified and
+    when the transaction commits or rolls back."""
+
+    def __init__(self):
+        self.answers = {}
+
+    def __eq__(self, other):
+        if not isinstance(other, LatestMeasurementCache):
+            return NotImplemented
+        return True
+
+    def __hash__(self):
+        return hash(LatestMeasurementCache)
+
+    def abort(self, trans):
+        self.answers.clear()
+
+    def tpc_begin(self, trans):
+        pass
+
+    def commit(self, trans):
+        pass
+
+    def tpc_vote(self, trans):
+        pass
+
+    def tpc_finish(self, trans):
+        self.answers.clear()
+
+    def tpc_abort(self, trans):
+        self.answers.clear()
+
+
 class Measurement(DeactivableMixin, ModelSQL, ModelView, metaclass=PoolMeta):
     "Measurement"
     __name__ = 'real_estate.measurement'
     _rec_name = 'name'
 
-
     base_object = fields.Many2One('real_estate.base_object', 
         "Base Object", required=True, path='path', ondelete='CASCADE',)
     valid_from = fields.Date('From', required=True)
@@ -258,6 +297,74 @@ class Measurement(DeactivableMixin, ModelSQL, ModelView, metaclass=PoolMeta):
                                 valid_from=BaseObject.date2string(self.valid_from),
                                 end_date=BaseObject.date2string(self.base_object.end_date)))
     @classmethod
+    def on_modification(cls, mode, records, field_names=None):
+        super().on_modification(mode, records, field_names=field_names)
+        cls._clear_latest_cache()
+
+    @classmethod
+    def _clear_latest_cache(cls):
+        "Drop the answers of get_latest kept for the transaction"
+        Transaction().join(LatestMeasurementCache()).answers.clear()
+
+    @classmethod
+    def get_latest(cls, queries):
+        """Resolve many "latest measurement as of date" queries at once.
+
+        queries is a list of (base_object_id, m_type_ids, date) with
+        m_type_ids the (leaf) measurement type ids to consider and date the
+        reference date (None for no limit). Returns for each query the list
+        of the latest measurement of each of its types, newest first.
+        The distinct queries are answered with one windowed query per slice;
+        the answers are kept until the transaction ends or a measurement or
+        a base object is modified."""
+        transaction = Transaction()
+        cache = transaction.join(LatestMeasurementCache()).answers
+        queries = [(o, tuple(sorted(set(t))), d) for o, t, d in queries]
+        answers = {q: cache[q] for q in set(queries) if q in cache}
+        distinct = [q for q in set(queries) if q not in answers]
+        if distinct:
+            found = {q: {} for q in distinct}
+            table = cls.__table__()
+            cursor = transaction.connection.cursor()
+            # Each query takes three values besides its type ids
+            for sub_queries in grouped_slice(
+                    distinct, backend.MAX_QUERY_PARAMS // 4):
+                sub_queries = list(sub_queries)
+                type_ids = {t for _, types, _ in sub_queries for t in types}
+                if not type_ids:
+                    continue
+                values = Values([
+                        [i, o, d or datetime.date.max]
+                        for i, (o, _, d) in enumerate(sub_queries)])
+                window = Window([values.column1, table.m_type],
+                    order_by=[table.valid_from.desc, table.id.desc])
+                latest = table.join(values,
+                    condition=(table.base_object == values.column2)
+                    & (table.valid_from <= values.column3)
+                    ).select(
+                        values.column1.as_('query'),
+                        table.m_type.as_('m_type'),
+                        table.id.as_('id'),
+                        RowNumber(window=window).as_('rank'),
+                        where=table.m_type.in_(list(type_ids))
+                        & table.active)
+                cursor.execute(*latest.select(
+                        latest.query, latest.m_type, latest.id,
+                        where=latest.rank == 1))
+                for index, m_type, id_ in cursor:
+                    query = sub_queries[index]
+                    if m_type in query[1]:
+                        found[query][m_type] = id_
+            records = cls.browse(
+                [i for by_type in found.values() for i in by_type.values()])
+            by_id = {r.id: r for r in records}
+            for query, by_type in found.items():
+                answers[query] = cache[query] = [m.id for m in sorted(
+                        (by_id[i] for i in by_type.values()),
+                        key=lambda m: (m.valid_from, m.id), reverse=True)]
+        return [cls.browse(answers[q]) for q in queries]
+
+    @classmethod
     def compute_name_search(cls, name, clause):
         if clause[1].startswith('!') or clause[1].startswith('not '):
             bool_op = 'AND'
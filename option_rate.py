@@ -178,19 +178,19 @@ class OptionRate(ModelSQL, ModelView):
         return leaves
 
     @classmethod
-    def _measurement_value(cls, base_object, m_type, cutoff_date):
+    def _measurement_values(cls, base_objects, m_type, cutoff_date):
         Measurement = Pool().get('real_estate.measurement')
-        total = None
-        for leaf in cls._measurement_type_leaves(m_type):
-            records = Measurement.search([
-                ('base_object', '=', base_object.id),
-                ('m_type', '=', leaf.id),
-                ('valid_from', '<=', cutoff_date),
-                ], order=[('valid_from', 'DESC')], limit=1)
-            if records:
-                value = Decimal(str(records[0].value))
+        leaf_ids = [leaf.id for leaf in cls._measurement_type_leaves(m_type)]
+        # latest measurement of each leaf type, for all objects at once
+        values = []
+        for records in Measurement.get_latest(
+                [(o.id, leaf_ids, cutoff_date) for o in base_objects]):
+            total = None
+            for record in records:
+                value = Decimal(str(record.value))
                 total = value if total is None else total + value
-        return total
+            values.append(total)
+        return values
 
     @classmethod
     def _approved_descendants(cls, base_object):
@@ -256,8 +256,9 @@ class OptionRate(ModelSQL, ModelView):
             return None
         numerator = Decimal(0)
         denominator = Decimal(0)
-        for rental_object in cls._rental_objects_of(kind, record):
-            weight = cls._measurement_value(rental_object, m_type, cutoff_date)
+        rental_objects = cls._rental_objects_of(kind, record)
+        weights = cls._measurement_values(rental_objects, m_type, cutoff_date)
+        for rental_object, weight in zip(rental_objects, weights):
             if weight is None:
                 continue
             rate = cls._rental_object_rate(rental_object, cutoff_date)
@@ -30,6 +30,12 @@ class ReAccounting(base_object.re_sequence_ordered(), ModelSQL, ModelView):
         help="Default payment term for operating cost settlement invoices, "
              "used when the contract itself has no payment term set.")
 
+    re_consolidate_owner_moves = fields.Boolean(
+        'Consolidate Owner-borne Moves',
+        help="Book all vacancy and flat-rate costs of a billing run in one "
+             "move per company and journal instead of one move per "
+             "settlement result.")
+
     create_moves_horizon_days = fields.Integer(
         'Move Creation Horizon (Days)',
         help="Number of days ahead of today the 'create_moves_rolling' cron "
@@ -11,11 +11,52 @@ from trytond.modules.currency.fields import Monetary
 
 import re
 import datetime
-from decimal import Decimal, ROUND_HALF_UP
+from decimal import Decimal, ROUND_FLOOR, ROUND_HALF_UP
 
 from . import base_object
 
 
+def round_preserving_sum(values, quantum, total=None):
+    """Round values to multiples of quantum so that they sum up to total
+    (default: the sum of values rounded to quantum).
+
+    Largest remainder (Hamilton) method: every value is floored to quantum
+    and the missing units go to the values with the largest remainders,
+    ties going to the earlier value. Decimal exact and O(n log n)."""
+    quantum = Decimal(str(quantum))
+    values = [v if isinstance(v, Decimal) else Decimal(str(v))
+        for v in values]
+    if not values:
+        return []
+    if total is None:
+        total = sum(values).quantize(quantum, rounding=ROUND_HALF_UP)
+    units = [(v / quantum).to_integral_value(rounding=ROUND_FLOOR)
+        for v in values]
+    missing = int((Decimal(str(total)) / quantum).to_integral_value(
+            rounding=ROUND_HALF_UP) - sum(units))
+    share, rest = divmod(missing, len(values))
+    order = sorted(range(len(values)),
+        key=lambda i: (units[i] - values[i] / quantum, i))
+    for rank, i in enumerate(order):
+        units[i] += share + (1 if rank < rest else 0)
+    return [u * quantum for u in units]
+
+
+def apportion(total, weights, quantum):
+    """Split total into parts proportional to weights, each a multiple of
+    quantum, that sum up exactly to total (see round_preserving_sum).
+    Without any weight the total is split equally."""
+    weights = [w if isinstance(w, Decimal) else Decimal(str(w or 0))
+        for w in weights]
+    weight_total = sum(weights)
+    if not weight_total:
+        weights = [Decimal(1)] * len(weights)
+        weight_total = Decimal(len(weights))
+    total = Decimal(str(total))
+    return round_preserving_sum(
+        [total * w / weight_total for w in weights], quantum, total)
+
+
 #**********************************************************************
 class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelSQL, ModelView):
     """Settlement Unit, e.g. cost allocation for a specific cost type and period within a billing unit."""
@@ -451,105 +492,152 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
 
     def selection(self):
         """Select objects and contracts for billing using the occupancy table."""
-        if self.state != 'approved' and self.state != 'selection' and self.state != 'value_share':
-            raise ValidationError(gettext(
-                'real_estate.msg_settlement_unit_selection_invalid_state',
-                name=self.rec_name, state=self.state))
-
-        CostShare = Pool().get('real_estate.cost_share')
-        if self.cost_shares:
-            CostShare.delete(list(self.cost_shares))
+        self.select_cost_shares([self])
 
-        if self.allocation_rule == 'no_allocation':
-            self.billing_unit.add_log('selection',
-                f'Settlement unit {self.id}: no_allocation — selection skipped.')
-            return
+    @classmethod
+    def select_cost_shares(cls, settlement_units):
+        """Select objects and contracts of settlement_units (of any billing
+        units) in bulk: occupancy is refreshed once per object, all
+        intervals are read with one query and all cost shares are created
+        with one create call."""
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+        CostShare = pool.get('real_estate.cost_share')
+        Occupancy = pool.get('real_estate.base_object.occupancy')
+        Log = pool.get('real_estate.billing_unit.log')
 
+        for su in settlement_units:
+            if su.state not in ('approved', 'selection', 'value_share'):
+                raise ValidationError(gettext(
+                    'real_estate.msg_settlement_unit_selection_invalid_state',
+                    name=su.rec_name, state=su.state))
 
-        Occupancy = Pool().get('real_estate.base_object.occupancy')
-        is_weg = self.billing_unit.calculation_method == 'WEG_billing'
-        bu_start = self.billing_unit.start_date
-        bu_end = self.billing_unit.end_date
-        object_count = 0
+        CostShare.delete([cs for su in settlement_units
+                for cs in su.cost_shares])
 
-        for object in self.objects:
-            if not (object.state == 'approved'
-                    and object.start_date <= bu_end
-                    and (object.end_date is None or object.end_date >= bu_start)):
-                continue
-            object_count += 1
+        logs = []
 
-            Occupancy.refresh([object])
+        def add_log(su, event, description):
+            logs.append({
+                'billing_unit': su.billing_unit.id,
+                'event': event,
+                'description': description,
+            })
 
-            occ_domain = [
-                ('base_object', '=', object.id),
-                ('start_date', '<=', bu_end),
-                ['OR', ('end_date', '=', None), ('end_date', '>=', bu_start)],
-            ]
+        # eligible objects per settlement unit
+        su_objects = []
+        objects = {}
+        for su in settlement_units:
+            if su.allocation_rule == 'no_allocation':
+                add_log(su, 'selection',
+                    f'Settlement unit {su.id}: no_allocation — selection skipped.')
+                continue
+            bu_start = su.billing_unit.start_date
+            bu_end = su.billing_unit.end_date
+            eligible = [o for o in su.objects
+                if o.state == 'approved'
+                and o.start_date <= bu_end
+                and (o.end_date is None or o.end_date >= bu_start)]
+            su_objects.append((su, eligible))
+            objects.update((o.id, o) for o in eligible)
+
+        entries_by_object = {}
+        if objects:
+            # The pending objects are no longer refreshed at the commit
+            flushed = BaseObject._flush_occupancy(list(objects))
+            others = [o for i, o in objects.items() if i not in flushed]
+            if others:
+                Occupancy.refresh(others)
+            period_start = min(su.billing_unit.start_date
+                for su, _ in su_objects)
+            period_end = max(su.billing_unit.end_date
+                for su, _ in su_objects)
+            for occ in Occupancy.search([
+                        ('base_object', 'in', list(objects)),
+                        ('start_date', '<=', period_end),
+                        ['OR', ('end_date', '=', None),
+                            ('end_date', '>=', period_start)],
+                        ], order=[('start_date', 'ASC'), ('id', 'ASC')]):
+                entries_by_object.setdefault(
+                    occ.base_object.id, []).append(occ)
+
+        to_create = []
+        for su, eligible in su_objects:
+            is_weg = su.billing_unit.calculation_method == 'WEG_billing'
+            bu_start = su.billing_unit.start_date
+            bu_end = su.billing_unit.end_date
+            by_owner = su.vacancy == 'by_owner'
+            for object in eligible:
+                entries = [e for e in entries_by_object.get(object.id, [])
+                    if e.start_date <= bu_end
+                    and (e.end_date is None or e.end_date >= bu_start)]
+                if is_weg:
+                    rented = [e for e in entries if e.state == 'rented']
+                    if not rented:
+                        add_log(su, 'selection_error',
+                            f'Settlement unit {su.id}: no rented occupancy found'
+                            f' for object {object.id}.')
+                        continue
+                    # latest rented entry
+                    entry = max(rented, key=lambda e: e.start_date)
+                    to_create.append({
+                        'settlement_unit': su.id,
+                        'contract': (
+                            entry.contract.id if entry.contract else None),
+                        'base_object': object.id,
+                        'start_date': bu_start,
+                        'end_date': bu_end,
+                        'state': 'selection',
+                    })
+                    continue
 
-            if is_weg:
-                entries = Occupancy.search(
-                    occ_domain + [('state', '=', 'rented')],
-                    order=[('start_date', 'DESC')], limit=1)
-                if not entries:
-                    self.billing_unit.add_log('selection_error',
-                        f'Settlement unit {self.id}: no rented occupancy found'
-                        f' for object {object.id}.')
-                else:
-                    cost_share = CostShare(
-                        settlement_unit=self.id,
-                        contract=entries[0].contract.id if entries[0].contract else None,
-                        base_object=object.id,
-                        start_date=bu_start,
-                        end_date=bu_end,
-                        state='selection',
-                    )
-                    cost_share.save()
-            else:
-                entries = Occupancy.search(occ_domain, order=[('start_date', 'ASC')])
-                by_owner = self.vacancy == 'by_owner'
                 rented = any(e.state == 'rented' for e in entries)
-                if not rented and not (any(e.state == 'vacant' for e in entries) and by_owner):
-                    self.billing_unit.add_log('selection_error',
-                        f'Settlement unit {self.id}: no rented occupancy found'
+                if not rented and not (
+                        any(e.state == 'vacant' for e in entries)
+                        and by_owner):
+                    add_log(su, 'selection_error',
+                        f'Settlement unit {su.id}: no rented occupancy found'
                         f' for object {object.id}.')
-                else:
-                    for occ in entries:
-                        share_start = max(occ.start_date, bu_start)
-                        if occ.end_date:
-                            share_end = min(occ.end_date, bu_end) if bu_end else occ.end_date
-                        else:
-                            share_end = bu_end
-
-                        if occ.state == 'rented':
-                            cost_share = CostShare(
-                                settlement_unit=self.id,
-                                contract=occ.contract.id if occ.contract else None,
-                                base_object=object.id,
-                                start_date=share_start,
-                                end_date=share_end,
-                                state='selection',
-                            )
-                            cost_share.save()
-                        elif occ.state == 'vacant' and by_owner:
-                            cost_share = CostShare(
-                                settlement_unit=self.id,
-                                contract=None,
-                                base_object=object.id,
-                                start_date=share_start,
-                                end_date=share_end,
-                                state='selection',
-                            )
-                            cost_share.save()
-                            self.billing_unit.add_log('vacancy_selection',
-                                f'Settlement unit {self.id}: vacancy cost share created'
-                                f' for object {object.id} from {share_start} to {share_end}.')
-
-        self.billing_unit.add_log('selection',
-            f'Settlement unit {self.id} selection completed: {object_count} objects processed.')
-        self.save()
-
-    def selection_actual_costs(self):
+                    continue
+                for occ in entries:
+                    share_start = max(occ.start_date, bu_start)
+                    if occ.end_date:
+                        share_end = min(occ.end_date, bu_end) if bu_end else occ.end_date
+                    else:
+                        share_end = bu_end
+
+                    if occ.state == 'rented':
+                        to_create.append({
+                            'settlement_unit': su.id,
+                            'contract': (
+                                occ.contract.id if occ.contract else None),
+                            'base_object': object.id,
+                            'start_date': share_start,
+                            'end_date': share_end,
+                            'state': 'selection',
+                        })
+                    elif occ.state == 'vacant' and by_owner:
+                        to_create.append({
+                            'settlement_unit': su.id,
+                            'contract': None,
+                            'base_object': object.id,
+                            'start_date': share_start,
+                            'end_date': share_end,
+                            'state': 'selection',
+                        })
+                        add_log(su, 'vacancy_selection',
+                            f'Settlement unit {su.id}: vacancy cost share created'
+                            f' for object {object.id} from {share_start} to {share_end}.')
+            add_log(su, 'selection',
+                f'Settlement unit {su.id} selection completed: '
+                f'{len(eligible)} objects processed.')
+
+        if to_create:
+            CostShare.create(to_create)
+        if logs:
+            Log.create(logs)
+
+    def selection_actual_costs(self, save=True):
         """Sum amount + tax of all invoice lines assigned to this settlement unit
         and write the result into actual_costs."""
         pool = Pool()
@@ -571,17 +659,27 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                 # line.amount by core.
                 actual += amount + (line.tax_amount or Decimal(0))
         self.actual_costs = actual.quantize(Decimal('0.01'))
-        self.save()
+        if save:
+            self.save()
 
     def compute_value_shares(self):
         """Compute value_share on each CostShare based on allocation_rule,
-        then write value_total as the sum on this SettlementUnit."""
-        self.selection_actual_costs()
+        then write value_total as the sum on this SettlementUnit.
+
+        Everything is computed in memory; the cost shares are saved with a
+        single save call and the settlement unit once."""
+        CostShare = Pool().get('real_estate.cost_share')
+        self.cost_shares = list(self.cost_shares)
+        self._compute_value_shares()
+        CostShare.save(self.cost_shares)
+        self.save()
+
+    def _compute_value_shares(self):
+        self.selection_actual_costs(save=False)
         for cost_share in self.cost_shares:
             if cost_share.state == 'error':
                 cost_share.state = 'selection'
                 cost_share.error_message = None
-                cost_share.save()
         pool = Pool()
         Measurement = pool.get('real_estate.measurement')
         BaseObject = pool.get('real_estate.base_object')
@@ -604,6 +702,51 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
         _unit = 0.0001
 
         # --- first pass: collect raw values without saving ---
+        if self.allocation_rule == 'allocation_by_measurement':
+            MeasurementType = pool.get('real_estate.measurement.type')
+            effective_ids = MeasurementType.get_effective_ids(self.m_type)
+            # resolve the latest measurements of all cost shares at once
+            measured_shares = [cs for cs in self.cost_shares
+                if cs.base_object]
+            latest = dict(zip(measured_shares, Measurement.get_latest([
+                            (cs.base_object.id, effective_ids, cs.end_date)
+                            for cs in measured_shares])))
+        elif self.allocation_rule == 'allocation_by_consumption':
+            pre_days = (self.type.reading_pre_days
+                        if self.type and self.type.reading_pre_days is not None
+                        else 7)
+            post_days = (self.type.reading_post_days
+                         if self.type and self.type.reading_post_days is not None
+                         else 7)
+            # meters of all objects and their readings of the billing
+            # window, loaded once for all cost shares
+            consumption_shares = [cs for cs in self.cost_shares
+                if cs.base_object and cs.contract]
+            meters_by_object = {}
+            reading_index = None
+            if consumption_shares:
+                meters = BaseObject.search([
+                        ('parent', 'in', list({cs.base_object.id
+                                    for cs in consumption_shares})),
+                        ('type', '=', 'equipment'),
+                        ('e_type', '=', 'meters'),
+                        ('meter_unit', '=', self.meter_unit.id),
+                        ('state', '=', 'approved'),
+                        ])
+                if self.reg_ex_meter:
+                    pattern = re.compile(self.reg_ex_meter)
+                    meters = [m for m in meters if pattern.search(m.name or '')]
+                for meter in meters:
+                    meters_by_object.setdefault(
+                        meter.parent.id, []).append(meter)
+                reading_index = MeterReading.get_index(meters,
+                    start=min(cs.start_date for cs in self.cost_shares
+                        if cs.start_date)
+                    - datetime.timedelta(days=pre_days),
+                    end=max(cs.end_date for cs in self.cost_shares
+                        if cs.end_date)
+                    + datetime.timedelta(days=post_days))
+
         pending = []
         for cost_share in self.cost_shares:
             if not cost_share.base_object:
@@ -613,13 +756,7 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
             error_msg = None
 
             if self.allocation_rule == 'allocation_by_measurement':
-                MeasurementType = Pool().get('real_estate.measurement.type')
-                effective_ids = MeasurementType.get_effective_ids(self.m_type)
-                measurements = Measurement.search([
-                    ('base_object', '=', cost_share.base_object.id),
-                    ('m_type', 'in', effective_ids),
-                    ('valid_from', '<=', cost_share.end_date),
-                ], order=[('valid_from', 'DESC')], limit=1)
+                measurements = latest[cost_share]
                 if measurements:
                     mval = float(measurements[0].value or 0)
                     value = (mval * cost_share.time_share / self.time_total
@@ -634,17 +771,7 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                 if not cost_share.contract:
                     value = 0.0
                 else:
-                    meter_domain = [
-                        ('parent', '=', cost_share.base_object.id),
-                        ('type', '=', 'equipment'),
-                        ('e_type', '=', 'meters'),
-                        ('meter_unit', '=', self.meter_unit.id),
-                        ('state', '=', 'approved'),
-                    ]
-                    meters = BaseObject.search(meter_domain)
-                    if self.reg_ex_meter:
-                        pattern = re.compile(self.reg_ex_meter)
-                        meters = [m for m in meters if pattern.search(m.name or '')]
+                    meters = meters_by_object.get(cost_share.base_object.id, [])
 
                     if self.proportional_calculation == 'linear_interpolation':
                         consumption = 0.0
@@ -653,10 +780,12 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                             factor = float(meter.meter_factor or 1)
                             try:
                                 end_rdg = MeterReading.set_interpolation_reading(
-                                    meter, cost_share.end_date)
+                                    meter, cost_share.end_date,
+                                    index=reading_index)
                                 if meter.meter_is_counter:
                                     start_rdg = MeterReading.set_interpolation_reading(
-                                        meter, cost_share.start_date)
+                                        meter, cost_share.start_date,
+                                        index=reading_index)
                                     consumption += (
                                         float(end_rdg.value or 0)
                                         - float(start_rdg.value or 0)
@@ -672,27 +801,13 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                             value = consumption
 
                     else:  # 'none' (default): nearest reading within a tolerance window
-                        pre_days = (self.type.reading_pre_days
-                                    if self.type and self.type.reading_pre_days is not None
-                                    else 7)
-                        post_days = (self.type.reading_post_days
-                                     if self.type and self.type.reading_post_days is not None
-                                     else 7)
-
-                        def _closest_reading(meter_id, target_date):
+
+                        def _closest_reading(meter, target_date):
                             """Return the reading closest to target_date within the
                             window, considering all reading types (including
                             estimates and previously interpolated values)."""
-                            lo = target_date - datetime.timedelta(days=pre_days)
-                            hi = target_date + datetime.timedelta(days=post_days)
-                            rdgs = MeterReading.search([
-                                ('base_object', '=', meter_id),
-                                ('reading_date', '>=', lo),
-                                ('reading_date', '<=', hi),
-                            ])
-                            if not rdgs:
-                                return None
-                            return min(rdgs, key=lambda r: abs((r.reading_date - target_date).days))
+                            return reading_index.closest(
+                                meter, target_date, pre_days, post_days)
 
                         # Predecessor vacancy: cost share for same object ending
                         # the day before this one's start_date with no contract.
@@ -713,12 +828,12 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                         for meter in meters:
                             factor = float(meter.meter_factor or 1)
                             if meter.meter_is_counter:
-                                end_rdg = _closest_reading(meter.id, cost_share.end_date)
-                                start_rdg = _closest_reading(meter.id, cost_share.start_date)
+                                end_rdg = _closest_reading(meter, cost_share.end_date)
+                                start_rdg = _closest_reading(meter, cost_share.start_date)
                                 # If no start reading and predecessor is a vacancy,
                                 # try the reading at the start of that vacancy.
                                 if start_rdg is None and predecessor and not predecessor.contract:
-                                    start_rdg = _closest_reading(meter.id, predecessor.start_date)
+                                    start_rdg = _closest_reading(meter, predecessor.start_date)
                                 if not end_rdg:
                                     error_msg = gettext(
                                         'real_estate.msg_no_end_reading',
@@ -739,7 +854,7 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                                 ) * factor
                                 found = True
                             else:
-                                rdg = _closest_reading(meter.id, cost_share.end_date)
+                                rdg = _closest_reading(meter, cost_share.end_date)
                                 if not rdg:
                                     error_msg = gettext(
                                         'real_estate.msg_no_end_reading',
@@ -764,23 +879,10 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                                     'allocation_per_rental_unit'):
             ok_rows = [(cs, v) for cs, v, _ in pending if v is not None]
             if ok_rows:
-                rounded = [(cs, round(v, 4)) for cs, v in ok_rows]
-                exact_sum = sum(v for _, v in ok_rows)
-                rounded_sum = sum(v for _, v in rounded)
-                diff = round(exact_sum - rounded_sum, 4)
-                if diff > 0:
-                    n = round(diff / _unit)
-                    rounded.sort(key=lambda r: r[1])
-                    for i in range(n):
-                        cs, v = rounded[i % len(rounded)]
-                        rounded[i % len(rounded)] = (cs, round(v + _unit, 4))
-                elif diff < 0:
-                    n = round(-diff / _unit)
-                    rounded.sort(key=lambda r: r[1], reverse=True)
-                    for i in range(n):
-                        cs, v = rounded[i % len(rounded)]
-                        rounded[i % len(rounded)] = (cs, round(v - _unit, 4))
-                corrected = {id(cs): v for cs, v in rounded}
+                rounded = round_preserving_sum(
+                    [v for _, v in ok_rows], _unit)
+                corrected = {id(cs): float(v)
+                    for (cs, _), v in zip(ok_rows, rounded)}
                 pending = [
                     (cs, corrected[id(cs)] if v is not None else None, em)
                     for cs, v, em in pending
@@ -791,7 +893,7 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                 for cs, v, em in pending
             ]
 
-        # --- second pass: save ---
+        # --- second pass: assign ---
         for cost_share, value, error_msg in pending:
             if value is not None:
                 cost_share.value_share = value
@@ -801,41 +903,22 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
             else:
                 cost_share.state = 'error'
                 cost_share.error_message = error_msg
-            cost_share.save()
 
         self.value_total = total
-        self.save()
-
-        CostShare = pool.get('real_estate.cost_share')
-        vt = Decimal(str(total)) if total else Decimal(0)
 
-        cost_shares = CostShare.search(
-            [('settlement_unit', '=', self.id),
-             ('state', '=', 'value_share')])
+        cost_shares = [cs for cs in self.cost_shares
+            if cs.state == 'value_share']
 
         def _distribute(su_amount):
-            """Return list of (cost_share, rounded_amount) summing to su_amount."""
-            _cent = Decimal('0.01')
-            rows = []
-            for cs in cost_shares:
-                if not cs.value_share or not vt:
-                    raw = Decimal(0)
-                else:
-                    vs = Decimal(str(cs.value_share))
-                    raw = su_amount * vs / vt
-                rows.append([cs, raw.quantize(_cent, rounding=ROUND_HALF_UP)])
-            diff = (su_amount - sum(r[1] for r in rows)).quantize(_cent)
-            if diff and rows:
-                n = int(abs(diff) / _cent)
-                if diff > 0:
-                    rows.sort(key=lambda r: r[1])
-                    for i in range(n):
-                        rows[i % len(rows)][1] += _cent
-                else:
-                    rows.sort(key=lambda r: r[1], reverse=True)
-                    for i in range(n):
-                        rows[i % len(rows)][1] -= _cent
-            return rows
+            """Return list of (cost_share, rounded_amount) summing to su_amount.
+
+            The amount is split in proportion to the value shares of the
+            distributed cost shares only, not value_total: the part of a
+            cost share which is not in the value_share state goes to the
+            others pro rata instead of cent by cent."""
+            amounts = apportion(su_amount,
+                [cs.value_share for cs in cost_shares], Decimal('0.01'))
+            return [[cs, amount] for cs, amount in zip(cost_shares, amounts)]
 
         planned_rows = _distribute(self.planned_costs or Decimal(0))
         actual_rows = _distribute(self.actual_costs or Decimal(0))
@@ -844,7 +927,6 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
         for cost_share, planned_amount in planned_rows:
             cost_share.planned_costs = planned_amount
             cost_share.actual_costs = actual_by_id.get(cost_share.id, Decimal(0))
-            cost_share.save()
 
     def _compute_value_shares_external(self):
         """For allocation_from_external_billing.
@@ -859,8 +941,7 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
         Actual costs are entered later directly on SettlementResult via
         export/import.
         """
-        CostShare = Pool().get('real_estate.cost_share')
-        cost_shares = CostShare.search([('settlement_unit', '=', self.id)])
+        cost_shares = self.cost_shares
 
         bu_external = (self.billing_unit.external_billing
             if self.billing_unit else False)
@@ -876,10 +957,8 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                 cs.planned_costs = Decimal(0)
                 cs.state = 'value_share'
                 cs.error_message = ''
-                cs.save()
             self.planned_costs = Decimal(0)
             self.value_total = float(self.actual_costs or 0)
-            self.save()
         else:
             # Classic mode: values must be entered per CostShare
             total_actual = Decimal(0)
@@ -889,19 +968,16 @@ class SettlementUnit(DeactivableMixin, base_object.re_sequence_ordered(), ModelS
                 if cs.actual_costs is None:
                     cs.state = 'error'
                     cs.error_message = 'No actual costs entered for external billing.'
-                    cs.save()
                     has_error = True
                     continue
                 cs.state = 'value_share'
                 cs.error_message = ''
-                cs.save()
                 total_actual += cs.actual_costs or Decimal(0)
                 total_planned += cs.planned_costs or Decimal(0)
             if not has_error:
                 self.actual_costs = total_actual
                 self.planned_costs = total_planned
                 self.value_total = float(total_actual)
-                self.save()
 
     def billing(self, selection_on=False):
         if self.state == 'billed':
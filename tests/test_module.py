@@ -1,6 +1,27 @@
+import contextlib
+import datetime
+import operator
+from decimal import Decimal
+from unittest.mock import patch
 
+from trytond.i18n import gettext
+from trytond.model.exceptions import ValidationError
+from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_invoice.tests import set_invoice_sequences
+from trytond.modules.company.tests import create_company, set_company
 from trytond.pool import Pool
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction
+
+from trytond.modules.real_estate import billing_unit as billing_unit_module
+from trytond.modules.real_estate import contract_core as contract_core_module
+from trytond.modules.real_estate import contract_term as contract_term_module
+from trytond.modules.real_estate.base_object import (
+    MeterReadingIndex, RecomputeDataManager, partition_by_cost)
+from trytond.modules.real_estate.contract_term import RhythmSchedule
+from trytond.modules.real_estate.measurement import LatestMeasurementCache
+from trytond.modules.real_estate.settlement_unit import (
+    apportion, round_preserving_sum)
 
 
 class _StubNamed:
@@ -20,6 +41,221 @@ class _StubSettlementUnit:
         self.meter_unit = meter_unit
 
 
+class _StubReading:
+    "Minimal duck-typed stand-in for a real_estate.meter_reading record"
+
+    def __init__(self, id, meter, reading_date, m_type='reading',
+            meter_id='M1'):
+        self.id = id
+        self.base_object = meter
+        self.reading_date = reading_date
+        self.m_type = m_type
+        self.meter_id = meter_id
+
+
+class _StubMeterReadingIndex(MeterReadingIndex):
+    "MeterReadingIndex which searches a list of stub readings"
+
+    def __init__(self, stored, readings=None, start=None, end=None):
+        super().__init__(readings, start=start, end=end)
+        self.stored = stored
+
+    def _search(self, meter, domain, order, limit=None):
+        operators = {
+            '<': operator.lt, '>': operator.gt,
+            '<=': operator.le, '>=': operator.ge,
+            '=': operator.eq, 'in': lambda a, b: a in b,
+            }
+        readings = sorted((r for r in self.stored
+                if r.base_object == meter
+                and all(operators[o](getattr(r, n), v) for n, o, v in domain)),
+            key=lambda r: (r.reading_date, r.id),
+            reverse=order[0][1] == 'DESC')
+        return readings[:limit]
+
+
+def create_accounting(company, tax=False):
+    "Create the chart, the fiscal years 2024-2026 and the real estate config"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    FiscalYear = pool.get('account.fiscalyear')
+    ReAccounting = pool.get('real_estate.re_accounting')
+
+    create_chart(company, tax=tax)
+    for year in (2024, 2025, 2026):
+        fiscalyear = get_fiscalyear(
+            company, today=datetime.date(year, 1, 1))
+        set_invoice_sequences(fiscalyear)
+        fiscalyear.save()
+        FiscalYear.create_period([fiscalyear])
+    expense, = Account.search([('type.expense', '=', True)], limit=1)
+    journal, = Journal.search([('type', '=', 'expense')], limit=1)
+    re_accounting, = ReAccounting.create([{
+                'name': 'Real Estate',
+                're_account_allocation_by_owner': expense.id,
+                're_journal_billing': journal.id,
+                }])
+    company.re_accounting = re_accounting
+    company.save()
+    return re_accounting
+
+
+def create_property(company, objects=3, name='Property', sequence=1):
+    "Create a property with residential objects"
+    pool = Pool()
+    BaseObject = pool.get('real_estate.base_object')
+    UseClass = pool.get('real_estate.use_class')
+
+    use_class, = UseClass.create([{'name': 'Residential'}])
+    start_date = datetime.date(2020, 1, 1)
+    property_, = BaseObject.create([{
+                'name': name,
+                'type': 'property',
+                'sequence': sequence,
+                'company': company.id,
+                'start_date': start_date,
+                }])
+    objects = BaseObject.create([{
+                'name': f'{name} {i}',
+                'type': 'object',
+                'use_class': use_class.id,
+                'type_of_use': 'residential',
+                'parent': property_.id,
+                'property': property_.id,
+                'sequence': i,
+                'company': company.id,
+                'start_date': start_date,
+                } for i in range(1, objects + 1)])
+    return property_, objects
+
+
+def create_contracts(company, re_accounting, property_, count=2,
+        start_date=datetime.date(2024, 1, 1)):
+    "Create running rent contracts of a tenant on the property"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Journal = pool.get('account.journal')
+    Party = pool.get('party.party')
+    ContractType = pool.get('real_estate.contract.type')
+    Contract = pool.get('real_estate.contract')
+
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('closed', '!=', True),
+            ], limit=1)
+    journal, = Journal.search([('type', '=', 'revenue')], limit=1)
+    party, = Party.create([{
+                'name': 'Tenant',
+                'addresses': [('create', [{}])],
+                }])
+    c_type, = ContractType.create([{
+                're_accounting': re_accounting.id,
+                'name': 'Rent',
+                'invoice_type': 'out',
+                'account_journal': journal.id,
+                'account_billing_unit': revenue.id,
+                'prefix': 'R',
+                'start_number': 1,
+                'step_item': 1,
+                'step_term': 1,
+                'sequence': 1,
+                'types_of_use': ['residential'],
+                }])
+    return Contract.create([{
+                'company': company.id,
+                'property': property_.id,
+                'type_of_use': 'residential',
+                'c_type': c_type.id,
+                'currency': company.currency.id,
+                'start_date': start_date,
+                'unlimited': True,
+                'contractual_partner': party.id,
+                'invoice_address': party.addresses[0].id,
+                'sequence': i + 1,
+                } for i in range(count)])
+
+
+def create_rent_terms(re_accounting, contracts, objects,
+        unit_price=Decimal(100), start_date=datetime.date(2024, 1, 1),
+        taxes=()):
+    "Create a monthly rent term on an object for each contract and run them"
+    pool = Pool()
+    Account = pool.get('account.account')
+    Uom = pool.get('product.uom')
+    Contract = pool.get('real_estate.contract')
+    ContractItem = pool.get('real_estate.contract.item')
+    ContractTerm = pool.get('real_estate.contract.term')
+    TermType = pool.get('real_estate.contract.term.type')
+
+    revenue, = Account.search([
+            ('type.revenue', '=', True),
+            ('closed', '!=', True),
+            ], limit=1)
+    unit, = Uom.search([('symbol', '=', 'u')], limit=1)
+    term_type, = TermType.create([{
+                're_accounting': re_accounting.id,
+                'name': 'Rent',
+                'types_of_use': ['residential'],
+                'oc_processing': 'none',
+                'sequence': 1,
+                'rhythm': 1,
+                'rhythm_type': 'monthly',
+                'account': revenue.id,
+                }])
+    terms = []
+    for contract, object_ in zip(contracts, objects):
+        item, = ContractItem.create([{
+                    'contract': contract.id,
+                    'valid_from': start_date,
+                    'objects': [('create', [{'object': object_.id}])],
+                    }])
+        terms.extend(ContractTerm.create([{
+                        'contract': contract.id,
+                        'term_type': term_type.id,
+                        'reference_item': item.id,
+                        'valid_from': start_date,
+                        'quantity': 1,
+                        'unit': unit.id,
+                        'unit_price': unit_price,
+                        'rhythm': 1,
+                        'rhythm_type': 'monthly',
+                        'account': revenue.id,
+                        'sequence': 1,
+                        'taxes': [('add', [t.id for t in taxes])],
+                        }]))
+    Contract.write(list(contracts), {
+            'state': 'running',
+            'start_booking_date': start_date,
+            })
+    return terms
+
+
+def create_billing_unit(property_, objects, contracts):
+    """Create a billing unit of 2024 ready for billing with an approved
+    settlement result per object (alternating over the contracts)"""
+    pool = Pool()
+    BillingUnit = pool.get('real_estate.billing_unit')
+    SettlementResult = pool.get('real_estate.settlement_result')
+
+    billing_unit, = BillingUnit.create([{
+                'property': property_.id,
+                'start_date': datetime.date(2024, 1, 1),
+                'description': 'Operating costs',
+                }])
+    results = SettlementResult.create([{
+                'billing_unit': billing_unit.id,
+                'actual_costs': Decimal(i + 10),
+                'advanced_payment': Decimal(5),
+                'state': 'approved',
+                'contract': contracts[i % len(contracts)].id,
+                'start_date': datetime.date(2024, 1, 1),
+                'end_date': datetime.date(2024, 12, 31),
+                } for i, _ in enumerate(objects)])
+    BillingUnit.write([billing_unit], {'state': 'ready_for_billing'})
+    return billing_unit, results
+
+
 class RealEstateTestCase(ModuleTestCase):
     "Test Real Estate module"
     module = 'real_estate'
@@ -116,5 +352,1536 @@ class RealEstateTestCase(ModuleTestCase):
         self.assertNotEqual(label, '—')
         self.assertEqual(label, Report._allocation_label(su_missing))
 
+    @with_transaction()
+    def test_meter_reading_index_lookups(self):
+        "MeterReadingIndex answers exact, bracketing and closest lookups"
+        meter = _StubNamed(name='Meter')
+        meter.id = 1
+        date = datetime.date
+        readings = [
+            _StubReading(3, meter, date(2024, 3, 1)),
+            _StubReading(1, meter, date(2024, 1, 1), m_type='initial'),
+            _StubReading(2, meter, date(2024, 2, 1), m_type='estimate'),
+            ]
+        index = MeterReadingIndex(readings)
+
+        self.assertEqual(index.at(meter, date(2024, 2, 1)).id, 2)
+        self.assertIsNone(index.at(meter, date(2024, 2, 2)))
+        self.assertEqual(index.before(meter, date(2024, 2, 15)).id, 2)
+        self.assertEqual(
+            index.before(meter, date(2024, 2, 15),
+                m_types=('initial', 'reading')).id, 1)
+        self.assertEqual(index.after(meter, date(2024, 2, 1)).id, 3)
+        self.assertIsNone(index.after(meter, date(2024, 3, 1)))
+        self.assertEqual(index.closest(meter, date(2024, 2, 27), 7, 7).id, 3)
+        self.assertIsNone(index.closest(meter, date(2024, 2, 15), 7, 7))
+
+        reading = _StubReading(4, meter, date(2024, 2, 15))
+        index.add(reading)
+        self.assertEqual(index.closest(meter, date(2024, 2, 15), 7, 7).id, 4)
+
+        # A changed reading is moved, not duplicated
+        reading.reading_date = date(2024, 3, 15)
+        index.add(reading)
+        self.assertIsNone(index.at(meter, date(2024, 2, 15)))
+        self.assertEqual(
+            [r.id for r in index.between(
+                    meter, date(2024, 1, 1), date(2024, 12, 31))],
+            [1, 2, 3, 4])
+
+        # Lookups reaching past the loaded window search the other readings
+        stored = readings + [
+            _StubReading(5, meter, date(2023, 12, 1)),
+            _StubReading(6, meter, date(2024, 4, 1)),
+            ]
+        start, end = date(2024, 2, 1), date(2024, 3, 1)
+        index = _StubMeterReadingIndex(stored,
+            [r for r in stored if start <= r.reading_date <= end],
+            start=start, end=end)
+        self.assertEqual(index.before(meter, date(2024, 5, 1)).id, 6)
+        self.assertEqual(index.before(meter, date(2024, 2, 15)).id, 2)
+        self.assertEqual(index.before(meter, date(2024, 2, 1)).id, 1)
+        self.assertEqual(index.before(meter, date(2024, 1, 1)).id, 5)
+        self.assertEqual(
+            index.before(meter, date(2024, 2, 15), m_types=('initial',)).id,
+            1)
+        self.assertEqual(index.after(meter, date(2023, 12, 15)).id, 1)
+        self.assertEqual(index.after(meter, date(2024, 2, 15)).id, 3)
+        self.assertEqual(index.after(meter, date(2024, 3, 1)).id, 6)
+        self.assertIsNone(index.after(meter, date(2024, 4, 1)))
+        self.assertEqual(
+            [r.id for r in index.between(
+                    meter, date(2024, 1, 1), date(2024, 2, 1))], [1, 2])
+
+    @with_transaction()
+    def test_measurement_get_latest(self):
+        "The latest measurements are resolved per object, types and date"
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+        Measurement = pool.get('real_estate.measurement')
+        MeasurementType = pool.get('real_estate.measurement.type')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            _, objects = create_property(company, objects=2)
+            unit, = Uom.search([], limit=1)
+            area, heating = MeasurementType.create([{
+                        'name': name,
+                        'unit': unit.id,
+                        'types': ['object'],
+                        } for name in ['Area', 'Heating']])
+            date = datetime.date
+            area_2020, area_2022, heating_2021, other = Measurement.create([{
+                        'base_object': base_object.id,
+                        'm_type': m_type.id,
+                        'valid_from': valid_from,
+                        'value': value,
+                        } for base_object, m_type, valid_from, value in [
+                        (objects[0], area, date(2020, 1, 1), 10),
+                        (objects[0], area, date(2022, 1, 1), 12),
+                        (objects[0], heating, date(2021, 1, 1), 5),
+                        (objects[1], heating, date(2020, 6, 1), 7),
+                        ]])
+
+            def latest():
+                return Measurement.get_latest([
+                        (objects[0].id, [area.id], date(2021, 6, 1)),
+                        (objects[0].id, [area.id, heating.id],
+                            date(2021, 6, 1)),
+                        (objects[0].id, [heating.id, area.id], None),
+                        (objects[1].id, [area.id], None),
+                        (objects[1].id, [heating.id], date(2020, 5, 31)),
+                        (objects[1].id, [heating.id], date(2020, 6, 1)),
+                        ])
+
+            self.assertEqual(latest(), [
+                    [area_2020],
+                    [heating_2021, area_2020],
+                    [area_2022, heating_2021],
+                    [],
+                    [],
+                    [other],
+                    ])
+
+            # The answers are kept for the transaction
+            cache = Transaction().join(LatestMeasurementCache()).answers
+            self.assertEqual(len(cache), 6)
+            self.assertEqual(latest()[2], [area_2022, heating_2021])
+            self.assertEqual(len(cache), 6)
+
+            # Modifying a base object drops them
+            BaseObject.write([objects[1]], {'name': "Renamed"})
+            self.assertFalse(cache)
+            latest()
+
+            # A new measurement is seen by the next lookup
+            area_2021, = Measurement.create([{
+                        'base_object': objects[0].id,
+                        'm_type': area.id,
+                        'valid_from': date(2021, 3, 1),
+                        'value': 11,
+                        }])
+            self.assertEqual(latest()[:2], [
+                    [area_2021],
+                    [area_2021, heating_2021],
+                    ])
+
+            # The measurements of a deleted object go with it
+            BaseObject.delete([objects[1]])
+            self.assertEqual(Measurement.get_latest([
+                        (objects[1].id, [heating.id], None),
+                        ]), [[]])
+
+    @with_transaction()
+    def test_occupancy_refresh(self):
+        "The occupancy of many objects is rebuilt at once and diffed"
+        pool = Pool()
+        ContractItem = pool.get('real_estate.contract.item')
+        ContractType = pool.get('real_estate.contract.type')
+        Occupancy = pool.get('real_estate.base_object.occupancy')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contract, = create_contracts(
+                company, re_accounting, property_, count=1)
+            ContractType.write([contract.c_type], {'occupancy': True})
+            item, = ContractItem.create([{
+                        'contract': contract.id,
+                        'valid_from': datetime.date(2024, 1, 1),
+                        'objects': [('create', [
+                                    {'object': o.id} for o in objects[:2]])],
+                        }])
+            date = datetime.date
+
+            def timelines():
+                return {o.id: [(occ.start_date, occ.end_date, occ.state)
+                        for occ in Occupancy.search([
+                                ('base_object', '=', o.id),
+                                ], order=[('start_date', 'ASC')])]
+                    for o in objects}
+
+            def ids():
+                return {occ.id for occ in Occupancy.search([])}
+
+            Occupancy.delete(Occupancy.search([]))
+            # An object listed twice is rebuilt once
+            with patch.object(Occupancy, '_get_items_by_object',
+                    side_effect=Occupancy._get_items_by_object) as items:
+                Occupancy.refresh(list(objects) + [objects[0]])
+            self.assertEqual(items.call_count, 1)
+            rented = [(date(2020, 1, 1), date(2023, 12, 31), 'vacant'),
+                (date(2024, 1, 1), None, 'under_negotiation')]
+            expected = {
+                objects[0].id: rented,
+                objects[1].id: rented,
+                objects[2].id: [(date(2020, 1, 1), None, 'vacant')],
+                }
+            self.assertEqual(timelines(), expected)
+
+            # Unchanged rows are kept, changed ones are updated in place
+            before = ids()
+            Occupancy.refresh(objects)
+            self.assertEqual(ids(), before)
+            ContractItem.write([item], {'valid_to': date(2024, 6, 30)})
+            self.assertLessEqual(before, ids())
+            expected[objects[0].id] = expected[objects[1].id] = [
+                (date(2020, 1, 1), date(2023, 12, 31), 'vacant'),
+                (date(2024, 1, 1), date(2024, 6, 30), 'under_negotiation'),
+                (date(2024, 7, 1), None, 'vacant')]
+            self.assertEqual(timelines(), expected)
+            self.assertEqual(len(ids() - before), 2)
+
+            # Without diff all rows are re-created
+            before = ids()
+            Occupancy.refresh(objects, diff=False)
+            self.assertFalse(ids() & before)
+            self.assertEqual(timelines(), expected)
+
+    @with_transaction()
+    def test_dirty_objects_recomputed_once_per_transaction(self):
+        "Several writes are recomputed by one task queued at the commit"
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+        ContractItem = pool.get('real_estate.contract.item')
+        ContractType = pool.get('real_estate.contract.type')
+        Occupancy = pool.get('real_estate.base_object.occupancy')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contract, = create_contracts(
+                company, re_accounting, property_, count=1)
+            ContractType.write([contract.c_type], {'occupancy': True})
+
+            ContractItem.create([{
+                        'contract': contract.id,
+                        'valid_from': datetime.date(2024, 1, 1),
+                        'objects': [('create', [
+                                    {'object': o.id} for o in objects[:2]])],
+                        }])
+            BaseObject.flush_dirty()
+
+            def rented_until():
+                occupancy, = Occupancy.search([
+                        ('base_object', '=', objects[0].id),
+                        ('contract', '=', contract.id),
+                        ])
+                return occupancy.end_date
+
+            transaction = Transaction()
+            manager = transaction.join(RecomputeDataManager())
+            with patch.object(
+                    Occupancy, 'refresh', wraps=Occupancy.refresh) as refresh:
+                BaseObject.write([objects[0]], {
+                        'end_date': datetime.date(2024, 6, 30),
+                        })
+                BaseObject.write([objects[1]], {
+                        'end_date': datetime.date(2024, 6, 30),
+                        })
+                BaseObject.write([objects[0]], {
+                        'end_date': datetime.date(2024, 5, 31),
+                        })
+                refresh.assert_not_called()
+                self.assertEqual(
+                    manager.occupancy_ids, {objects[0].id, objects[1].id})
+
+                manager.tpc_begin(transaction)
+                self.assertFalse(manager.occupancy_ids)
+                refresh.assert_not_called()
+                task, = Queue.search([])
+                self.assertEqual(task.data['method'], 'recompute_dirty')
+
+                task.run()
+                refresh.assert_called_once()
+                refreshed, = refresh.call_args.args
+                self.assertEqual(
+                    {o.id for o in refreshed}, {objects[0].id, objects[1].id})
+
+            self.assertEqual(rented_until(), datetime.date(2024, 5, 31))
+            # Nothing is queued when nothing is pending
+            manager.tpc_begin(transaction)
+            self.assertEqual(len(Queue.search([])), 1)
+
+    @with_transaction()
+    def test_dirty_objects_marked_by_trigger_fields(self):
+        "Only writing a trigger field marks base objects dirty"
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+
+        company = create_company()
+        with set_company(company):
+            property_, objects = create_property(company)
+            object_ = objects[0]
+
+            with patch.object(BaseObject, '_mark_dirty') as mark_dirty:
+                BaseObject.write([object_], {'name': "Renamed"})
+                mark_dirty.assert_not_called()
+
+                BaseObject.write([object_], {
+                        'end_date': datetime.date(2024, 6, 30),
+                        })
+                mark_dirty.assert_called_once_with(
+                    occupancy_ids={object_.id},
+                    property_ids={property_.id})
+                mark_dirty.reset_mock()
+
+                BaseObject.write([object_], {'state': 'approved'})
+                mark_dirty.assert_called_once_with(
+                    occupancy_ids=set(), property_ids={property_.id})
+                mark_dirty.reset_mock()
+
+                # Only rental objects are recomputed
+                BaseObject.write([property_], {
+                        'end_date': datetime.date(2024, 6, 30),
+                        })
+                mark_dirty.assert_not_called()
+
+    @with_transaction()
+    def test_billing_invoice_lines(self):
+        "Billing creates one invoice per contract and each line once"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        Invoice = pool.get('account.invoice')
+        InvoiceLine = pool.get('account.invoice.line')
+        SettlementResult = pool.get('real_estate.settlement_result')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contracts = create_contracts(company, re_accounting, property_)
+            billing_unit, results = create_billing_unit(
+                property_, objects, contracts)
+
+            BillingUnit.billing(
+                [billing_unit], invoice_date=datetime.date(2025, 3, 1))
+
+            invoices = Invoice.search([])
+            self.assertEqual(len(invoices), 2)
+            self.assertEqual(len(InvoiceLine.search([])), 3)
+            self.assertEqual(
+                sorted(len(i.lines) for i in invoices), [1, 2])
+            self.assertEqual(
+                sum(i.untaxed_amount for i in invoices), Decimal(33))
+            self.assertEqual(
+                {r.state for r in SettlementResult.browse(results)},
+                {'billed'})
+
+    @with_transaction()
+    def test_simulate_billing(self):
+        "The simulation previews the amounts of the billing without writing"
+        pool = Pool()
+        BillingRun = pool.get('real_estate.billing_run')
+        BillingUnit = pool.get('real_estate.billing_unit')
+        Invoice = pool.get('account.invoice')
+        Move = pool.get('account.move')
+        SettlementResult = pool.get('real_estate.settlement_result')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contracts = create_contracts(company, re_accounting, property_)
+            billing_unit, results = create_billing_unit(
+                property_, objects, contracts)
+            # A vacancy borne by the owner
+            results += SettlementResult.create([{
+                        'billing_unit': billing_unit.id,
+                        'base_object': objects[2].id,
+                        'actual_costs': Decimal(7),
+                        'state': 'approved',
+                        }])
+            invoice_date = datetime.date(2025, 3, 1)
+
+            preview = BillingUnit.simulate_billing(
+                [billing_unit], invoice_date=invoice_date)
+            self.assertFalse(Invoice.search([]))
+            self.assertFalse(Move.search([]))
+            self.assertFalse(BillingRun.search([]))
+            self.assertEqual(
+                {r.state for r in SettlementResult.browse(results)},
+                {'approved'})
+            self.assertEqual(
+                BillingUnit(billing_unit.id).state, 'ready_for_billing')
+
+            BillingUnit.billing([billing_unit], invoice_date=invoice_date)
+            self.assertEqual(
+                preview['settlement_results'], sorted(r.id for r in results))
+            self.assertEqual(
+                sorted((i['contract'], i['untaxed_amount'], i['tax_amount'],
+                        i['total_amount'],
+                        sorted(l['amount'] for l in i['lines']))
+                    for i in preview['invoices']),
+                sorted((i.contract.id, i.untaxed_amount, i.tax_amount,
+                        i.total_amount, sorted(l.amount for l in i.lines))
+                    for i in Invoice.search([])))
+            self.assertEqual(
+                sorted((l['account'], l['debit'], l['credit'])
+                    for m in preview['moves'] for l in m['lines']),
+                sorted((l.account.id, l.debit, l.credit)
+                    for m in Move.search([]) for l in m.lines))
+            self.assertTrue(preview['moves'])
+
+    @with_transaction()
+    def test_billing_run_metrics(self):
+        "The billing run adds up the stage durations and row counts"
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+        BillingRun = pool.get('real_estate.billing_run')
+
+        run = BillingRun(
+            duration_checks=None, duration_moves=None, invoice_count=None)
+        run.add_metrics({'checks': 1.5}, {'invoice': 2})
+        run.add_metrics({'checks': 0.5, 'moves': 1}, {'invoice': 1})
+        self.assertEqual(run.duration_checks, datetime.timedelta(seconds=2))
+        self.assertEqual(run.duration_moves, datetime.timedelta(seconds=1))
+        self.assertEqual(run.invoice_count, 3)
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contracts = create_contracts(company, re_accounting, property_)
+            billing_unit, results = create_billing_unit(
+                property_, objects, contracts)
+            BaseObject.write([property_], {'state': 'approved'})
+
+            BaseObject.do_billing([property_.id],
+                invoice_date=datetime.date(2025, 3, 1))
+            run, = BillingRun.search([])
+            self.assertEqual(run.state, 'done')
+            self.assertEqual(run.duration, run.finished_at - run.started_at)
+            self.assertEqual(
+                (run.property_count, run.properties_done,
+                    run.billing_unit_count, run.settlement_result_count,
+                    run.invoice_count, run.invoice_line_count,
+                    run.move_count, run.billing_unit_moves_count),
+                (1, 1, 1, len(results), 2, 3, 0, 3))
+            for stage in ['checks', 'aggregation', 'invoices', 'posting',
+                    'moves']:
+                self.assertGreaterEqual(getattr(run, f'duration_{stage}'),
+                    datetime.timedelta(0), msg=stage)
+            self.assertEqual(run.billing_units, (billing_unit,))
+
+    @with_transaction()
+    def test_billing_run_failed(self):
+        "A failed billing step is recorded on its run"
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+        BillingRun = pool.get('real_estate.billing_run')
+        BillingUnit = pool.get('real_estate.billing_unit')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contracts = create_contracts(company, re_accounting, property_)
+            create_billing_unit(property_, objects, contracts)
+            BaseObject.write([property_], {'state': 'approved'})
+            run, = BillingRun.create([{
+                        'properties': [('add', [property_.id])],
+                        'property_count': 1,
+                        }])
+
+            # The detached transaction is replaced by the current one as the
+            # test database is shared
+            with patch.object(Transaction, 'new_transaction',
+                    return_value=contextlib.nullcontext()) as new, \
+                    patch.object(BillingUnit, '_execute_billing_plan',
+                        side_effect=RuntimeError("step failed")):
+                with self.assertRaises(RuntimeError):
+                    BaseObject.do_billing([property_.id],
+                        invoice_date=datetime.date(2025, 3, 1),
+                        billing_run=run.id)
+            new.assert_called_once_with()
+            run = BillingRun(run.id)
+            self.assertEqual(run.state, 'failed')
+            self.assertEqual(run.error_message, "step failed")
+            self.assertTrue(run.finished_at)
+            self.assertFalse(run.properties_done)
+
+            # A failure to record the failure is only logged
+            with patch.object(Transaction, 'new_transaction',
+                    side_effect=RuntimeError("no connection")), \
+                    self.assertLogs(billing_unit_module.logger, 'CRITICAL'):
+                BillingRun.write_detached(run.id, {'state': 'done'})
+            self.assertEqual(BillingRun(run.id).state, 'failed')
+
+    @with_transaction()
+    def test_billing_resumed_after_failure(self):
+        "A queued billing runs one step per task and resumes after a failure"
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+        BillingRun = pool.get('real_estate.billing_run')
+        BillingUnit = pool.get('real_estate.billing_unit')
+        Invoice = pool.get('account.invoice')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contracts = create_contracts(company, re_accounting, property_)
+            billing_unit, results = create_billing_unit(
+                property_, objects, contracts)
+            BaseObject.write([property_], {'state': 'approved'})
+            run, = BillingRun.create([{
+                        'properties': [('add', [property_.id])],
+                        'property_count': 1,
+                        }])
+
+            plans = []
+            plan_billing = BillingUnit._plan_billing
+
+            def record_plan(*args, **kwargs):
+                plans.append(plan_billing(*args, **kwargs))
+                return plans[-1]
+
+            with patch.object(billing_unit_module, '_billing_step_size', 1):
+                with patch.object(BillingUnit, '_plan_billing',
+                        side_effect=record_plan):
+                    BaseObject.do_billing([property_.id],
+                        invoice_date=datetime.date(2025, 3, 1),
+                        billing_run=run.id)
+                # The step only planned its own contract
+                plan, = plans
+                self.assertFalse(plan['completed'])
+                self.assertEqual(
+                    [c.id for _, _, c, *_ in plan['invoices']],
+                    [contracts[0].id])
+                run = BillingRun(run.id)
+                self.assertEqual(run.state, 'running')
+                self.assertFalse(run.properties_done)
+                self.assertEqual(run.invoice_count, 1)
+                self.assertEqual(len(Invoice.search([])), 1)
+                self.assertEqual(
+                    BillingUnit(billing_unit.id).state, 'ready_for_billing')
+                task, = Queue.search([])
+
+                with patch.object(BillingUnit, '_plan_billing',
+                        side_effect=RuntimeError("interrupted")), \
+                        patch.object(BillingRun, 'write_detached') as failed:
+                    with self.assertRaises(RuntimeError):
+                        task.run()
+                self.assertEqual(len(Invoice.search([])), 1)
+                # The failure is recorded outside of the task
+                (run_id, values), _ = failed.call_args
+                self.assertEqual(run_id, run.id)
+                self.assertEqual(values['state'], 'failed')
+
+                task.run()
+            run = BillingRun(run.id)
+            self.assertEqual(run.state, 'done')
+            self.assertEqual(run.properties_done, 1)
+            self.assertEqual(run.billing_unit_count, 1)
+            self.assertEqual(run.settlement_result_count, len(results))
+            self.assertEqual(run.invoice_count, 2)
+            self.assertEqual(run.invoice_line_count, 3)
+            self.assertEqual(len(Invoice.search([])), 2)
+            self.assertEqual(BillingUnit(billing_unit.id).state, 'billed')
+            self.assertEqual(len(Queue.search([])), 1)
+
+    @with_transaction()
+    def test_settlement_result_follows_invoice_changes(self):
+        "Settlement results are rebuilt when an advance payment is posted"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        Contract = pool.get('real_estate.contract')
+        CostShare = pool.get('real_estate.cost_share')
+        CostType = pool.get('real_estate.cost_type')
+        Invoice = pool.get('account.invoice')
+        SettlementResult = pool.get('real_estate.settlement_result')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contract, = create_contracts(
+                company, re_accounting, property_, count=1)
+            create_rent_terms(re_accounting, [contract], objects)
+            Contract.create_moves(
+                [contract.id], datetime.date(2024, 2, 28),
+                're_calc_and_create')
+
+            billing_unit, = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'description': 'Operating costs',
+                        }])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            settlement_unit, = SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': 1,
+                        }])
+            CostShare.create([{
+                        'settlement_unit': settlement_unit.id,
+                        'contract': contract.id,
+                        'base_object': objects[0].id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'end_date': datetime.date(2024, 12, 31),
+                        'actual_costs': Decimal(300),
+                        }])
+            BillingUnit.write([billing_unit], {'state': 'value_share'})
+
+            def advanced_payment():
+                result, = SettlementResult.search([
+                        ('billing_unit', '=', billing_unit.id)])
+                return result.advanced_payment
+
+            BillingUnit.compute_settlement_result([billing_unit])
+            self.assertEqual(advanced_payment(), Decimal(0))
+
+            invoice, _ = Invoice.search([], order=[('invoice_date', 'ASC')])
+            with Transaction().set_context(_skip_warnings=True):
+                Invoice.post([invoice])
+            BillingUnit.compute_settlement_result(
+                [BillingUnit(billing_unit.id)])
+            self.assertEqual(advanced_payment(), Decimal(100))
+
+            # Only the invoice changes, its lines are untouched
+            fingerprint = BillingUnit(
+                billing_unit.id)._get_settlement_fingerprint()
+            Invoice.write([invoice], {'state': 'paid'})
+            self.assertNotEqual(
+                BillingUnit(billing_unit.id)._get_settlement_fingerprint(),
+                fingerprint)
+
+    @with_transaction()
+    def test_settlement_result_rebuilt_after_selection(self):
+        "Resetting the selection clears the settlement fingerprint"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        CostType = pool.get('real_estate.cost_type')
+        SettlementResult = pool.get('real_estate.settlement_result')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+
+        company = create_company()
+        with set_company(company):
+            create_accounting(company)
+            property_, objects = create_property(company)
+            billing_unit, = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'description': 'Operating costs',
+                        'settlement_fingerprint': '{"": "1"}',
+                        }])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': 1,
+                        'allocation_rule': 'no_allocation',
+                        }])
+            SettlementResult.create([{
+                        'billing_unit': billing_unit.id,
+                        'actual_costs': Decimal(10),
+                        'state': 'approved',
+                        }])
+            BillingUnit.write([billing_unit], {'state': 'approved'})
+
+            with Transaction().set_context(_skip_warnings=True):
+                BillingUnit.selection([billing_unit])
+            billing_unit = BillingUnit(billing_unit.id)
+            self.assertFalse(SettlementResult.search([]))
+            self.assertIsNone(billing_unit.settlement_fingerprint)
+
+    @with_transaction()
+    def test_projected_cash_flows(self):
+        "The draft cash flows are projected up to the end of the term"
+        pool = Pool()
+        Contract = pool.get('real_estate.contract')
+        ContractTerm = pool.get('real_estate.contract.term')
+        ProjectedCashFlows = pool.get(
+            'real_estate.contract.projected_cash_flows.wizard', type='wizard')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contracts = create_contracts(
+                company, re_accounting, property_, count=3)
+            terms = create_rent_terms(re_accounting, contracts, objects)
+            date = datetime.date
+
+            def document_dates(term, end_date=None):
+                term = ContractTerm(term.id)
+                return [cf.document_date
+                    for cf in term.get_projected_cash_flows(end_date)]
+
+            def months(start, count):
+                return [date(start.year + (start.month + i - 1) // 12,
+                        (start.month + i - 1) % 12 + 1, 1)
+                    for i in range(count)]
+
+            # Up to the given date, at most _re_calc_year ahead
+            self.assertEqual(
+                document_dates(terms[0], date(2024, 6, 30)),
+                months(date(2024, 1, 1), 6))
+            today = date.today()
+            limit = today.replace(
+                year=today.year + contract_term_module._re_calc_year)
+            dates = document_dates(terms[0], date(limit.year + 5, 1, 1))
+            self.assertEqual(dates, document_dates(terms[0]))
+            self.assertEqual(dates, months(date(2024, 1, 1), len(dates)))
+            self.assertLessEqual(dates[-1], limit)
+            self.assertGreater(months(dates[-1], 2)[1], limit)
+
+            # Up to the end of the term or of the contract
+            ContractTerm.write([terms[1]], {'valid_to': date(2024, 3, 31)})
+            self.assertEqual(
+                document_dates(terms[1]), months(date(2024, 1, 1), 3))
+            Contract.write([contracts[2]], {
+                    'unlimited': False,
+                    'end_date': date(2024, 4, 30),
+                    })
+            self.assertEqual(
+                document_dates(terms[2]), months(date(2024, 1, 1), 4))
+
+            # None for a cancelled contract
+            Contract.write([contracts[1]], {'state': 'cancelled'})
+            self.assertEqual(document_dates(terms[1]), [])
+
+            # The wizard shows the projection of the contract
+            with Transaction().set_context(
+                    active_model='real_estate.contract',
+                    active_id=contracts[0].id,
+                    active_ids=[contracts[0].id]):
+                session_id, _, _ = ProjectedCashFlows.create()
+                result = ProjectedCashFlows.execute(session_id, {
+                        'start': {
+                            'contract': contracts[0].id,
+                            'date': date(2024, 2, 29),
+                            },
+                        }, 'result')
+            cash_flows = result['view']['defaults']['cash_flows']
+            self.assertEqual(
+                [(cf['document_date'], cf['term'], cf['amount'])
+                    for cf in cash_flows],
+                [(date(2024, 1, 1), terms[0].id, Decimal(100)),
+                    (date(2024, 2, 1), terms[0].id, Decimal(100))])
+
+    @with_transaction()
+    def test_term_cash_flows_kept_on_re_calc(self):
+        "Recalculating a term keeps its unchanged cash flows"
+        pool = Pool()
+        CashFlow = pool.get('real_estate.contract.term.cash_flow')
+        Contract = pool.get('real_estate.contract')
+        ContractTerm = pool.get('real_estate.contract.term')
+        Invoice = pool.get('account.invoice')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contract, = create_contracts(
+                company, re_accounting, property_, count=1)
+            term, = create_rent_terms(re_accounting, [contract], objects)
+            date = datetime.date
+            Contract.create_moves(
+                [contract.id], date(2024, 3, 31), 're_calc_and_create')
+
+            def cash_flows():
+                return {cf.id: (cf.document_date, cf.state,
+                        cf.invoice_line.id, cf.create_moves_run_id)
+                    for cf in CashFlow.search([('term', '=', term.id)])}
+
+            done = cash_flows()
+            self.assertEqual(sorted(v[0] for v in done.values()),
+                [date(2024, 1, 1), date(2024, 2, 1), date(2024, 3, 1)])
+            self.assertEqual({v[1] for v in done.values()}, {'done'})
+            self.assertEqual(len({v[3] for v in done.values()}), 1)
+
+            ContractTerm.write([term], {'unit_price': Decimal(120)})
+            self.assertEqual(cash_flows(), done)
+            Contract.create_moves(
+                [contract.id], date(2024, 3, 31), 're_calc')
+            self.assertEqual(cash_flows(), done)
+
+            # Cancelling an invoice only removes its own cash flow
+            invoice, = Invoice.search([
+                    ('invoice_date', '=', date(2024, 3, 1)),
+                    ])
+            Invoice.cancel([invoice])
+            Contract._re_calc_terms([Contract(contract.id)])
+            self.assertEqual(cash_flows(), {
+                    id_: values for id_, values in done.items()
+                    if values[0] != date(2024, 3, 1)})
+            self.assertEqual([cf.document_date
+                    for cf in ContractTerm(term.id).get_projected_cash_flows(
+                        date(2024, 4, 30))],
+                [date(2024, 3, 1), date(2024, 4, 1)])
+
+    @with_transaction()
+    def test_create_moves_over_several_contracts(self):
+        "Creating the moves of contracts together or apart gives the same"
+        pool = Pool()
+        CashFlow = pool.get('real_estate.contract.term.cash_flow')
+        Contract = pool.get('real_estate.contract')
+        ContractLog = pool.get('real_estate.contract.log')
+        Invoice = pool.get('account.invoice')
+        Tax = pool.get('account.tax')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company, tax=True)
+            tax, = Tax.search([])
+            date = datetime.date
+            runs = []
+            for sequence in [1, 2]:
+                property_, objects = create_property(
+                    company, name=f'Property {sequence}', sequence=sequence)
+                contracts = create_contracts(
+                    company, re_accounting, property_)
+                create_rent_terms(
+                    re_accounting, contracts, objects, taxes=[tax])
+                runs.append(contracts)
+
+            together, apart = runs
+            with patch.object(ContractLog, 'create',
+                    wraps=ContractLog.create) as create_log, \
+                    patch.object(Contract, '_save_moves',
+                        wraps=Contract._save_moves) as save_moves:
+                Contract.create_moves([c.id for c in together],
+                    date(2024, 3, 31), 're_calc_and_create')
+                # The invoices of all the contracts are logged in one call
+                (vlist,), _ = create_log.call_args
+                save_moves.assert_called_once()
+            self.assertEqual(len(vlist), 3 * len(together))
+            self.assertEqual(
+                {v['contract'] for v in vlist}, {c.id for c in together})
+            for contract in apart:
+                Contract.create_moves(
+                    [contract.id], date(2024, 3, 31), 're_calc_and_create')
+
+            def moves(contract):
+                invoices = Invoice.search([
+                        ('contract', '=', contract.id),
+                        ], order=[('invoice_date', 'ASC')])
+                cash_flows = CashFlow.search([
+                        ('term.contract', '=', contract.id),
+                        ], order=[('document_date', 'ASC')])
+                return ([(i.invoice_date, i.accounting_date, i.state,
+                            i.untaxed_amount, i.tax_amount,
+                            [(l.quantity, l.unit_price, l.amount,
+                                    l.account, l.taxes)
+                                for l in i.lines],
+                            [(t.tax, t.base, t.amount) for t in i.taxes])
+                        for i in invoices],
+                    [(cf.document_date, cf.state,
+                            cf.invoice_line.invoice.invoice_date)
+                        for cf in cash_flows])
+
+            for contract, other in zip(together, apart):
+                invoices, cash_flows = moves(contract)
+                self.assertEqual((invoices, cash_flows), moves(other))
+                self.assertEqual(len(invoices), 3)
+                self.assertEqual(
+                    [(i[3], i[4]) for i in invoices],
+                    [(Decimal(100), Decimal(20))] * 3)
+                self.assertEqual(
+                    [(d, s) for d, s, _ in cash_flows],
+                    [(date(2024, m, 1), 'done') for m in [1, 2, 3]])
+                self.assertEqual(
+                    [d for _, _, d in cash_flows],
+                    [date(2024, m, 1) for m in [1, 2, 3]])
+
+    @with_transaction()
+    def test_create_moves_jobs_share_property_run_id(self):
+        "The contracts of a property split over jobs share one run id"
+        pool = Pool()
+        CashFlow = pool.get('real_estate.contract.term.cash_flow')
+        Contract = pool.get('real_estate.contract')
+        Queue = pool.get('ir.queue')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contracts = create_contracts(
+                company, re_accounting, property_, count=3)
+            create_rent_terms(re_accounting, contracts, objects)
+            date = datetime.date(2024, 3, 31)
+            contract_ids = [c.id for c in contracts]
+
+            # The contract and its 3 pending cash flows
+            costs, _ = Contract._create_moves_costs(contract_ids, date)
+            self.assertEqual(costs, dict.fromkeys(contract_ids, 4))
+
+            with patch.object(contract_core_module,
+                    '_create_moves_job_cost', 8):
+                Contract.call_create_moves(
+                    contract_ids, date, 're_calc_and_create')
+            tasks = Queue.search([])
+            self.assertEqual(len(tasks), 2)
+            for task in tasks:
+                task.run()
+
+            cash_flows = CashFlow.search([])
+            self.assertEqual(len(cash_flows), 9)
+            self.assertEqual(
+                {cf.term.contract for cf in cash_flows}, set(contracts))
+            run_id, = {cf.create_moves_run_id for cf in cash_flows}
+            self.assertTrue(run_id)
+
+    @with_transaction()
+    def test_selection_flushes_pending_occupancy(self):
+        "The selection refreshes each object once and clears pending ones"
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+        BillingUnit = pool.get('real_estate.billing_unit')
+        CostType = pool.get('real_estate.cost_type')
+        Occupancy = pool.get('real_estate.base_object.occupancy')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+
+        company = create_company()
+        with set_company(company):
+            property_, objects = create_property(company)
+            BaseObject.write(list(objects), {'state': 'approved'})
+            billing_unit, = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'description': 'Operating costs',
+                        }])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            settlement_unit, = SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': 1,
+                        'allocation_rule': 'allocation_per_rental_unit',
+                        'vacancy': 'by_owner',
+                        }])
+            BillingUnit.write([billing_unit], {'state': 'approved'})
+            BillingUnit.selection([billing_unit])
+            settlement_unit = SettlementUnit(settlement_unit.id)
+            eligible = {o.id for o in settlement_unit.objects
+                if o.state == 'approved'}
+            self.assertIn(objects[0].id, eligible)
+
+            manager = Transaction().join(RecomputeDataManager())
+            BaseObject._mark_dirty(occupancy_ids={objects[0].id})
+            with patch.object(
+                    Occupancy, 'refresh', wraps=Occupancy.refresh) as refresh:
+                SettlementUnit.select_cost_shares([settlement_unit])
+            refreshed = [o.id for (records,), _ in refresh.call_args_list
+                for o in records]
+            self.assertEqual(sorted(refreshed), sorted(eligible))
+            self.assertFalse(manager.occupancy_ids)
+
+    @with_transaction()
+    def test_selection_scoped_to_changed_objects(self):
+        "A changed object re-selects only the settlement units covering it"
+        pool = Pool()
+        BaseObject = pool.get('real_estate.base_object')
+        BillingUnit = pool.get('real_estate.billing_unit')
+        ContractItem = pool.get('real_estate.contract.item')
+        CostType = pool.get('real_estate.cost_type')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            BaseObject.write(list(objects), {'state': 'approved'})
+            contract, = create_contracts(
+                company, re_accounting, property_, count=1)
+            billing_unit, = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'description': 'Operating costs',
+                        }])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            first, second = SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': i,
+                        'allocation_rule': 'allocation_per_rental_unit',
+                        'vacancy': 'by_owner',
+                        'reg_ex_object': f'{object_.name}$',
+                        } for i, object_ in enumerate(objects[:2], 1)])
+            BillingUnit.write([billing_unit], {'state': 'approved'})
+            BillingUnit.selection([billing_unit])
+            selected = {su: {cs.id for cs in su.cost_shares}
+                for su in SettlementUnit.browse([first, second])}
+            self.assertTrue(all(selected.values()))
+
+            with patch.object(SettlementUnit, 'select_cost_shares',
+                    side_effect=SettlementUnit.select_cost_shares) as select:
+                ContractItem.create([{
+                            'contract': contract.id,
+                            'valid_from': datetime.date(2024, 1, 1),
+                            'objects': [('create', [
+                                        {'object': objects[0].id}])],
+                            }])
+                BaseObject.flush_dirty()
+            (settlement_units,), _ = select.call_args
+            self.assertEqual(settlement_units, [first])
+            first, second = SettlementUnit.browse([first, second])
+            self.assertFalse(
+                {cs.id for cs in first.cost_shares} & selected[first])
+            self.assertEqual(
+                {cs.id for cs in second.cost_shares}, selected[second])
+
+    @with_transaction()
+    def test_compute_value_shares(self):
+        "The value shares and costs are computed and saved at once"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        CostShare = pool.get('real_estate.cost_share')
+        CostType = pool.get('real_estate.cost_type')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+
+        company = create_company()
+        with set_company(company):
+            create_accounting(company)
+            property_, objects = create_property(company)
+            billing_unit, = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'description': 'Operating costs',
+                        }])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            settlement_unit, = SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': 1,
+                        'allocation_rule': 'allocation_per_rental_unit',
+                        'planned_costs': Decimal(100),
+                        }])
+            CostShare.create([{
+                        'settlement_unit': settlement_unit.id,
+                        'base_object': object_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'end_date': datetime.date(2024, 12, 31),
+                        } for object_ in objects])
+
+            with patch.object(CostShare, 'save',
+                    side_effect=CostShare.save) as save:
+                SettlementUnit(settlement_unit.id).compute_value_shares()
+            self.assertEqual(save.call_count, 1)
+
+            settlement_unit = SettlementUnit(settlement_unit.id)
+            self.assertEqual(settlement_unit.value_total, 3)
+            cost_shares = settlement_unit.cost_shares
+            self.assertEqual(
+                {(cs.state, cs.value_share, cs.actual_costs)
+                    for cs in cost_shares},
+                {('value_share', 1, Decimal(0))})
+            self.assertEqual(
+                sorted(cs.planned_costs for cs in cost_shares),
+                [Decimal('33.33'), Decimal('33.33'), Decimal('33.34')])
+
+    @with_transaction()
+    def test_compute_value_shares_partially_excluded(self):
+        "The costs are split among the distributed value shares only"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        CostShare = pool.get('real_estate.cost_share')
+        CostType = pool.get('real_estate.cost_type')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+
+        company = create_company()
+        with set_company(company):
+            create_accounting(company)
+            property_, objects = create_property(company)
+            billing_unit, = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'description': 'Operating costs',
+                        }])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            settlement_unit, = SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': 1,
+                        'allocation_rule': 'allocation_per_rental_unit',
+                        'planned_costs': Decimal(100),
+                        }])
+            half, full, excluded = CostShare.create([{
+                        'settlement_unit': settlement_unit.id,
+                        'base_object': object_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'end_date': end_date,
+                        'state': state,
+                        } for object_, end_date, state in zip(objects, [
+                            datetime.date(2024, 6, 30),
+                            datetime.date(2024, 12, 31),
+                            datetime.date(2024, 12, 31)], [
+                            'selection', 'selection', 'no_allocation'])])
+
+            SettlementUnit(settlement_unit.id).compute_value_shares()
+
+            settlement_unit = SettlementUnit(settlement_unit.id)
+            half, full, excluded = CostShare.browse([half, full, excluded])
+            # The excluded share counts in the value total but its part of
+            # the costs goes to the others in proportion to their shares
+            self.assertEqual(settlement_unit.value_total, 2.4973)
+            self.assertEqual(
+                [(cs.state, cs.value_share, cs.planned_costs)
+                    for cs in [half, full, excluded]], [
+                    ('value_share', 0.4973, Decimal('33.21')),
+                    ('value_share', 1, Decimal('66.79')),
+                    ('no_allocation', 1, None),
+                    ])
+
+    @with_transaction()
+    def test_compute_value_shares_by_measurement(self):
+        "Allocation by measurement weighs the latest measurement per object"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        CostShare = pool.get('real_estate.cost_share')
+        CostType = pool.get('real_estate.cost_type')
+        Measurement = pool.get('real_estate.measurement')
+        MeasurementType = pool.get('real_estate.measurement.type')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+        Uom = pool.get('product.uom')
+
+        company = create_company()
+        with set_company(company):
+            create_accounting(company)
+            property_, objects = create_property(company)
+            unit, = Uom.search([], limit=1)
+            area, = MeasurementType.create([{
+                        'name': 'Area',
+                        'unit': unit.id,
+                        'types': ['object'],
+                        }])
+            date = datetime.date
+            Measurement.create([{
+                        'base_object': object_.id,
+                        'm_type': area.id,
+                        'valid_from': valid_from,
+                        'value': value,
+                        } for object_, valid_from, value in [
+                        (objects[0], date(2020, 1, 1), 40),
+                        (objects[0], date(2024, 6, 1), 50),
+                        (objects[1], date(2020, 1, 1), 30),
+                        (objects[1], date(2025, 1, 1), 35),
+                        ]])
+            billing_unit, = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': date(2024, 1, 1),
+                        'description': 'Operating costs',
+                        }])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            settlement_unit, = SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': 1,
+                        'allocation_rule': 'allocation_by_measurement',
+                        'm_type': area.id,
+                        'planned_costs': Decimal(160),
+                        }])
+            CostShare.create([{
+                        'settlement_unit': settlement_unit.id,
+                        'base_object': object_.id,
+                        'start_date': date(2024, 1, 1),
+                        'end_date': date(2024, 12, 31),
+                        } for object_ in objects])
+
+            SettlementUnit(settlement_unit.id).compute_value_shares()
+
+            cost_shares = {cs.base_object: cs
+                for cs in SettlementUnit(settlement_unit.id).cost_shares}
+            self.assertEqual(
+                [(cost_shares[o].state, cost_shares[o].value_share,
+                        cost_shares[o].planned_costs) for o in objects], [
+                    ('value_share', 50, Decimal(100)),
+                    ('value_share', 30, Decimal(60)),
+                    ('error', None, None),
+                    ])
+
+    @with_transaction()
+    def test_settlement_result_grouped_by_object(self):
+        "The cost shares are summed up per contract and object"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        CostShare = pool.get('real_estate.cost_share')
+        CostType = pool.get('real_estate.cost_type')
+        SettlementResult = pool.get('real_estate.settlement_result')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+
+        company = create_company()
+        with set_company(company):
+            create_accounting(company)
+            property_, objects = create_property(company)
+            billing_unit, = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'description': 'Operating costs',
+                        }])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            heating, water = SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': sequence,
+                        } for sequence in [1, 2]])
+            date = datetime.date
+            CostShare.create([{
+                        'settlement_unit': settlement_unit.id,
+                        'base_object': object_.id,
+                        'start_date': start_date,
+                        'end_date': end_date,
+                        'planned_costs': planned_costs,
+                        'actual_costs': actual_costs,
+                        'active': active,
+                        } for (settlement_unit, object_, start_date, end_date,
+                            planned_costs, actual_costs, active) in [
+                        (heating, objects[0], date(2024, 1, 1),
+                            date(2024, 6, 30), Decimal(10), Decimal('12.50'),
+                            True),
+                        (water, objects[0], date(2024, 3, 1),
+                            date(2024, 12, 31), None, Decimal('1.25'), True),
+                        (heating, objects[1], date(2024, 1, 1),
+                            date(2024, 12, 31), Decimal(3), Decimal(4), True),
+                        (heating, objects[2], date(2024, 1, 1),
+                            date(2024, 12, 31), Decimal(3), Decimal(4), False),
+                        ]])
+            BillingUnit.write([billing_unit], {'state': 'value_share'})
+
+            with patch.object(SettlementResult, 'create',
+                    side_effect=SettlementResult.create) as create:
+                BillingUnit.compute_settlement_result([billing_unit])
+            self.assertEqual(create.call_count, 1)
+
+            def results():
+                return {(r.base_object, r.start_date, r.end_date,
+                        r.planned_costs, r.actual_costs): r.id
+                    for r in SettlementResult.search([])}
+
+            computed = results()
+            self.assertEqual(set(computed), {
+                    (objects[0], date(2024, 1, 1), date(2024, 12, 31),
+                        Decimal(10), Decimal('13.75')),
+                    (objects[1], date(2024, 1, 1), date(2024, 12, 31),
+                        Decimal(3), Decimal(4)),
+                    })
+
+            # Unchanged cost shares keep their results
+            BillingUnit.compute_settlement_result(
+                [BillingUnit(billing_unit.id)])
+            self.assertEqual(results(), computed)
+
+            # A removed result is rebuilt
+            SettlementResult.delete([SettlementResult(computed[min(
+                            computed, key=lambda k: k[0].id)])])
+            BillingUnit.compute_settlement_result(
+                [BillingUnit(billing_unit.id)])
+            self.assertEqual(set(results()), set(computed))
+            computed = results()
+
+            # A changed parameter of the billing unit rebuilds all results
+            BillingUnit.write([billing_unit], {'start_date': date(2024, 1, 2)})
+            BillingUnit.compute_settlement_result(
+                [BillingUnit(billing_unit.id)])
+            self.assertEqual(set(results()), set(computed))
+            self.assertFalse(set(results().values()) & set(computed.values()))
+
+    @with_transaction()
+    def test_billing_owner_borne_results(self):
+        "The owner-borne results of a run are booked in one move if asked"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        BillingUnitMoves = pool.get('real_estate.billing_unit.moves')
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        ReAccounting = pool.get('real_estate.re_accounting')
+        SettlementResult = pool.get('real_estate.settlement_result')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            for consolidate, sequence in [(False, 1), (True, 2)]:
+                ReAccounting.write([re_accounting], {
+                        're_consolidate_owner_moves': consolidate,
+                        })
+                property_, objects = create_property(company,
+                    name=f'Property {sequence}', sequence=sequence)
+                billing_unit, = BillingUnit.create([{
+                            'property': property_.id,
+                            'start_date': datetime.date(2024, 1, 1),
+                            'description': 'Operating costs',
+                            }])
+                results = SettlementResult.create([{
+                            'billing_unit': billing_unit.id,
+                            'base_object': object_.id,
+                            'actual_costs': Decimal(i),
+                            'state': 'approved',
+                            } for i, object_ in enumerate(objects)])
+                BillingUnit.write([billing_unit], {
+                        'state': 'ready_for_billing',
+                        })
+                with patch.object(Period, 'find',
+                        side_effect=Period.find) as find:
+                    BillingUnit.billing([billing_unit],
+                        invoice_date=datetime.date(2025, 3, 1))
+                self.assertEqual(find.call_count, 1)
+
+                moves = Move.search([
+                        ('lines.billing_unit', '=', billing_unit.id),
+                        ])
+                # The result without costs is billed without posting
+                self.assertEqual(len(moves), 1 if consolidate else 2)
+                self.assertEqual({m.state for m in moves}, {'posted'})
+                self.assertEqual(
+                    sorted((l.debit, l.credit)
+                        for m in moves for l in m.lines),
+                    [(Decimal(0), Decimal(1)), (Decimal(0), Decimal(2)),
+                        (Decimal(1), Decimal(0)), (Decimal(2), Decimal(0))])
+                self.assertEqual(
+                    {r.state for r in SettlementResult.browse(results)},
+                    {'billed'})
+                self.assertEqual(len(BillingUnitMoves.search([
+                                ('billing_unit', '=', billing_unit.id),
+                                ])), 2)
+
+    @with_transaction()
+    def test_cancel_billing(self):
+        "Cancelling a billing credits and reconciles the posted invoices"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        BillingUnitMoves = pool.get('real_estate.billing_unit.moves')
+        Invoice = pool.get('account.invoice')
+        MoveLine = pool.get('account.move.line')
+        SettlementResult = pool.get('real_estate.settlement_result')
+
+        company = create_company()
+        with set_company(company):
+            re_accounting = create_accounting(company)
+            property_, objects = create_property(company)
+            contracts = create_contracts(company, re_accounting, property_)
+            billing_unit, results = create_billing_unit(
+                property_, objects, contracts)
+            with Transaction().set_context(_skip_warnings=True):
+                BillingUnit.billing([billing_unit], invoice_state='posted',
+                    invoice_date=datetime.date(2025, 3, 1))
+            invoices = Invoice.search([])
+            self.assertEqual({i.state for i in invoices}, {'posted'})
+
+            with Transaction().set_context(_skip_warnings=True), \
+                    patch.object(MoveLine, 'reconcile',
+                        side_effect=MoveLine.reconcile) as reconcile:
+                BillingUnit.cancel_units([BillingUnit(billing_unit.id)],
+                    invoice_date=datetime.date(2025, 3, 2))
+            self.assertEqual(reconcile.call_count, 1)
+
+            credit_notes = [i for i in Invoice.search([])
+                if i not in invoices]
+            self.assertEqual(len(credit_notes), 2)
+            self.assertEqual(
+                sorted(i.total_amount for i in credit_notes),
+                sorted(-i.total_amount for i in invoices))
+            for invoice in invoices:
+                credit_note, = [i for i in credit_notes
+                    if i.total_amount == -invoice.total_amount]
+                reconciliations = {l.reconciliation
+                    for i in [invoice, credit_note] for l in i.lines_to_pay}
+                self.assertEqual(len(reconciliations), 1)
+                self.assertIsNotNone(reconciliations.pop())
+
+            self.assertEqual(
+                BillingUnit(billing_unit.id).state, 'value_share')
+            self.assertFalse(BillingUnitMoves.search([]))
+            self.assertEqual(
+                {(r.state, r.invoice)
+                    for r in SettlementResult.browse(results)},
+                {('approved', None)})
+
+    @with_transaction()
+    def test_billing_readiness(self):
+        "The readiness report lists what blocks the billing"
+        pool = Pool()
+        BillingUnit = pool.get('real_estate.billing_unit')
+        CostShare = pool.get('real_estate.cost_share')
+        CostType = pool.get('real_estate.cost_type')
+        SettlementResult = pool.get('real_estate.settlement_result')
+        SettlementUnit = pool.get('real_estate.settlement_unit')
+
+        company = create_company()
+        with set_company(company):
+            create_accounting(company)
+            property_, objects = create_property(company)
+            earlier, billing_unit = BillingUnit.create([{
+                        'property': property_.id,
+                        'start_date': datetime.date(year, 1, 1),
+                        'description': 'Operating costs',
+                        } for year in [2023, 2024]])
+            cost_type, = CostType.create([{'name': 'Heating', 'sequence': 1}])
+            heating, _ = SettlementUnit.create([{
+                        'billing_unit': billing_unit.id,
+                        'type': cost_type.id,
+                        'sequence': sequence,
+                        'allocation_rule': 'allocation_per_rental_unit',
+                        } for sequence in [1, 2]])
+            CostShare.create([{
+                        'settlement_unit': heating.id,
+                        'base_object': object_.id,
+                        'start_date': datetime.date(2024, 1, 1),
+                        'end_date': datetime.date(2024, 12, 31),
+                        'state': state,
+                        'actual_costs': actual_costs,
+                        } for object_, state, actual_costs in [
+                        (objects[0], 'value_share', Decimal(30)),
+                        (objects[1], 'error', Decimal(10)),
+                        ]])
+            SettlementResult.create([{
+                        'billing_unit': billing_unit.id,
+                        'base_object': object_.id,
+                        'actual_costs': actual_costs,
+                        'advanced_payment': advanced_payment,
+                        'state': 'approved',
+                        } for object_, actual_costs, advanced_payment in [
+                        (objects[0], Decimal(10), None),
+                        (objects[1], Decimal(0), Decimal(3)),
+                        ]])
+            BillingUnit.write([earlier, billing_unit], {
+                    'state': 'value_share',
+                    })
+
+            problems = BillingUnit._get_settlement_problems(
+                [earlier, billing_unit])
+            self.assertEqual(
+                [message for message, _ in problems[earlier.id]],
+                ['real_estate.msg_billing_unit_no_settlement_results'])
+            self.assertEqual(
+                [message for message, _ in problems[billing_unit.id]], [
+                    'real_estate.msg_billing_unit_settlement_unit_errors',
+                    'real_estate.msg_billing_unit_zero_actual_costs',
+                    'real_estate.msg_billing_unit_settlement_result_'
+                    'missing_term',
+                    'real_estate.msg_billing_unit_sum_mismatch',
+                    ])
+            earlier, billing_unit = BillingUnit.browse(
+                [earlier, billing_unit])
+            self.assertEqual(earlier.readiness, gettext(
+                    'real_estate.msg_billing_unit_no_settlement_results',
+                    name=earlier.name))
+            self.assertTrue(billing_unit.readiness.startswith(gettext(
+                        'real_estate.msg_billing_unit_chronological_order',
+                        names=earlier.name)))
+
+            for billing_units in [[earlier], [billing_unit]]:
+                with self.assertRaises(ValidationError):
+                    BillingUnit.check_ready_for_billing(billing_units)
+            with self.assertRaises(ValidationError):
+                BillingUnit._check_chronological_order([billing_unit])
+            BillingUnit._check_chronological_order([earlier, billing_unit])
+
+    @with_transaction()
+    def test_round_preserving_sum(self):
+        "round_preserving_sum keeps the rounded total, largest remainder first"
+        cent = Decimal('0.01')
+        self.assertEqual(
+            round_preserving_sum([Decimal(1) / 3] * 3, cent),
+            [Decimal('0.34'), Decimal('0.33'), Decimal('0.33')])
+        self.assertEqual(
+            round_preserving_sum(
+                [Decimal('0.125'), Decimal('0.126'), Decimal('0.749')], cent),
+            [Decimal('0.12'), Decimal('0.13'), Decimal('0.75')])
+        self.assertEqual(
+            round_preserving_sum([0.33335, 0.66665], 0.0001),
+            [Decimal('0.3334'), Decimal('0.6666')])
+        self.assertEqual(round_preserving_sum([], cent), [])
+
+        values = [Decimal(i) / 7 for i in range(1, 2000)]
+        rounded = round_preserving_sum(values, Decimal('0.0001'))
+        self.assertEqual(
+            sum(rounded), sum(values).quantize(Decimal('0.0001')))
+        for value, result in zip(values, rounded):
+            self.assertLess(abs(value - result), Decimal('0.0001'))
+
+    @with_transaction()
+    def test_apportion(self):
+        "apportion splits a total exactly along the weights"
+        cent = Decimal('0.01')
+        self.assertEqual(
+            apportion(Decimal('100.00'), [1, 1, 1], cent),
+            [Decimal('33.34'), Decimal('33.33'), Decimal('33.33')])
+        self.assertEqual(
+            apportion(Decimal('-10.00'), [1, 2], cent),
+            [Decimal('-3.33'), Decimal('-6.67')])
+        self.assertEqual(
+            apportion(Decimal('0.05'), [0, 0], cent),
+            [Decimal('0.03'), Decimal('0.02')])
+        self.assertEqual(
+            apportion(Decimal('10.00'), [Decimal('0.5'), None], cent),
+            [Decimal('10.00'), Decimal('0.00')])
+
+    @with_transaction()
+    def test_partition_by_cost(self):
+        "partition_by_cost packs keys largest first within the budget"
+        jobs = partition_by_cost({1: 50, 2: 500, 3: 30, 4: 40, 5: 5}, 100)
+        self.assertEqual(jobs, [[2], [1, 4, 5], [3]])
+        self.assertEqual(partition_by_cost({}, 100), [])
+
+        costs = {i: i % 17 + 1 for i in range(200)}
+        jobs = partition_by_cost(costs, 60)
+        self.assertEqual(sorted(k for job in jobs for k in job), list(costs))
+        for job in jobs:
+            self.assertLessEqual(sum(costs[k] for k in job), 60)
+
+    @with_transaction()
+    def test_rhythm_schedule(self):
+        "RhythmSchedule jumps to the same dates as stepping period by period"
+        date = datetime.date
+        rhythms = [
+            ('monthly', 1), ('monthly', 5), ('quarterly', 1),
+            ('annually', 2), ('daily', 30), ('daily', 365), ('daily', 45),
+            ('weekly', 6),
+            ]
+        for rhythm_type, rhythm in rhythms:
+            for rhythm_start in [None, 'term_start', '15th_month', 'month_end']:
+                for anchor in [date(2024, 1, 31), date(2024, 2, 29),
+                        date(2025, 6, 15)]:
+                    schedule = RhythmSchedule(
+                        rhythm_type, rhythm, rhythm_start, start_day=31)
+                    dates, current = [], anchor
+                    while len(dates) < 20:
+                        following = schedule.align(schedule.advance(current))
+                        if following <= current:
+                            break
+                        dates.append(following)
+                        current = following
+                    self.assertEqual(
+                        schedule.dates(anchor, dates[-1]), dates)
+                    for index, expected in enumerate(dates, 1):
+                        self.assertEqual(
+                            schedule.date(anchor, index), expected)
+
+        schedule = RhythmSchedule('monthly', 1, 'month_end')
+        self.assertEqual(
+            schedule.dates(date(2024, 1, 31), date(2024, 4, 29)),
+            [date(2024, 2, 29), date(2024, 3, 31)])
+        self.assertEqual(RhythmSchedule('one_time', 1).dates(
+                date(2024, 1, 1), date(2025, 1, 1)), [])
+        self.assertEqual(RhythmSchedule('weekly', 1).dates(
+                date(2024, 1, 1), date(2025, 1, 1)), [])
+
 
 del ModuleTestCase